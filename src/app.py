@@ -3,6 +3,11 @@ app
 ============
 Module that contains main iot gateway logic.
 
+Classes
+---------
+HandlerContext
+    Subsystem configs and shared handles of data handlers.
+
 Functions
 ---------
 read_conf()
@@ -17,12 +22,17 @@ on_connect_load_handler(client, userdata, flags, rc,props)
     Logic executed after successfully connecting load sensor to MQTT broker.
 on_connect_fuel_handler(client, userdata, flags, rc,props)
     Logic executed after successfully connecting fuel sensor to MQTT broker.
-collect_temperature_data(interval, url, jwt, time_pattern, mqtt_address, mqtt_port, mqtt_user,mqtt_pass, flag, stats_queue)
+collect_temperature_data(interval, url, jwt, time_pattern, mqtt_address, mqtt_port, mqtt_user,mqtt_pass, flag, stats_queue,
+                         context, worker_state)
     Collects temperature data and periodically initiates data processing and forwarding.
-collect_load_data(interval, url, jwt, time_pattern, mqtt_address, mqtt_port, mqtt_user,mqtt_pass,flag, stats_queue)
+collect_load_data(interval, url, jwt, time_pattern, mqtt_address, mqtt_port, mqtt_user,mqtt_pass,flag, stats_queue,
+                  context, worker_state)
     Collects load data and periodically initiates data processing and forwarding.
-collect_fuel_data(limit, url, jwt, time_pattern, mqtt_address, mqtt_port, mqtt_user,mqtt_pass, flag, stats_queue)
+collect_fuel_data(limit, url, jwt, time_pattern, mqtt_address, mqtt_port, mqtt_user,mqtt_pass, flag, stats_queue,
+                  context, worker_state)
     Collects temperature data and initiates data filtering and forwarding.
+log_live_stats(live_stats, interval, flag)
+    Periodically logs live throughput of data handlers.
 main()
     Iot gateway app entrypoint.
 
@@ -66,17 +76,75 @@ http_no_content: int
     Http status code.
 qos: int
     Quality of service of MQTT.
+outbox_conf: str
+    Config key of durable outbox settings.
+resilience_conf: str
+    Config key of circuit breaker and backoff settings.
+max_failed_alerts: int
+    Max number of fuel alerts kept in memory for retry when outbox is disabled.
+retry_buffer_conf: str
+    Config key of memory bounded retry buffer settings.
+flush_conf: str
+    Config key of flush trigger and adaptive interval settings.
+egress_conf: str
+    Config key of egress scheduler settings.
+upstream_conf: str
+    Config key of MQTT upstream bridge settings.
+fanout_conf: str
+    Config key of additional delivery targets.
+http_conf: str
+    Config key of HTTP client settings.
+tls_conf: str
+    Config key of MQTT broker's TLS settings.
+jwt_conf: str
+    Config key of JWT refresh settings.
+supervisor_conf: str
+    Config key of worker supervisor settings.
+stats_conf: str
+    Config key of live stats and periodic stats upload settings.
+live_interval: str
+    Config key of time in seconds between two live stats log entries.
+metrics_conf: str
+    Config key of metrics endpoint settings.
+tracing_conf: str
+    Config key of pipeline latency tracing settings.
+profiler_conf: str
+    Config key of on-demand profiler settings.
+watchdog_conf: str
+    Config key of stall and scheduling lag watchdog settings.
 '''
 
+import os
+import sys
 import json
+import queue
 import auth
 import stats_service
 import data_service
+import outbox
+import resilience
+import retry_buffer
+import flush_policy
+import egress
+import mqtt_bridge
+import fanout
+import http_egress
+import tls
+import token_manager
+import startup
+import supervisor
+import traffic
+import metrics
+import tracing
+import profiler
+import sequencing
+import watchdog
 import time
 import logging.config
 import paho.mqtt.client as mqtt
-from multiprocessing import Process, Queue, Event
-from threading import Thread
+from collections import deque
+from multiprocessing import Queue, Event
+from threading import Thread, Event as ThreadEvent
 
 logging.config.fileConfig('logging.conf')
 infoLogger = logging.getLogger('customInfoLogger')
@@ -105,6 +173,24 @@ http_unauthorized = 401
 http_ok = 200
 http_no_content = 204
 qos=2
+outbox_conf = "outbox"
+resilience_conf = "resilience"
+max_failed_alerts = 100
+retry_buffer_conf = "retry_buffer"
+flush_conf = "flush"
+egress_conf = "egress"
+upstream_conf = "upstream_mqtt"
+fanout_conf = "fanout"
+http_conf = "http"
+tls_conf = "tls"
+jwt_conf = "jwt"
+supervisor_conf = "supervisor"
+stats_conf = "stats"
+live_interval = "live_interval"
+metrics_conf = "metrics"
+tracing_conf = "tracing"
+profiler_conf = "profiler"
+watchdog_conf = "watchdog"
 
 def read_conf():
     '''
@@ -115,15 +201,22 @@ def read_conf():
     Returns
     -------
     conf: dict
-        Configuration data parsed from json config file.
+        Configuration data parsed from json config file, None if file can not be read or config is invalid.
     '''
     try:
         conf_file = open(conf_path)
         conf = json.load(conf_file)
-        return conf
     except:
         errorLogger.critical("Cant read app configuration file - ", conf_path, " !")
         return None
+    # supervisor must not take worker that waits for slow cloud service for hung one
+    egress_config = conf.get(egress_conf)
+    if not supervisor.check_config(conf.get(supervisor_conf), (conf.get(http_conf) or {}).get(http_egress.timeout),
+                                   egress_config.get(egress.reply_timeout, egress.default_reply_timeout)
+                                   if egress_config is not None and egress_config.get(egress.enabled, False)
+                                   else None):
+        return None
+    return conf
 
 # def signup_periodically(key, username, password, time_pattern, url, interval):
 #     '''
@@ -175,8 +268,15 @@ def shutdown_controller(temp_handler_flag,load_handler_flag, fuel_handler_flag):
     Returns
     -------
     '''
-    # waiting for shutdown signal
-    input("")
+    # waiting for shutdown signal, stdin is read past its buffer, because buffer lock held by blocked input() would be
+    # inherited locked by handler processes forked meanwhile, which close stdin on start
+    while True:
+        line = os.read(sys.stdin.fileno(), 1024)
+        if not line:
+            # stdin is closed, so gateway is not stopped by user
+            return
+        if b"\n" in line:
+            break
     infoLogger.info("IoT Gateway app shutting down! Please wait")
     customLogger.debug("IoT Gateway app shutting down! Please wait")
     # shutting down handler processes
@@ -247,8 +347,306 @@ def on_connect_fuel_handler(client, userdata, flags, rc,props):
         errorLogger.error("Fuel data handler failed to establish connection with MQTT broker!")
         customLogger.critical("Fuel data handler failed to establish connection with MQTT broker!")
 
+
+
+class HandlerContext:
+    '''
+    Subsystem configs and shared handles of data handlers.
+
+    Context is created once by main process and passed to every data handler as process argument.
+
+    Attributes
+    ---------
+    outbox_config: dict
+        Durable outbox config. If None, undelivered data is kept in memory.
+    resilience_config: dict
+        Circuit breaker and backoff config. If None, defaults are used.
+    retry_buffer_config: dict
+        Memory bounded retry buffer config. If None, defaults are used.
+    flush_config: dict
+        Flush trigger config. If None, data is flushed every interval.
+    fanout_config: dict
+        Additional delivery targets config. Requires outbox. If None, data is sent to cloud services only.
+    http_config: dict
+        HTTP client config. If None, HTTP/1.1 is used.
+    broker_tls_config: dict
+        TLS config of MQTT broker connection. If None, TLS is not used.
+    tracing_config: dict
+        Pipeline latency tracing config. If None, latency is not traced.
+    profiler_config: dict
+        On-demand profiler config. If None, handlers can not be profiled.
+    watchdog_config: dict
+        Stall and scheduling lag watchdog config. If None, handlers' loops are not watched.
+    upstream_config: dict
+        MQTT upstream bridge config. If None, data is sent over HTTP.
+    egress_clients: dict
+        Egress scheduler clients by stream. Streams without client send requests directly.
+    jwt_manager: token_manager.TokenManager
+        Source of refreshed JWT. If None, jwt is used until it expires and handlers stop when it expires.
+    startup_timer: startup.StartupTimer
+        Startup phase timer. If None, startup is not timed.
+    stats_counters: dict
+        Live stats counters by stream. Streams without counters have stats only after handler stops.
+    stream_metrics: dict
+        Hot path metrics served by metrics endpoint by stream. Metrics of streams missing here are not collected.
+    '''
+    def __init__(self, config=None, upstream_config=None, egress_clients=None, jwt_manager=None, startup_timer=None,
+                 stats_counters=None, stream_metrics=None):
+        '''
+        Initializes HandlerContext object.
+
+        Parameters
+        ----------
+        config: dict
+            App config, subsystem configs are taken from it. If None, optional subsystems are disabled.
+        upstream_config: dict
+            MQTT upstream bridge config with stream URLs resolved.
+        egress_clients: dict
+            Egress scheduler clients by stream.
+        jwt_manager: token_manager.TokenManager
+            Source of refreshed JWT.
+        startup_timer: startup.StartupTimer
+            Startup phase timer.
+        stats_counters: dict
+            Live stats counters by stream.
+        stream_metrics: dict
+            Hot path metrics by stream.
+        '''
+        if config is None:
+            config = {}
+        self.outbox_config = config.get(outbox_conf)
+        self.resilience_config = config.get(resilience_conf)
+        self.retry_buffer_config = config.get(retry_buffer_conf)
+        self.flush_config = config.get(flush_conf)
+        self.fanout_config = config.get(fanout_conf)
+        self.http_config = config.get(http_conf)
+        self.broker_tls_config = config.get(mqtt_broker, {}).get(tls_conf)
+        self.tracing_config = config.get(tracing_conf)
+        self.profiler_config = config.get(profiler_conf)
+        self.watchdog_config = config.get(watchdog_conf)
+        self.upstream_config = upstream_config
+        self.egress_clients = {} if egress_clients is None else egress_clients
+        self.jwt_manager = jwt_manager
+        self.startup_timer = startup_timer
+        self.stats_counters = {} if stats_counters is None else stats_counters
+        self.stream_metrics = {} if stream_metrics is None else stream_metrics
+
+
 # iot data aggregation and forwarding to cloud
-def collect_temperature_data(interval, url, jwt, time_pattern, mqtt_address, mqtt_port, mqtt_user,mqtt_pass, flag, stats_queue):
+# data handler logic shared by temperature and load data handlers, which differ only in stream and summaries
+def _collect_data(stream, label, client_name, on_connect, summarize, handle, interval, url, jwt, time_pattern,
+                  mqtt_address, mqtt_port, mqtt_user, mqtt_pass, flag, stats_queue, context, worker_state):
+    if context is None:
+        context = HandlerContext()
+    new_data = []
+    # data that is not delivered due to connection problem, summarized when memory limit is exceeded
+    old_data = retry_buffer.create_retry_buffer(context.retry_buffer_config, time_pattern)
+    # decides when collected data is flushed to cloud services
+    policy = flush_policy.create_flush_policy(context.flush_config, interval)
+    prewarm_time = context.http_config.get(http_egress.prewarm_time) if context.http_config is not None else None
+    prewarmed = False
+    # called when there is new message in stream's topic
+    def on_message_handler(client, userdata, message):
+        '''
+         Handles received mqtt message.
+
+         After receiving mqtt message, locally stores sensor data.
+
+         Parameters
+         ----------
+         client: mqtt.client
+         userdata: object
+         message: object
+
+         Returns
+         -------
+        '''
+        # MQTT network thread is watched while it handles message, it waits for traffic otherwise
+        with watchdog.busy(watchdog.network_loop):
+            if not flag.is_set():
+                reading = str(message.payload.decode("utf-8"))
+                new_data.append(reading)
+                policy.add(len(message.payload))
+                metrics.ingest(len(message.payload))
+                tracing.received(message.timestamp)
+                # lost, repeated and reordered readings are counted by sensor sequence numbers
+                sequencing.received(reading)
+                stats.update_received(len(message.payload))
+                customLogger.info("Received " + label + " data: " + str(message.payload.decode("utf-8")))
+                if context.startup_timer is not None:
+                    context.startup_timer.mark(stream + "_first_reading")
+    # initializing stats object
+    stats = stats_service.Stats(context.stats_counters.get(stream))
+    # buffers of crashed handler are taken over, and own buffers are handed over if this handler crashes
+    if worker_state is not None:
+        handoff = worker_state.take_handoff()
+        if handoff is not None:
+            stats = handoff["stats"]
+            stats.counters = context.stats_counters.get(stream)
+            new_data.extend(handoff["new_data"])
+            old_data.restore(*handoff["retry"])
+        worker_state.register(lambda: {"stats": stats, "new_data": new_data[:], "retry": old_data.drain()})
+    resilience.configure(context.resilience_config)
+    metrics.configure(context.stream_metrics.get(stream))
+    tracing.configure(context.tracing_config, stream)
+    profiler.configure(context.profiler_config, stream)
+    watchdog.configure(context.watchdog_config, stream)
+    data_service.configure_egress(context.egress_clients.get(stream))
+    http_egress.configure(context.http_config)
+    data_service.configure_upstream(context.upstream_config, client_name + "-upstream-bridge-mqtt-client")
+    # opening durable outbox for data that is not delivered yet
+    data_outbox = outbox.open_outbox(context.outbox_config, stream, fanout.consumers(context.fanout_config, stream))
+    # additional targets receive the same payloads from outbox, each at its own pace
+    data_fanout = fanout.create_fanout(context.fanout_config, data_outbox, stream)
+    replay_limit = (context.outbox_config.get(outbox.replay_batch, outbox.default_replay_batch)
+                    if context.outbox_config else None)
+    # initializing mqtt client for collecting sensor data from broker
+    client = mqtt.Client(client_id=client_name + "-data-handler-mqtt-client", transport=transport_protocol,
+                         protocol=mqtt.MQTTv5)
+    client.username_pw_set(username=mqtt_user, password=mqtt_pass)
+    # reconnects resume cached TLS session instead of full handshake
+    tls.configure_mqtt(client, context.broker_tls_config)
+    client.on_connect = on_connect
+    client.on_message = on_message_handler
+    # broker connection is retried in background, so data handler meanwhile opens connection to cloud services
+    infoLogger.info(label.capitalize() + " data handler establishing connection with MQTT broker!")
+    startup.connect_mqtt(client, mqtt_address, mqtt_port, abs(round(interval)) * 3, context.startup_timer,
+                         stream + "_mqtt_connected")
+    data_service.prewarm(url)
+    if context.startup_timer is not None:
+        context.startup_timer.mark(stream + "_http_prewarmed")
+    # set while collected data waits for first JWT
+    buffering = False
+    # processes collected data and forwards result to cloud services when any flush trigger fires
+    while not flag.is_set():
+        if worker_state is not None:
+            worker_state.beat()
+        tick = policy.tick()
+        # loop is stalled when it does not finish wait and flush in time, e.g. blocked in request to cloud
+        watchdog.progress(watchdog.handler_loop, tick)
+        if buffering:
+            # buffered data is flushed as soon as first JWT is published
+            context.jwt_manager.wait(tick)
+        else:
+            flag.wait(tick)
+        # depth is sampled every tick, so growing backlog is visible before it is summarized or dropped
+        metrics.buffer_depth(len(new_data))
+        # connection to cloud is opened shortly before deadline flush, so flush does not wait for handshakes
+        if prewarm_time is not None and not prewarmed and policy.time_to_deadline() <= prewarm_time:
+            data_service.prewarm(url)
+            prewarmed = True
+        # refreshed JWT is picked up without restarting handler
+        if context.jwt_manager is not None:
+            jwt = context.jwt_manager.get()
+            # until first JWT is published, collected data is kept buffered
+            if jwt == "":
+                buffering = True
+                # flush triggers move waiting data to outbox or retry buffer, so it is bounded the same way as data
+                # that is not delivered
+                if policy.due() is not None and len(new_data) > 0:
+                    tracing.flushed()
+                    data = new_data[:]
+                    del new_data[:len(data)]
+                    sequencing.flushed(data)
+                    policy.flushed()
+                    if data_outbox is not None:
+                        data_outbox.append(summarize(data, time_pattern))
+                        if data_fanout is not None:
+                            data_fanout.notify()
+                        metrics.buffer_depth(len(new_data), data_outbox.size())
+                    else:
+                        old_data.extend(data)
+                        stats.update_buffer(old_data.metrics())
+                continue
+        trigger = policy.due()
+        # data buffered during startup is flushed as soon as JWT is ready
+        if trigger is None and buffering and (len(new_data) > 0 or len(old_data) > 0 or
+                                              (data_outbox is not None and data_outbox.size() > 0)):
+            trigger = "jwt ready"
+        buffering = False
+        if flag.is_set() or trigger is None:
+            continue
+        customLogger.debug("Flushing " + label + " data, trigger: " + trigger)
+        # sampled readings stop waiting in buffer when flush takes them
+        tracing.flushed()
+        # copy data from list that is populated with newly arrived data and remove copied data from that list
+        data = new_data[:]
+        del new_data[:len(data)]
+        sequencing.flushed(data)
+        policy.flushed()
+        prewarmed = False
+        flush_start = time.monotonic()
+        # flush is timed stage by stage, sampled flushes are also kept as traces
+        with tracing.trace("flush"):
+            if data_outbox is not None:
+                # collected data is summarized right away and kept on disk until it is delivered
+                if len(data) > 0:
+                    data_outbox.append(summarize(data, time_pattern))
+                    if data_fanout is not None:
+                        data_fanout.notify()
+                code, delivered = data_service.forward_outbox(data_outbox, url, jwt, label, replay_limit)
+                pending = data_outbox.size()
+                metrics.buffer_depth(len(new_data), pending)
+                # data of flushed readings is delivered once outbox is empty
+                if pending == 0:
+                    sequencing.delivered()
+                if delivered > 0 and context.startup_timer is not None:
+                    context.startup_timer.mark(stream + "_first_forward")
+                if code == http_no_content:
+                    infoLogger.warning("There is no " + label + " sensor data to handle!")
+                else:
+                    flush_latency = time.monotonic() - flush_start
+                    policy.record(flush_latency, code == http_ok)
+                    metrics.flushed(flush_latency, code == http_ok)
+            else:
+                # append data that is not sent in previous iterations due to connection problem
+                old_data.extend(data)
+                data, aggregates = old_data.drain()
+                # send request to Cloud only if there is available data
+                if len(data) > 0 or len(aggregates) > 0:
+                    code = handle(data, url, jwt, time_pattern, aggregates)
+                    flush_latency = time.monotonic() - flush_start
+                    policy.record(flush_latency, code == http_ok)
+                    metrics.flushed(flush_latency, code == http_ok)
+                    # if data is not sent to cloud, it is returned to retry buffer
+                    if code != http_ok:
+                        old_data.restore(data, aggregates)
+                    else:
+                        # retry buffer is drained, so data of all flushed readings is delivered
+                        sequencing.delivered()
+                        if context.startup_timer is not None:
+                            context.startup_timer.mark(stream + "_first_forward")
+                    stats.update_buffer(old_data.metrics())
+                else:
+                    code = http_no_content
+                    infoLogger.warning("There is no " + label + " sensor data to handle!")
+        # bytes actually sent by flush, and by fan-out since previous flush
+        stats.update_traffic(traffic.take())
+        tracing.export(False)
+        # jwt has expired
+        if code == http_unauthorized:
+            customLogger.error("JWT has expired!")
+            if context.jwt_manager is None:
+                break
+            # data is kept until refreshed jwt is published
+            context.jwt_manager.request_refresh(jwt)
+    # shutting down data handler
+    stats.update_traffic(traffic.take())
+    tracing.export()
+    stats_queue.put(stats)
+    client.loop_stop()
+    client.disconnect()
+    if data_fanout is not None:
+        data_fanout.stop()
+    if data_outbox is not None:
+        data_outbox.close()
+    data_service.configure_upstream(None, None)
+    http_egress.close()
+    customLogger.debug(label.capitalize() + " data handler shutdown!")
+
+
+def collect_temperature_data(interval, url, jwt, time_pattern, mqtt_address, mqtt_port, mqtt_user,mqtt_pass, flag, stats_queue,
+                             context=None, worker_state=None):
     '''
     Temperature data handler logic.
 
@@ -277,79 +675,21 @@ def collect_temperature_data(interval, url, jwt, time_pattern, mqtt_address, mqt
         Object used for stopping temperature sensor process.
     stats_queue: multiprocessing.Queue
         Stats data wrapper.
+    context: HandlerContext
+        Subsystem configs and shared handles. If None, optional subsystems are disabled.
+    worker_state: supervisor.WorkerState
+        State shared with supervisor. If None, handler is not supervised.
     Returns
     -------
     '''
-    new_data = []
-    old_data = []
-    # called when there is new message in temp_topic topic
-    def on_message_handler(client, userdata, message):
-        '''
-         Handles received mqtt message.
-
-         After receiving mqtt message, locally stores temperature data.
-
-         Parameters
-         ----------
-         client: mqtt.client
-         userdata: object
-         message: object
-
-         Returns
-         -------
-        '''
-        if not flag.is_set():
-            new_data.append(str(message.payload.decode("utf-8")))
-            customLogger.info("Received temperature data: " + str(message.payload.decode("utf-8")))
-    # initializing stats object
-    stats = stats_service.Stats()
-    # initializing mqtt client for collecting sensor data from broker
-    client = mqtt.Client(client_id="temp-data-handler-mqtt-client", transport=transport_protocol,
-                         protocol=mqtt.MQTTv5)
-    client.username_pw_set(username=mqtt_user, password=mqtt_pass)
-    client.on_connect = on_connect_temp_handler
-    client.on_message=on_message_handler
-    while not client.is_connected():
-        try:
-            infoLogger.info("Temperature data handler establishing connection with MQTT broker!")
-            client.connect(mqtt_address, port=mqtt_port,
-                           keepalive=abs(round(interval)) * 3)
-            client.loop_start()
-        except:
-            errorLogger.error("Temperature data handler failed to establish connection with MQTT broker!")
-        time.sleep(0.2)
-    # periodically processes collected data and forwards result to cloud services
-    while not flag.is_set():
-        # copy data from list that is populated with newly arrived data and clear that list
-        data=new_data.copy()
-        new_data.clear()
-        # append data that is not sent in previous iterations due to connection problem
-        for i in old_data:
-            data.append(i)
-        old_data.clear()
-        # send request to Cloud only if there is available data
-        if len(data) > 0:
-            code = data_service.handle_temperature_data(data, url, jwt, time_pattern)
-            # if data is not sent to cloud, it is returned to queue
-            if code != http_ok:
-                old_data = data.copy()
-            else:
-                stats.update_data(len(data) * 4, 4, 1)
-            # jwt has expired
-            if code == http_unauthorized:
-                customLogger.error("JWT has expired!")
-                break
-        else:
-            infoLogger.warning("There is no temperature sensor data to handle!")
-        time.sleep(interval)
-    # shutting down temperature sensor
-    stats_queue.put(stats)
-    client.loop_stop()
-    client.disconnect()
-    customLogger.debug("Temperature data handler shutdown!")
+    _collect_data("temperature", "temperature", "temp", on_connect_temp_handler,
+                  data_service.summarize_temperature_data, data_service.handle_temperature_data, interval, url, jwt,
+                  time_pattern, mqtt_address, mqtt_port, mqtt_user, mqtt_pass, flag, stats_queue, context,
+                  worker_state)
 
 
-def collect_load_data(interval, url, jwt, time_pattern, mqtt_address, mqtt_port, mqtt_user,mqtt_pass,flag, stats_queue):
+def collect_load_data(interval, url, jwt, time_pattern, mqtt_address, mqtt_port, mqtt_user,mqtt_pass,flag, stats_queue,
+                      context=None, worker_state=None):
     '''
     Load data handler logic.
 
@@ -378,80 +718,22 @@ def collect_load_data(interval, url, jwt, time_pattern, mqtt_address, mqtt_port,
        Object used for stopping temperature sensor process.
     stats_queue: multiprocessing.Queue
         Stats data wrapper.
+    context: HandlerContext
+        Subsystem configs and shared handles. If None, optional subsystems are disabled.
+    worker_state: supervisor.WorkerState
+        State shared with supervisor. If None, handler is not supervised.
 
     Returns
     -------
    '''
-    new_data = []
-    old_data = []
-    # called when there is new message in load_topic topic
-    def on_message_handler(client, userdata, message):
-        '''
-         Handles received mqtt message.
+    _collect_data("load", "arm load", "load", on_connect_load_handler, data_service.summarize_load_data,
+                  data_service.handle_load_data, interval, url, jwt,
+                  time_pattern, mqtt_address, mqtt_port, mqtt_user, mqtt_pass, flag, stats_queue, context,
+                  worker_state)
 
-         After receiving mqtt message, locally stores load data.
 
-         Parameters
-         ----------
-         client: mqtt.client
-         userdata: object
-         message: object
-
-         Returns
-         -------
-        '''
-        if not flag.is_set():
-            new_data.append(str(message.payload.decode("utf-8")))
-            customLogger.info("Received load data: "+str(message.payload.decode("utf-8")))
-
-    # initializing stats object
-    stats = stats_service.Stats()
-    # initializing mqtt client for collecting sensor data from broker
-    client = mqtt.Client(client_id="load-data-handler-mqtt-client", transport=transport_protocol,
-                         protocol=mqtt.MQTTv5)
-    client.username_pw_set(username=mqtt_user, password=mqtt_pass)
-    client.on_connect = on_connect_load_handler
-    client.on_message = on_message_handler
-    while not client.is_connected():
-        try:
-            infoLogger.info("Arm load data handler establishing connection with MQTT broker!")
-            client.connect(mqtt_address, port=mqtt_port,
-                           keepalive=abs(round(interval)) * 3)
-            client.loop_start()
-        except:
-            errorLogger.error("Arm load data handler failed to establish connection with MQTT broker!")
-        time.sleep(0.2)
-    # periodically processes collected data and forwards result to cloud services
-    while not flag.is_set():
-        # copy data from list that is populated with newly arrived data and clear that list
-        data = new_data.copy()
-        new_data.clear()
-        # append data that is not sent in previous iterations due to connection problem
-        for i in old_data:
-            data.append(i)
-        old_data.clear()
-        # send request to Cloud only if there is available data
-        if len(data) > 0:
-            code = data_service.handle_load_data(data, url, jwt, time_pattern)
-            # if data is not sent to cloud, it is returned to queue
-            if code != http_ok :
-                old_data = data.copy()
-            else:
-                stats.update_data(len(data) * 4, 4, 1)
-            # jwt has expired
-            if code == http_unauthorized:
-                customLogger.error("JWT has expired!")
-                break
-        else:
-            infoLogger.warning("There is no arm load sensor data to handle!")
-        time.sleep(interval)
-    # shutting down load sensor
-    stats_queue.put(stats)
-    client.loop_stop()
-    client.disconnect()
-    customLogger.debug("Arm load data handler shutdown!")
-
-def collect_fuel_data(limit, url, jwt, time_pattern, mqtt_address, mqtt_port, mqtt_user,mqtt_pass, flag, stats_queue):
+def collect_fuel_data(limit, url, jwt, time_pattern, mqtt_address, mqtt_port, mqtt_user,mqtt_pass, flag, stats_queue,
+                      context=None, worker_state=None):
     '''
     Fuel data handler logic.
 
@@ -480,12 +762,42 @@ def collect_fuel_data(limit, url, jwt, time_pattern, mqtt_address, mqtt_port, mq
       Object used for stopping temperature sensor process.
     stats_queue: multiprocessing.Queue
        Stats data wrapper.
+    context: HandlerContext
+       Subsystem configs and shared handles. If None, optional subsystems are disabled.
+    worker_state: supervisor.WorkerState
+       State shared with supervisor. If None, handler is not supervised.
 
     Returns
     -------
     '''
+    if context is None:
+        context = HandlerContext()
     # initializing stats object
-    stats = stats_service.Stats()
+    stats = stats_service.Stats(context.stats_counters.get("fuel"))
+    resilience.configure(context.resilience_config)
+    metrics.configure(context.stream_metrics.get("fuel"))
+    tracing.configure(context.tracing_config, "fuel")
+    profiler.configure(context.profiler_config, "fuel")
+    watchdog.configure(context.watchdog_config, "fuel")
+    data_service.configure_egress(context.egress_clients.get("fuel"))
+    http_egress.configure(context.http_config)
+    data_service.configure_upstream(context.upstream_config, "fuel-upstream-bridge-mqtt-client")
+    # opening durable outbox for alerts that are not delivered yet
+    data_outbox = outbox.open_outbox(context.outbox_config, "fuel", fanout.consumers(context.fanout_config, "fuel"))
+    # additional targets receive the same payloads from outbox, each at its own pace
+    data_fanout = fanout.create_fanout(context.fanout_config, data_outbox, "fuel")
+    replay_limit = (context.outbox_config.get(outbox.replay_batch, outbox.default_replay_batch)
+                    if context.outbox_config else None)
+    # alerts that failed to be delivered, used when outbox is disabled
+    failed_alerts = deque(maxlen=max_failed_alerts)
+    # alerts of crashed handler are taken over, and own alerts are handed over if this handler crashes
+    if worker_state is not None:
+        handoff = worker_state.take_handoff()
+        if handoff is not None:
+            stats = handoff["stats"]
+            stats.counters = context.stats_counters.get("fuel")
+            failed_alerts.extend(handoff["failed_alerts"])
+        worker_state.register(lambda: {"stats": stats, "failed_alerts": list(failed_alerts)})
     # called when there is new message in load_topic topic
     def on_message_handler(client, userdata, message):
         '''
@@ -504,39 +816,159 @@ def collect_fuel_data(limit, url, jwt, time_pattern, mqtt_address, mqtt_port, mq
         '''
         # making sure that flag is not set in meantime
         if not flag.is_set():
-            customLogger.info("Received fuel data: "+str(message.payload.decode("utf-8")))
-            code= data_service.handle_fuel_data(str(message.payload.decode("utf-8")), limit, url, jwt, time_pattern)
-            if code == http_ok:
-                stats.update_data(4, 4, 1)
-            elif code == http_no_content:
-                stats.update_data(4, 0, 0)
-            # jwt has expired - handler will be stopped, and started again after app restart
-            elif code == http_unauthorized:
-                customLogger.error("JWT has expired!")
-                flag.set()
+            reading = str(message.payload.decode("utf-8"))
+            customLogger.info("Received fuel data: " + reading)
+            metrics.ingest(len(message.payload))
+            tracing.received(message.timestamp)
+            sequencing.received(reading)
+            stats.update_received(len(message.payload))
+            if context.startup_timer is not None:
+                context.startup_timer.mark("fuel_first_reading")
+            # alert is timed stage by stage, sampled alerts are also kept as traces, and MQTT network thread is
+            # watched while it forwards alert, so request that blocks ingest is logged with its stack
+            with tracing.trace("alert"), watchdog.busy(watchdog.network_loop):
+                # refreshed JWT is picked up without restarting handler
+                token = jwt if context.jwt_manager is None else context.jwt_manager.get()
+                if data_outbox is not None:
+                    # alert is stored before sending, so it survives failed request and gateway restart
+                    payload = data_service.filter_fuel_data(reading, limit, time_pattern)
+                    if payload is not None:
+                        # alert is synced to disk right away, it is not batched with other payloads
+                        data_outbox.append(payload, sync=True)
+                        sequencing.flushed([reading])
+                        if data_fanout is not None:
+                            data_fanout.notify()
+                    # until first JWT is published, alerts are kept in outbox
+                    if token == "":
+                        return
+                    # alerts left from previous failures are replayed as well
+                    code, delivered = data_service.forward_outbox(data_outbox, url, token, "fuel", replay_limit)
+                    pending = data_outbox.size()
+                    metrics.buffer_depth(0, pending)
+                    # alerts are delivered once outbox is empty
+                    if pending == 0:
+                        sequencing.delivered()
+                    stats.update_traffic(traffic.take())
+                    if delivered > 0 and context.startup_timer is not None:
+                        context.startup_timer.mark("fuel_first_forward")
+                    if code == http_unauthorized:
+                        customLogger.error("JWT has expired!")
+                        if context.jwt_manager is None:
+                            flag.set()
+                        else:
+                            context.jwt_manager.request_refresh(token)
+                    return
+                payload = data_service.filter_fuel_data(reading, limit, time_pattern)
+                if payload is None:
+                    return
+                sequencing.flushed([reading])
+                # until first JWT is published, alerts wait with alerts that failed to be delivered
+                if token == "":
+                    failed_alerts.append(payload)
+                    return
+                code = data_service.forward_data(payload, url, token, "fuel")
+                stats.update_traffic(traffic.take())
+                if code == http_ok:
+                    if len(failed_alerts) == 0:
+                        sequencing.delivered()
+                    if context.startup_timer is not None:
+                        context.startup_timer.mark("fuel_first_forward")
+                # jwt has expired - handler will be stopped, and started again after app restart
+                elif code == http_unauthorized and context.jwt_manager is None:
+                    customLogger.error("JWT has expired!")
+                    flag.set()
+                else:
+                    if code == http_unauthorized:
+                        customLogger.error("JWT has expired!")
+                        context.jwt_manager.request_refresh(token)
+                    # alert is kept and retried once fuel Cloud service is available again or jwt is refreshed
+                    failed_alerts.append(payload)
     # initializing mqtt client for collecting sensor data from broker
     client = mqtt.Client(client_id="fuel-data-handler-mqtt-client", transport=transport_protocol,
                          protocol=mqtt.MQTTv5)
     client.username_pw_set(username=mqtt_user, password=mqtt_pass)
+    # reconnects resume cached TLS session instead of full handshake
+    tls.configure_mqtt(client, context.broker_tls_config)
     client.on_connect = on_connect_fuel_handler
     client.on_message = on_message_handler
-    while not client.is_connected():
-        try:
-            infoLogger.info("Fuel level data handler establishing connection with MQTT broker!")
-            client.connect(mqtt_address, port=mqtt_port, keepalive=abs(8 * 60 * 60))
-            client.loop_start()
-        except :
-            errorLogger.error("Fuel level data handler failed to establish connection with MQTT broker!")
-        time.sleep(0.2)
+    # broker connection is retried in background, so data handler meanwhile opens connection to cloud services
+    infoLogger.info("Fuel level data handler establishing connection with MQTT broker!")
+    startup.connect_mqtt(client, mqtt_address, mqtt_port, abs(8 * 60 * 60), context.startup_timer,
+                         "fuel_mqtt_connected")
+    data_service.prewarm(url)
+    if context.startup_timer is not None:
+        context.startup_timer.mark("fuel_http_prewarmed")
     # must do like this to be able to stop thread acquired for incoming messages(on_message) after flag is set
     while not flag.is_set():
+        if worker_state is not None:
+            worker_state.beat()
+        watchdog.progress(watchdog.handler_loop, 2)
         time.sleep(2)
+        # retrying alerts that failed to be delivered, oldest first
+        token = jwt if context.jwt_manager is None else context.jwt_manager.get()
+        while len(failed_alerts) > 0 and not flag.is_set() and token != "":
+            supervisor.heartbeat()
+            code = data_service.forward_data(failed_alerts[0], url, token, "fuel")
+            if code != http_ok:
+                break
+            failed_alerts.popleft()
+            if len(failed_alerts) == 0:
+                sequencing.delivered()
+            if context.startup_timer is not None:
+                context.startup_timer.mark("fuel_first_forward")
+        metrics.buffer_depth(len(failed_alerts))
+        # bytes sent by retries, and by fan-out since previous check
+        stats.update_traffic(traffic.take())
+        tracing.export(False)
     # shutting down temperature sensor
+    stats.update_traffic(traffic.take())
+    tracing.export()
     stats_queue.put(stats)
     client.loop_stop()
     client.disconnect()
+    if data_fanout is not None:
+        data_fanout.stop()
+    if data_outbox is not None:
+        data_outbox.close()
+    data_service.configure_upstream(None, None)
+    http_egress.close()
     customLogger.debug("Fuel level data handler shutdown!")
 
+
+# stats sent by data handler on shutdown, or stats it published to shared memory if it was killed before sending them
+def _handler_stats(stats_queue, counters):
+    try:
+        return stats_queue.get(timeout=supervisor.terminate_timeout)
+    except queue.Empty:
+        errorLogger.error("Data handler did not send its stats! Using its last published stats.")
+        return stats_service.Stats(counters)
+
+
+def log_live_stats(live_stats, interval, flag):
+    '''
+    Periodically logs live throughput of data handlers.
+
+    Parameters
+    ----------
+    live_stats: stats_service.LiveStats
+        Live stats counters of data handlers.
+    interval: float
+        Time between two log entries [s].
+    flag: threading.Event
+        Token used for stopping logging.
+
+    Returns
+    -------
+    '''
+    live_stats.rates()
+    while not flag.wait(interval):
+        for stream, rates in live_stats.rates().items():
+            infoLogger.info("Live " + stream + " stats: {:.1f} B/s collected, {:.1f} B/s forwarded, "
+                                               "{:.2f} requests/s".format(rates["dataBytes"],
+                                                                          rates["dataBytesForwarded"],
+                                                                          rates["dataRequests"]))
+
+
 def main():
     '''
     IoT gateway app entrypoint.
@@ -550,24 +982,50 @@ def main():
     # used for restarting device due to jwt expiration
     reset = True
     while reset:
+        # phases of every startup are timed, time to first forward matters after power cycle
+        startup_timer = startup.StartupTimer(["config", "jwt_ready"] +
+                                             [stream + phase for stream in ("temperature", "load", "fuel")
+                                              for phase in ("_mqtt_connected", "_http_prewarmed", "_first_reading")] +
+                                             ["temperature_first_forward", "load_first_forward"])
+        startup_timer.start()
         # read app config
         config = read_conf()
         # if config is read successfully, start app logic
         if config is not None:
             infoLogger.info("IoT Gateway app started!")
             customLogger.debug("IoT Gateway app started!")
-            # iot cloud platform login
-            jwt = auth.login(config[user], config[password], config[server_url] + "/auth/login")
-            # if failed, periodically request signup
-            if jwt is None:
-                customLogger.error("Login failed! Trying to sign up periodically!")
-                jwt = signup_periodically(config[api_key], config[user], config[password],
-                                          config[server_time_format], config[server_url] + "/auth/signup",
-                                          config[auth_interval])
+            startup_timer.mark("config")
+            # backoff of main process, e.g. of stats sending, follows the same resilience config as handlers
+            resilience.configure(config.get(resilience_conf))
+            # jwt is refreshed before it expires and handlers pick up new jwt, so they are not restarted
+            jwt_config = config.get(jwt_conf)
+            if jwt_config is None and config.get(supervisor_conf) is not None:
+                # supervised handlers are restarted one by one, so they can not rely on app restart for new jwt
+                jwt_config = {}
+            # auth requests use the same timeout as requests to cloud services
+            auth_timeout = (config.get(http_conf) or {}).get(http_egress.timeout) or token_manager.default_login_timeout
+            jwt_manager = token_manager.create_token_manager(jwt_config, None, config[user], config[password],
+                                                             config[server_url] + "/auth/login", auth_timeout)
+            if jwt_manager is None:
+                # iot cloud platform login
+                jwt = auth.login(config[user], config[password], config[server_url] + "/auth/login", auth_timeout)
+                # if failed, periodically request signup
+                if jwt is None:
+                    customLogger.error("Login failed! Trying to sign up periodically!")
+                    jwt = signup_periodically(config[api_key], config[user], config[password],
+                                              config[server_time_format], config[server_url] + "/auth/signup",
+                                              config[auth_interval])
+                else:
+                    customLogger.debug("Login successful!")
+                # now JWT required for Cloud platform auth is stored in jwt var
+                customLogger.info("Received JWT: " +jwt)
+                startup_timer.mark("jwt_ready")
             else:
-                customLogger.debug("Login successful!")
-            # now JWT required for Cloud platform auth is stored in jwt var
-            customLogger.info("Received JWT: " +jwt)
+                # cached jwt is used right away, otherwise handlers start without jwt and buffer data until
+                # refreshing thread logs in
+                jwt_manager.start()
+                jwt = jwt_manager.get()
+                startup_timer.mark_when(jwt_manager.wait, "jwt_ready")
             # starting stats collecting
             # using shared memory Queue objects for returning stats data from processes
             customLogger.debug("Initializing devices stats data!")
@@ -575,6 +1033,27 @@ def main():
             temp_stats_queue = Queue()
             load_stats_queue = Queue()
             fuel_stats_queue = Queue()
+            # handlers publish stats to shared memory as they change, so they can be read while handlers run
+            stats_counters = {"temperature": stats_service.SharedCounters(),
+                              "load": stats_service.SharedCounters(),
+                              "fuel": stats_service.SharedCounters()}
+            # handlers write hot path metrics to shared memory, metrics endpoint reads them when scraped
+            stream_metrics = {"temperature": metrics.StreamMetrics(),
+                              "load": metrics.StreamMetrics(),
+                              "fuel": metrics.StreamMetrics()}
+            # stats are uploaded periodically as per stream deltas, so crash or power loss does not lose them
+            stats_uploader = stats_service.create_stats_uploader(config.get(stats_conf),
+                                                                 config[server_url] + "/stats/streams",
+                                                                 stats_counters,
+                                                                 (lambda: jwt) if jwt_manager is None
+                                                                 else jwt_manager.get, config[time_format])
+            if stats_uploader is not None:
+                stats_uploader.start()
+            live_stats_flag = ThreadEvent()
+            if config.get(stats_conf) is not None and config[stats_conf].get(live_interval) is not None:
+                Thread(target=log_live_stats, args=(stats_service.LiveStats(stats_counters),
+                                                    config[stats_conf][live_interval], live_stats_flag),
+                       daemon=True).start()
             # flags are used for stopping data handlers on app shutdown
             temp_handler_flag = Event()
             load_handler_flag = Event()
@@ -583,49 +1062,99 @@ def main():
             shutdown_controller_worker = Thread(target=shutdown_controller,
                                                 args=(temp_handler_flag, load_handler_flag, fuel_handler_flag))
             shutdown_controller_worker.start()
+            stream_urls = {"temperature": config[server_url] + "/data/temp",
+                           "load": config[server_url] + "/data/load",
+                           "fuel": config[server_url] + "/data/fuel"}
+            # streams listed in upstream bridge config are published to cloud MQTT broker instead of being posted
+            upstream_config = mqtt_bridge.upstream_config(config.get(upstream_conf), stream_urls, config[user])
+            # central egress scheduler, if enabled, sends requests of all handlers by priority
+            scheduler, scheduler_flag, egress_clients = egress.create_scheduler(config.get(egress_conf),
+                                                                                {"temperature": egress.normal,
+                                                                                 "load": egress.normal,
+                                                                                 "fuel": egress.critical},
+                                                                                config.get(resilience_conf),
+                                                                                upstream_config,
+                                                                                config[server_url] + "/data/snapshot",
+                                                                                config.get(http_conf))
+            if scheduler is not None:
+                scheduler.start()
             customLogger.debug("Starting workers!")
-            # creates and starts data handling workers
-            temperature_data_handler = Process(target=collect_temperature_data, args=(config[temp_interval],
-                                                                                      config[server_url] + "/data/temp",
-                                                                                      jwt, config[time_format],
-                                                                                      config[mqtt_broker][address],
-                                                                                      config[mqtt_broker][port],
-                                                                                      config[mqtt_broker][user],
-                                                                                      config[mqtt_broker][password],
-                                                                                      temp_handler_flag,
-                                                                                      temp_stats_queue))
-            temperature_data_handler.start()
-            load_data_handler = Process(target=collect_load_data, args=(config[load_interval],
-                                                                        config[server_url] + "/data/load", jwt,
-                                                                        config[time_format],
-                                                                        config[mqtt_broker][address],
-                                                                        config[mqtt_broker][port],
-                                                                        config[mqtt_broker][user],
-                                                                        config[mqtt_broker][password],
-                                                                        load_handler_flag, load_stats_queue))
-            load_data_handler.start()
-            fuel_data_handler = Process(target=collect_fuel_data, args=(config[fuel_level_limit],
-                                                                        config[server_url] + "/data/fuel", jwt,
-                                                                        config[time_format],
-                                                                        config[mqtt_broker][address],
-                                                                        config[mqtt_broker][port],
-                                                                        config[mqtt_broker][user],
-                                                                        config[mqtt_broker][password],
-                                                                        fuel_handler_flag, fuel_stats_queue,))
-            fuel_data_handler.start()
-            # waiting fow workers to stop
-            temperature_data_handler.join()
-            load_data_handler.join()
-            fuel_data_handler.join()
+            # creates data handling workers
+            # subsystem configs and shared handles are the same for every data handler
+            handler_context = HandlerContext(config, upstream_config, egress_clients, jwt_manager, startup_timer,
+                                             stats_counters, stream_metrics)
+            temperature_data_handler = supervisor.Worker("temperature", collect_temperature_data,
+                                                         (config[temp_interval], stream_urls["temperature"], jwt,
+                                                          config[time_format], config[mqtt_broker][address],
+                                                          config[mqtt_broker][port], config[mqtt_broker][user],
+                                                          config[mqtt_broker][password], temp_handler_flag,
+                                                          temp_stats_queue, handler_context),
+                                                         temp_handler_flag)
+            load_data_handler = supervisor.Worker("load", collect_load_data,
+                                                  (config[load_interval], stream_urls["load"], jwt,
+                                                   config[time_format], config[mqtt_broker][address],
+                                                   config[mqtt_broker][port], config[mqtt_broker][user],
+                                                   config[mqtt_broker][password], load_handler_flag,
+                                                   load_stats_queue, handler_context),
+                                                  load_handler_flag)
+            fuel_data_handler = supervisor.Worker("fuel", collect_fuel_data,
+                                                  (config[fuel_level_limit], stream_urls["fuel"], jwt,
+                                                   config[time_format], config[mqtt_broker][address],
+                                                   config[mqtt_broker][port], config[mqtt_broker][user],
+                                                   config[mqtt_broker][password], fuel_handler_flag,
+                                                   fuel_stats_queue, handler_context),
+                                                  fuel_handler_flag)
+            workers = [temperature_data_handler, load_data_handler, fuel_data_handler]
+            # SIGUSR1 and admin requests profile main process and data handlers that are running
+            profiler.configure(config.get(profiler_conf), "main",
+                               lambda: [worker.process.pid for worker in workers
+                                        if worker.process is not None and worker.process.is_alive()])
+            # supervisor loop of main process is watched as well, its stalls are only logged
+            watchdog.configure(config.get(watchdog_conf), "main")
+            metrics_server = metrics.create_metrics_server(config.get(metrics_conf), stream_metrics, stats_counters,
+                                                           workers, {} if scheduler is None else {"egress": scheduler})
+            # starts workers and waits for them to stop, supervisor restarts only worker that failed
+            supervisor.run_workers(config.get(supervisor_conf), workers)
+            # read before shared counters are closed, handler killed during shutdown does not send its stats
+            handler_stats = [_handler_stats(temp_stats_queue, stats_counters["temperature"]),
+                             _handler_stats(load_stats_queue, stats_counters["load"]),
+                             _handler_stats(fuel_stats_queue, stats_counters["fuel"])]
+            if scheduler is not None:
+                scheduler_flag.set()
+                scheduler.join()
             customLogger.debug("Workers stopped!")
+            # latency of every pipeline stage, merged over all handler processes
+            tracing.summarize(config.get(tracing_conf))
+            startup_timer.stop()
+            live_stats_flag.set()
+            if metrics_server is not None:
+                metrics_server.stop()
+            if stats_uploader is not None:
+                stats_uploader.stop()
+            for counters in list(stats_counters.values()) + list(stream_metrics.values()):
+                counters.close()
+                counters.unlink()
+            if jwt_manager is not None:
+                jwt_manager.stop()
+                jwt = jwt_manager.get()
+                stats.jwt = jwt
 
             # finalizing stats
-            stats.combine_stats(temp_stats_queue.get(), load_stats_queue.get(), fuel_stats_queue.get() )
-            customLogger.debug("Sending device stats data!")
-            stats.send_stats()
-            # checking jwt, if jwt has expired  app will restart
-            jwt_code= auth.check_jwt(jwt, config[server_url] + "/auth/jwt-check")
-            if jwt_code == http_ok:
+            stats.combine_stats(*handler_stats)
+            # with periodic upload, final stats were already uploaded by uploader
+            if stats_uploader is None:
+                customLogger.debug("Sending device stats data!")
+                stats.send_stats()
+            # with jwt manager, handlers refresh expired jwt and stop only on shutdown request, so app is not restarted
+            if jwt_manager is not None:
+                jwt_valid = True
+            else:
+                # checking jwt, if jwt has expired  app will restart
+                jwt_valid = auth.is_jwt_valid(jwt)
+                if jwt_valid is None:
+                    # validity can not be decided from jwt claims, so cloud platform is asked
+                    jwt_valid = auth.check_jwt(jwt, config[server_url] + "/auth/jwt-check", auth_timeout) == http_ok
+            if jwt_valid:
                 reset = False
                 infoLogger.info("IoT Gateway app shutdown!")
                 customLogger.debug("IoT Gateway app shutdown!")
@@ -634,6 +1163,7 @@ def main():
                 infoLogger.info("IoT Gateway app restart!")
                 customLogger.debug("IoT Gateway app restart!")
         else:
+            startup_timer.stop()
             customLogger.critical("Cant read config file! Aborting...")
 
 
@@ -5,18 +5,29 @@ Module that provides functions for iot-gateway authentication on cloud
 
 Functions
 ---------
-login(username,password,url)
+login(username,password,url,timeout)
     User login with provided credentials.
 
-check_jwt(jwt,url)
+check_jwt(jwt,url,timeout)
     Checks  validity of current jwt.
 
 register(key, username, password, time_format, url)
     Registers new iot-gateway device.
+
+decode_claims(jwt)
+    Decodes claims of jwt locally.
+
+expires_at(jwt)
+    Returns expiration time of jwt.
+
+is_jwt_valid(jwt, leeway)
+    Checks validity of jwt locally.
 '''
 
 import requests
 import base64
+import json
+import time
 import logging.config
 
 logging.config.fileConfig('logging.conf')
@@ -26,7 +37,7 @@ customLogger=logging.getLogger('customConsoleLogger')
 http_not_found = 404
 http_ok = 200
 
-def login(username,password,url):
+def login(username,password,url,timeout=None):
     '''
     Sign in iot-gateway to its account on cloud platform.
 
@@ -38,6 +49,8 @@ def login(username,password,url):
     password : str
     url: str
          Cloud auth services url.
+    timeout: float
+         Request timeout [s], None to wait for response without limit.
 
     Returns
     -------
@@ -48,7 +61,7 @@ def login(username,password,url):
     # creating base64 encoded username:password token for basic auth
     basic_auth = "Basic "+(base64.b64encode((username+":"+password).encode("ascii")).decode("ascii"))
     try:
-        login_req = requests.get(url, headers={"Authorization":basic_auth})
+        login_req = requests.get(url, headers={"Authorization":basic_auth}, timeout=timeout)
         if login_req.status_code == http_ok:
             return login_req.text
         else:
@@ -60,7 +73,7 @@ def login(username,password,url):
         customLogger.critical("Authentication Cloud service cant be reached!")
         return None
 
-def check_jwt(jwt,url):
+def check_jwt(jwt,url,timeout=None):
     '''
     Checking jwt validity.
 
@@ -70,6 +83,8 @@ def check_jwt(jwt,url):
         JWT to check.
     url: str
          Cloud auth services url.
+    timeout: float
+         Request timeout [s], None to wait for response without limit.
 
     Returns
     -------
@@ -77,7 +92,7 @@ def check_jwt(jwt,url):
          Function returns status 0 if JWT is invalid, otherwise returns 1.
     '''
     try:
-        login_req = requests.get(url, headers={"Authorization": "Bearer " + jwt})
+        login_req = requests.get(url, headers={"Authorization": "Bearer " + jwt}, timeout=timeout)
         if login_req.status_code != http_ok:
             errorLogger.error("Jwt has expired!")
         return login_req.status_code
@@ -124,3 +139,69 @@ def register(key, username, password, time_format, url):
         errorLogger.error("Authentication Cloud service cant be reached!")
         customLogger.critical("Authentication Cloud service cant be reached!")
         return None
+
+
+def decode_claims(jwt):
+    '''
+    Decodes claims of jwt locally, without cloud request.
+
+    Signature is not verified - gateway only reads claims of token it received from cloud platform.
+
+    Parameters
+    ----------
+    jwt : str
+        JWT to decode.
+
+    Returns
+    -------
+    claims: dict
+        Decoded claims, or None if jwt is malformed.
+    '''
+    try:
+        payload = jwt.split(".")[1]
+        claims = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+    except (AttributeError, IndexError, ValueError):
+        return None
+    return claims if isinstance(claims, dict) else None
+
+
+def expires_at(jwt):
+    '''
+    Returns expiration time of jwt from its exp claim.
+
+    Parameters
+    ----------
+    jwt : str
+        JWT to check.
+
+    Returns
+    -------
+    exp: float
+        Expiration time as UNIX timestamp [s], or None if jwt has no exp claim.
+    '''
+    claims = decode_claims(jwt)
+    if claims is None or not isinstance(claims.get("exp"), (int, float)):
+        return None
+    return float(claims["exp"])
+
+
+def is_jwt_valid(jwt, leeway=0.0):
+    '''
+    Checks jwt validity locally, instead of asking cloud platform.
+
+    Parameters
+    ----------
+    jwt : str
+        JWT to check.
+    leeway: float
+        Time [s] before expiration from which jwt is considered expired.
+
+    Returns
+    -------
+    valid: bool
+        Whether jwt is not expired, or None if validity can not be decided locally.
+    '''
+    exp = expires_at(jwt)
+    if exp is None:
+        return None
+    return time.time() + leeway < exp
@@ -5,9 +5,29 @@ Module containing logic for sending collected and processed data to cloud servic
 
 Functions
 ---------
-handle_temperature_data(data, url, jwt, time_format)
+summarize_temperature_data(data, time_format, aggregates)
+    Summarizing collected temperature data into request payload.
+summarize_load_data(data, time_format, aggregates)
+    Summarizing collected load data into request payload.
+data_unit(data, aggregates, name)
+    Extracting measurement unit from collected data.
+filter_fuel_data(data, limit, time_format)
+    Filtering collected fuel data into request payload.
+configure_egress(client)
+    Routing requests of current process through egress scheduler.
+configure_upstream(conf, client_id)
+    Routing selected data streams of current process through MQTT upstream bridge.
+upstream_batch_size(url)
+    Returning max number of payloads delivered in single message to cloud service.
+prewarm(url)
+    Opening connection to cloud service ahead of scheduled flush.
+forward_data(payload, url, jwt, name, backlog)
+    Forwarding request payload to cloud service.
+forward_outbox(outbox, url, jwt, name, limit)
+    Forwarding payloads stored in outbox to cloud service.
+handle_temperature_data(data, url, jwt, time_format, aggregates)
     Summarizing collected temperature data and forwarding result to cloud service.
-handle_load_data(data, url, jwt, time_format)
+handle_load_data(data, url, jwt, time_format, aggregates)
     Summarizing load temperature data and forwarding result to cloud service.
 handle_fuel_data(data, limit, url, jwt, time_format)
     Filtering collected temperature data and forwarding result to cloud service.
@@ -22,10 +42,22 @@ http_ok
     Http status code.
 http_no_content
     Http status code.
+http_service_unavailable
+    Http status code, also returned when request is skipped because endpoint's circuit is open.
+egress_client
+    Egress scheduler client of current process, None if requests are sent directly.
+upstream_conf
+    MQTT upstream bridge config of current process, None if all data is sent over HTTP.
 
 '''
 import time
-import requests
+import threading
+import resilience
+import http_egress
+import mqtt_bridge
+import metrics
+import tracing
+import supervisor
 import logging.config
 
 logging.config.fileConfig('logging.conf')
@@ -36,7 +68,362 @@ data_pattern = "[ value={} , time={} , unit={} ]"
 http_not_found = 404
 http_ok = 200
 http_no_content = 204
-def handle_temperature_data(data, url, jwt, time_format):
+http_service_unavailable = 503
+
+egress_client = None
+upstream_conf = None
+upstream_client_id = None
+# bridge is connected on first use, so processes that never publish do not hold connection to cloud broker
+upstream_bridge = None
+_upstream_lock = threading.Lock()
+
+def summarize_temperature_data(data, time_format, aggregates=()):
+    '''
+       Summarizes collected temperature data.
+
+       Parameters
+       ----------
+       data: list
+            Collected temperature data.
+       time_format: str
+            Cloud services' time format.
+       aggregates: list
+            Aggregates of older temperature data summarized by retry buffer.
+
+       Returns
+       -------
+       payload: dict
+            Request payload containing average temperature.
+       '''
+    data_sum = 0.0
+    # summarizing colleceted data
+    with tracing.span("parse"):
+        for item in data:
+            try:
+                tokens=item.split(" ")
+                data_sum += float(tokens[1].split("=")[1])
+            except:
+                errorLogger.error("Invalid temperature data format! - "+item)
+                metrics.parse_error()
+    with tracing.span("aggregate"):
+        data_count = len(data)
+        for aggregate in aggregates:
+            data_sum += aggregate["sum"]
+            data_count += aggregate["count"]
+        time_value = time.strftime(time_format, time.localtime())
+        unit = data_unit(data, aggregates, "temperature")
+    # creating request payload
+    return {"value": round(data_sum / data_count,2), "time": time_value, "unit": unit}
+
+def summarize_load_data(data, time_format, aggregates=()):
+    '''
+    Summarizes collected load data.
+
+    Parameters
+    ----------
+    data: list
+        Collected load data.
+    time_format: str
+        Cloud services' time format.
+    aggregates: list
+        Aggregates of older load data summarized by retry buffer.
+
+    Returns
+    -------
+    payload: dict
+        Request payload containing total arm load.
+   '''
+    data_sum = 0.0
+    # summarizing collected load aata
+    with tracing.span("parse"):
+        for item in data:
+            try:
+                tokens = item.split(" ")
+                data_sum += float(tokens[1].split("=")[1])
+            except:
+                errorLogger.error("Invalid load data format! - "+ item)
+                metrics.parse_error()
+    with tracing.span("aggregate"):
+        for aggregate in aggregates:
+            data_sum += aggregate["sum"]
+        time_value = time.strftime(time_format, time.localtime())
+        unit = data_unit(data, aggregates, "load")
+    # request payload
+    return {"value": round(data_sum,2), "time": time_value, "unit": unit}
+
+def data_unit(data, aggregates, name):
+    '''
+    Extracts measurement unit from collected data.
+
+    Parameters
+    ----------
+    data: list
+        Collected sensor data.
+    aggregates: list
+        Aggregates of older sensor data.
+    name: str
+        Sensor data name used for logging.
+
+    Returns
+    -------
+    unit: str
+        Measurement unit, or "unknown" if data can not be parsed.
+    '''
+    if len(data) == 0:
+        return aggregates[0]["unit"] if len(aggregates) > 0 else "unknown"
+    try:
+        return data[0].split(" ")[6].split("=")[1]
+    except:
+        errorLogger.error("Invalid " + name + " data format! - " + data[0])
+        return "unknown"
+
+def filter_fuel_data(data, limit, time_format):
+    '''
+     Filters collected fuel data.
+
+     Parameters
+     ----------
+     data: str
+         Collected fuel data.
+     limit: double
+         Critical fuel level.
+     time_format: str
+         Cloud services' time format.
+
+     Returns
+     -------
+     payload: dict
+         Request payload, or None if fuel level is over the limit or data can not be parsed.
+    '''
+    try:
+        with tracing.span("parse"):
+            tokens = data.split(" ")
+            value=float(tokens[1].split("=")[1])
+    except:
+        errorLogger.error("Invalid fuel data format! - " + data)
+        metrics.parse_error()
+        return None
+    # data is of interest only if fuel level is under the limit
+    if value > limit:
+        return None
+    unit = "unknown"
+    try:
+        unit = tokens[6].split("=")[1]
+    except:
+        errorLogger.error("Invalid fuel data format! - " + data)
+    time_value = time.strftime(time_format, time.localtime())
+    # request payload
+    return {"value": round(value,2), "time": time_value, "unit": unit}
+
+def configure_egress(client):
+    '''
+    Routes requests of current process through egress scheduler.
+
+    Parameters
+    ----------
+    client: egress.EgressClient
+        Egress scheduler client, or None for sending requests directly.
+
+    Returns
+    -------
+    '''
+    global egress_client
+    egress_client = client
+
+def configure_upstream(conf, client_id):
+    '''
+    Routes selected data streams of current process through MQTT upstream bridge.
+
+    Parameters
+    ----------
+    conf: dict
+        Bridge config created by mqtt_bridge.upstream_config, or None for sending all data over HTTP.
+    client_id: str
+        MQTT client id of current process.
+
+    Returns
+    -------
+    '''
+    global upstream_conf, upstream_client_id, upstream_bridge
+    if upstream_bridge is not None:
+        upstream_bridge.close()
+    upstream_conf = conf
+    upstream_client_id = client_id
+    upstream_bridge = None
+
+def upstream_batch_size(url):
+    '''
+    Returns max number of payloads delivered in single message to cloud service.
+
+    Parameters
+    ----------
+    url: str
+        Cloud services' URL.
+
+    Returns
+    -------
+    size: int
+        Bridge batch size if URL is delivered over MQTT, 1 otherwise.
+    '''
+    if upstream_conf is None or url not in upstream_conf[mqtt_bridge.routes]:
+        return 1
+    return max(1, upstream_conf.get(mqtt_bridge.batch_size, mqtt_bridge.default_batch_size))
+
+def prewarm(url):
+    '''
+    Opens connection used for forwarding data to cloud service ahead of scheduled flush.
+
+    Nothing is done if requests go through egress scheduler, which owns the connection, or if endpoint's circuit is
+    open.
+
+    Parameters
+    ----------
+    url: str
+        Cloud services' URL.
+
+    Returns
+    -------
+    '''
+    global upstream_bridge
+    if egress_client is not None or resilience.breaker(url).retry_in() > 0:
+        return
+    if upstream_conf is not None and url in upstream_conf[mqtt_bridge.routes]:
+        with _upstream_lock:
+            if upstream_bridge is None:
+                upstream_bridge = mqtt_bridge.create_bridge(upstream_conf, upstream_client_id)
+        return
+    http_egress.prewarm(url)
+
+
+def forward_data(payload, url, jwt, name, backlog=False):
+    '''
+    Sends request payload to cloud service.
+
+    If egress scheduler is configured, request is handed to the scheduler and result is awaited. Data streams
+    routed through MQTT upstream bridge are published to cloud broker instead of being posted.
+
+    Request is skipped while circuit breaker of cloud service endpoint is open. Result of every request is recorded by
+    the breaker, together with delay requested through Retry-After header.
+
+    Parameters
+    ----------
+    payload: dict, list or bytes
+        Request payload, or JSON text serialized earlier, e.g. when payload was stored in outbox. List of payloads can
+        be sent only to URLs with upstream batch size over 1.
+    url: str
+        Cloud services' URL.
+    jwt: str
+        JSON web auth token.
+    name: str
+        Cloud service name used for logging.
+    backlog: bool
+        Whether payload is part of outbox backlog.
+
+    Returns
+    -------
+    http status code
+    '''
+    global upstream_bridge
+    if egress_client is not None:
+        with tracing.span("send"):
+            code = egress_client.send(payload, url, jwt, name, backlog)
+        metrics.response(code)
+        return code
+    breaker = resilience.breaker(url)
+    if not breaker.allow_request():
+        customLogger.debug(name.capitalize() + " Cloud service circuit is open! Next attempt in {:.1f}s"
+                           .format(breaker.retry_in()))
+        return http_service_unavailable
+    customLogger.warning("Forwarding " + name + " data: " +
+                         (payload.decode("utf-8") if isinstance(payload, bytes) else str(payload)))
+    if upstream_conf is not None and url in upstream_conf[mqtt_bridge.routes]:
+        # egress scheduler can forward several requests concurrently
+        with _upstream_lock:
+            if upstream_bridge is None:
+                upstream_bridge = mqtt_bridge.create_bridge(upstream_conf, upstream_client_id)
+        with tracing.span("send"):
+            code = upstream_bridge.publish(url, payload)
+        metrics.response(code)
+        if resilience.is_failure(code):
+            breaker.record_failure()
+            customLogger.error("Problem with " + name + " upstream MQTT bridge!")
+        else:
+            breaker.record_success()
+        return code
+    try:
+        with tracing.span("send"):
+            post_req = http_egress.post(url, payload, {"Authorization": "Bearer " + jwt})
+    except:
+        breaker.record_failure()
+        metrics.response(None)
+        errorLogger.error(name.capitalize() + " Cloud service cant be reached!")
+        customLogger.critical(name.capitalize() + " Cloud service cant be reached!")
+        return http_not_found
+    metrics.response(post_req.status_code)
+    if resilience.is_failure(post_req.status_code):
+        breaker.record_failure(resilience.parse_retry_after(post_req.headers.get("Retry-After")))
+    else:
+        breaker.record_success()
+    if post_req.status_code != http_ok:
+        errorLogger.error("Problem with " + name + " Cloud service! - Http status code: " + str(post_req.status_code))
+        customLogger.error("Problem with " + name + " Cloud service! - Http status code: " + str(post_req.status_code))
+    return post_req.status_code
+
+def forward_outbox(outbox, url, jwt, name, limit=None):
+    '''
+    Replays payloads stored in outbox to cloud service.
+
+    Payloads are sent in the order they were stored. Replay stops at first failed request, and every payload
+    delivered before the failure is acknowledged, so it is never sent again. Payload that cloud service rejects, e.g.
+    with 400 or 413, is logged and acknowledged as well, because it would otherwise block all later payloads. All but
+    the newest payload are backlog.
+    If cloud service accepts batches (MQTT upstream bridge), consecutive payloads are sent together as one message.
+
+    Parameters
+    ----------
+    outbox: outbox.Outbox
+        Durable store of payloads that are not delivered yet.
+    url: str
+        Cloud services' URL.
+    jwt: str
+        JSON web auth token.
+    name: str
+        Cloud service name used for logging.
+    limit: int
+        Max number of payloads replayed in one call.
+
+    Returns
+    -------
+    code: int
+        Http status code of last request, or http_no_content if outbox is empty.
+    delivered: int
+        Number of delivered payloads.
+    '''
+    code = http_no_content
+    delivered = 0
+    # stored JSON text is sent as it is, so payload is serialized only once, when it is appended
+    records = outbox.pending_raw(limit)
+    batch = upstream_batch_size(url)
+    for start in range(0, len(records), batch):
+        # long replay is progress of worker, so supervisor does not take it for hung
+        supervisor.heartbeat()
+        chunk = records[start:start + batch]
+        text = chunk[0][1] if batch == 1 else "[" + ",".join(record[1] for record in chunk) + "]"
+        payload = text.encode("utf-8")
+        code = forward_data(payload, url, jwt, name, start + len(chunk) < len(records))
+        if resilience.is_rejected(code):
+            errorLogger.error(name.capitalize() + " Cloud service rejected payload, dropping it! - Http status code: "
+                              + str(code) + " - " + text)
+            customLogger.error(name.capitalize() + " Cloud service rejected payload, dropping it!")
+            outbox.ack(chunk[-1][0])
+            continue
+        if code != http_ok:
+            break
+        outbox.ack(chunk[-1][0])
+        delivered += len(chunk)
+    return code, delivered
+
+def handle_temperature_data(data, url, jwt, time_format, aggregates=()):
     '''
        Summarizes and sends collected temperature data.
 
@@ -52,39 +439,16 @@ def handle_temperature_data(data, url, jwt, time_format):
             JSON wen auth token
        time_format: str
             Cloud services' time format.
+       aggregates: list
+            Aggregates of older temperature data summarized by retry buffer.
 
        Returns
        -------
        http status code
        '''
-    data_sum = 0.0
-    # summarizing colleceted data
-    for item in data:
-        try:
-            tokens=item.split(" ")
-            data_sum += float(tokens[1].split("=")[1])
-        except:
-            errorLogger.error("Invalid temperature data format! - "+item)
-    time_value = time.strftime(time_format, time.localtime())
-    unit="unknown"
-    try:
-        unit = data[0].split(" ")[6].split("=")[1]
-    except:
-        errorLogger.error("Invalid temperature data format! - "+data[0])
-    # creating request payload
-    payload = {"value": round(data_sum / len(data),2), "time": time_value, "unit": unit}
-    customLogger.warning("Forwarding temperature data: " + str(payload))
-    try:
-        post_req = requests.post(url, json=payload, headers={"Authorization": "Bearer " + jwt})
-        if post_req.status_code != http_ok:
-            errorLogger.error("Problem with temperature Cloud service! - Http status code: "+ str(post_req.status_code))
-        return post_req.status_code
-    except:
-        errorLogger.error("Temperature Cloud service cant be reached!")
-        customLogger.critical("Temperature Cloud service cant be reached!")
-        return http_not_found
+    return forward_data(summarize_temperature_data(data, time_format, aggregates), url, jwt, "temperature")
 
-def handle_load_data(data, url, jwt, time_format):
+def handle_load_data(data, url, jwt, time_format, aggregates=()):
     '''
     Summarizes and sends collected load data.
 
@@ -100,38 +464,14 @@ def handle_load_data(data, url, jwt, time_format):
         JSON wen auth token
     time_format: str
         Cloud services' time format.
+    aggregates: list
+        Aggregates of older load data summarized by retry buffer.
 
     Returns
     -------
     http status code
    '''
-    data_sum = 0.0
-    # summarizing collected load aata
-    for item in data:
-        try:
-            tokens = item.split(" ")
-            data_sum += float(tokens[1].split("=")[1])
-        except:
-            errorLogger.error("Invalid load data format! - "+ item)
-    time_value = time.strftime(time_format, time.localtime())
-    unit = "unknown"
-    try:
-        unit = data[0].split(" ")[6].split("=")[1]
-    except:
-        errorLogger.error("Invalid load data format! - "+data[0])
-    # request payload
-    payload = {"value": round(data_sum,2), "time": time_value, "unit": unit}
-    customLogger.warning("Forwarding load data: " +str(payload))
-    try:
-        post_req = requests.post(url, json=payload, headers={"Authorization": "Bearer " + jwt})
-        if post_req.status_code != http_ok:
-            errorLogger.error("Problem with arm load Cloud service! - Http status code: " + str(post_req.status_code))
-            customLogger.error("Problem with arm load Cloud service! - Http status code: " + str(post_req.status_code))
-        return post_req.status_code
-    except:
-        errorLogger.error("Arm load Cloud service cant be reached!")
-        customLogger.critical("Arm load Cloud service cant be reached!")
-        return http_not_found
+    return forward_data(summarize_load_data(data, time_format, aggregates), url, jwt, "arm load")
 
 
 def handle_fuel_data(data, limit, url, jwt, time_format):
@@ -157,34 +497,8 @@ def handle_fuel_data(data, limit, url, jwt, time_format):
      -------
      http status code
     '''
-    try:
-        tokens = data.split(" ")
-        value=float(tokens[1].split("=")[1])
-        # sends data to cloud services only if it is value of interest
-        if value<=limit:
-            unit = "unknown"
-            try:
-                unit = tokens[6].split("=")[1]
-            except:
-                errorLogger.error("Invalid fuel data format! - " + data)
-            time_value = time.strftime(time_format, time.localtime())
-            # request payload
-            payload = {"value": round(value,2), "time": time_value, "unit": unit}
-            customLogger.warning("Forwarding fuel data: " + str(payload))
-            try:
-                post_req = requests.post(url, json=payload, headers={"Authorization": "Bearer " + jwt})
-                if post_req.status_code != http_ok:
-                    errorLogger.error("Problem with fuel Cloud service! - Http status code: " + str(post_req.status_code))
-                    customLogger.error("Problem with fuel Cloud service! - Http status code: " + str(post_req.status_code))
-                return post_req.status_code
-            except:
-                errorLogger.error("Fuel Cloud service cant be reached!")
-                customLogger.error("Fuel Cloud service cant be reached!")
-                return http_not_found
-        else:
-            # data is handled but is not sent because fuel level is over the limit
-            return http_no_content
-    except:
-        errorLogger.error("Invalid fuel data format! - " + data)
-        # data can not be parsed, trying again to parse it and send in next iteration is redundant
+    payload = filter_fuel_data(data, limit, time_format)
+    # data is handled but is not sent because fuel level is over the limit or it can not be parsed
+    if payload is None:
         return http_no_content
+    return forward_data(payload, url, jwt, "fuel")
@@ -0,0 +1,478 @@
+'''
+egress
+============
+Module that contains central egress scheduler shared by all data handlers.
+
+When scheduler is enabled, data handlers do not send requests to cloud services themselves. Requests are put into
+shared queue and scheduler process sends them one by one over the uplink. Every request belongs to priority class -
+pending request of higher class is always sent before any request of lower class, so critical alerts jump ahead of
+regular summaries and outbox backlog. Within single class, streams share the uplink by weighted fair queuing
+(self-clocked fair queuing with request size as cost). Scheduler measures how long requests of every class wait in
+queue and reports it periodically.
+
+Streams can be consolidated into device snapshots: regular requests of snapshot streams that arrive within short
+window are held and sent as single snapshot request, which contains aggregate of every stream. If window closes with
+only one stream's request held, that request is sent to its own endpoint as usual.
+
+By default scheduler sends one request at a time. With HTTP/2 egress, several requests can be kept in flight over
+single multiplexed connection - requests are still dispatched in priority order, but slow response no longer blocks
+requests behind it.
+
+Classes
+---------
+EgressClient
+    Handler side of egress scheduler.
+LatencyStats
+    Queueing latency of single priority class.
+
+Functions
+---------
+run_scheduler(requests, replies, stream_weights, flag, interval, resilience_conf, upstream_conf, snapshot_conf,
+              http_conf, in_flight_limit)
+    Egress scheduler process logic.
+create_scheduler(conf, streams, resilience_conf, upstream_conf, snapshot_url, http_conf)
+    Creates egress scheduler process and clients for data streams.
+
+Constants
+---------
+critical: int
+    Priority class of critical alerts.
+normal: int
+    Priority class of regular data summaries.
+bulk: int
+    Priority class of outbox backlog and other bulk traffic.
+enabled: str
+    Config key of scheduler switch.
+weights: str
+    Config key of per stream weights.
+priorities: str
+    Config key of per stream priority classes.
+report_interval: str
+    Config key of queueing latency report interval in seconds.
+reply_timeout: str
+    Config key of max time in seconds handler waits for request result.
+max_in_flight: str
+    Config key of max number of requests sent concurrently.
+snapshot: str
+    Config key of snapshot consolidation settings.
+snapshot_streams: str
+    Config key of streams consolidated into snapshots.
+snapshot_window: str
+    Config key of max time in seconds first request of snapshot is held waiting for other streams.
+'''
+import json
+import heapq
+import queue
+import itertools
+import threading
+import time
+import logging.config
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Process, Queue, Event
+import data_service
+import http_egress
+import resilience
+import traffic
+import supervisor
+
+logging.config.fileConfig('logging.conf')
+infoLogger = logging.getLogger('customInfoLogger')
+errorLogger = logging.getLogger('customErrorLogger')
+customLogger = logging.getLogger('customConsoleLogger')
+
+critical = 0
+normal = 1
+bulk = 2
+class_names = {critical: "critical", normal: "normal", bulk: "bulk"}
+
+enabled = "enabled"
+weights = "weights"
+priorities = "priorities"
+report_interval = "report_interval"
+reply_timeout = "reply_timeout"
+max_in_flight = "max_in_flight"
+snapshot = "snapshot"
+snapshot_streams = "streams"
+snapshot_window = "window"
+snapshot_stream = "snapshot"
+
+default_report_interval = 60
+default_reply_timeout = 120
+default_snapshot_window = 1.0
+# max time handler waits for reply without updating its heartbeat [s]
+_beat_interval = 1.0
+
+
+class EgressClient:
+    '''
+    Handler side of egress scheduler.
+
+    Object is created in main process and passed to data handler process.
+
+    Attributes
+    ---------
+    stream: str
+        Data stream name.
+    priority: int
+        Default priority class of stream.
+    timeout: float
+        Max time handler waits for request result [s].
+
+    Methods
+    ---------
+    send(self, payload, url, jwt, name, backlog)
+        Schedules request and waits for its result.
+    '''
+    def __init__(self, stream, priority, requests, replies, timeout=default_reply_timeout):
+        '''
+        Initializes EgressClient object.
+
+        Parameters
+        ----------
+        stream: str
+            Data stream name.
+        priority: int
+            Default priority class of stream.
+        requests: multiprocessing.Queue
+            Queue shared by all clients and scheduler.
+        replies: multiprocessing.Queue
+            Queue with results of stream's requests.
+        timeout: float
+            Max time handler waits for request result [s].
+        '''
+        self.stream = stream
+        self.priority = priority
+        self.timeout = timeout
+        self._requests = requests
+        self._replies = replies
+        self._next_id = 0
+        self._lock = None
+
+    def send(self, payload, url, jwt, name, backlog=False):
+        '''
+        Schedules request and waits for its result.
+
+        Parameters
+        ----------
+        payload: dict
+            Request payload.
+        url: str
+            Cloud services' URL.
+        jwt: str
+            JSON web auth token.
+        name: str
+            Cloud service name used for logging.
+        backlog: bool
+            Whether payload is part of outbox backlog, which is sent as bulk traffic.
+
+        Returns
+        -------
+        http status code
+        '''
+        # lock is created lazily, because it can not be passed to handler process
+        if self._lock is None:
+            self._lock = threading.Lock()
+        with self._lock:
+            request_id = self._next_id
+            self._next_id += 1
+            self._requests.put((self.stream, request_id, bulk if backlog else self.priority, time.time(), url, jwt,
+                                name, payload))
+            deadline = time.monotonic() + self.timeout
+            while True:
+                # worker keeps beating while its request waits behind traffic of other handlers
+                supervisor.heartbeat()
+                try:
+                    reply_id, code, usage = self._replies.get(timeout=max(0.0, min(_beat_interval,
+                                                                                   deadline - time.monotonic())))
+                except queue.Empty:
+                    if time.monotonic() < deadline:
+                        continue
+                    errorLogger.error("Egress scheduler did not answer " + name + " request in time!")
+                    return data_service.http_not_found
+                # results of requests that timed out earlier are discarded, but their traffic was sent anyway
+                traffic.merge(usage)
+                if reply_id == request_id:
+                    return code
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_lock"] = None
+        return state
+
+
+class LatencyStats:
+    '''
+    Queueing latency of single priority class.
+
+    Attributes
+    ---------
+    count: int
+        Number of dispatched requests.
+    total: float
+        Sum of queueing latencies [s].
+    max: float
+        Max queueing latency [s].
+
+    Methods
+    ---------
+    record(self, latency)
+        Records queueing latency of dispatched request.
+    report(self)
+        Returns latency summary.
+    '''
+    def __init__(self):
+        '''
+        Initializes LatencyStats object.
+        '''
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, latency):
+        '''
+        Records queueing latency of dispatched request.
+
+        Parameters
+        ----------
+        latency: float
+            Time request spent in queue [s].
+
+        Returns
+        -------
+        '''
+        self.count += 1
+        self.total += latency
+        self.max = max(self.max, latency)
+
+    def report(self):
+        '''
+        Returns latency summary.
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        summary: dict
+            Number of requests, average and max queueing latency in milliseconds.
+        '''
+        average = self.total / self.count if self.count > 0 else 0.0
+        return {"requests": self.count, "avg_ms": round(average * 1000, 2), "max_ms": round(self.max * 1000, 2)}
+
+
+def run_scheduler(requests, replies, stream_weights, flag, interval, resilience_conf, upstream_conf=None,
+                  snapshot_conf=None, http_conf=None, in_flight_limit=1):
+    '''
+    Egress scheduler process logic.
+
+    Parameters
+    ----------
+    requests: multiprocessing.Queue
+        Queue with scheduled requests of all streams.
+    replies: dict
+        Reply queue of every stream.
+    stream_weights: dict
+        Weight of every stream within its priority class.
+    flag: multiprocessing.Event
+        Object used for stopping scheduler process.
+    interval: float
+        Queueing latency report interval [s].
+    resilience_conf: dict
+        Circuit breaker and backoff config.
+    upstream_conf: dict
+        MQTT upstream bridge config, None if all data is sent over HTTP.
+    snapshot_conf: tuple
+        Snapshot URL, consolidated streams and window [s], None if streams are not consolidated.
+    http_conf: dict
+        HTTP client config.
+    in_flight_limit: int
+        Max number of requests sent concurrently.
+
+    Returns
+    -------
+    '''
+    resilience.configure(resilience_conf)
+    http_egress.configure(http_conf)
+    data_service.configure_upstream(upstream_conf, "egress-upstream-bridge-mqtt-client")
+    # pending requests of every class, ordered by virtual finish time
+    pending = {critical: [], normal: [], bulk: []}
+    virtual_time = {critical: 0.0, normal: 0.0, bulk: 0.0}
+    last_finish = {}
+    latency = {priority: LatencyStats() for priority in pending}
+    sequence = itertools.count()
+    last_report = time.monotonic()
+    snapshot_url, consolidated, window = snapshot_conf if snapshot_conf is not None else (None, (), 0.0)
+    # regular requests of consolidated streams waiting for snapshot, and member requests of queued snapshots
+    held = {}
+    held_since = None
+    members = {}
+    snapshot_ids = itertools.count()
+    executor = ThreadPoolExecutor(in_flight_limit) if in_flight_limit > 1 else None
+    in_flight = threading.Semaphore(max(1, in_flight_limit))
+
+    def dispatch(request):
+        stream, request_id, _, enqueued, url, jwt, name, payload = request
+        usage = {}
+        try:
+            # traffic is returned with result, so it is accounted to stream that made request
+            with traffic.capture() as usage:
+                code = data_service.forward_data(payload, url, jwt, name)
+        except Exception as error:
+            # failed request is answered like unavailable service, so handler keeps data and scheduler keeps running
+            errorLogger.error("Egress request of " + name + " failed! - " + repr(error))
+            code = data_service.http_service_unavailable
+        finally:
+            in_flight.release()
+        if stream == snapshot_stream:
+            snapshot_members = members.pop(request_id)
+            for (member_stream, member_id), member_usage in zip(snapshot_members,
+                                                                traffic.share(usage, len(snapshot_members))):
+                replies[member_stream].put((member_id, code, member_usage))
+        else:
+            replies[stream].put((request_id, code, usage))
+
+    def enqueue(request, hold=True):
+        nonlocal held_since
+        stream, request_id, priority, enqueued, url, jwt, name, payload = request
+        priority = priority if priority in pending else normal
+        if hold and stream in consolidated and priority == normal and isinstance(payload, bytes):
+            # snapshot merges payloads of streams, so payload read from outbox is parsed again
+            payload = json.loads(payload)
+            request = request[:7] + (payload,)
+        if hold and stream in consolidated and priority == normal and isinstance(payload, dict):
+            # second request of the same stream closes snapshot early, so no request is held twice as long
+            if stream in held:
+                release()
+            held[stream] = request
+            held_since = time.monotonic() if held_since is None else held_since
+            if len(held) == len(consolidated):
+                release()
+            return
+        cost = len(payload) if isinstance(payload, bytes) else len(json.dumps(payload))
+        start = max(virtual_time[priority], last_finish.get((priority, stream), 0.0))
+        finish = start + cost / max(stream_weights.get(stream, 1), 1e-6)
+        last_finish[(priority, stream)] = finish
+        heapq.heappush(pending[priority], (finish, next(sequence), request))
+
+    def release():
+        nonlocal held_since
+        held_requests = list(held.values())
+        held.clear()
+        held_since = None
+        if len(held_requests) == 1:
+            enqueue(held_requests[0], False)
+            return
+        snapshot_id = next(snapshot_ids)
+        members[snapshot_id] = [(request[0], request[1]) for request in held_requests]
+        payload = {"time": held_requests[-1][7].get("time"),
+                   "streams": {request[0]: request[7] for request in held_requests}}
+        enqueue((snapshot_stream, snapshot_id, normal, min(request[3] for request in held_requests), snapshot_url,
+                 held_requests[-1][5], snapshot_stream, payload), False)
+
+    customLogger.debug("Egress scheduler started!")
+    while not flag.is_set():
+        # blocking only when there is nothing to send
+        has_pending = any(len(requests_of_class) > 0 for requests_of_class in pending.values())
+        timeout = 0.2 if held_since is None else min(0.2, max(0.0, held_since + window - time.monotonic()))
+        # while all in flight slots are taken, new requests are collected in short steps
+        if has_pending and executor is not None and not in_flight.acquire(blocking=False):
+            has_pending = False
+            timeout = min(timeout, 0.005)
+        elif has_pending and executor is not None:
+            in_flight.release()
+        try:
+            enqueue(requests.get_nowait() if has_pending or timeout == 0.0 else requests.get(timeout=timeout))
+            while True:
+                enqueue(requests.get_nowait())
+        except queue.Empty:
+            pass
+        if held_since is not None and time.monotonic() - held_since >= window:
+            release()
+        for priority in (critical, normal, bulk):
+            if len(pending[priority]) > 0:
+                if not in_flight.acquire(blocking=False):
+                    break
+                finish, _, request = heapq.heappop(pending[priority])
+                virtual_time[priority] = finish
+                latency[priority].record(time.time() - request[3])
+                if executor is not None:
+                    executor.submit(dispatch, request)
+                else:
+                    dispatch(request)
+                break
+        if time.monotonic() - last_report >= interval:
+            last_report = time.monotonic()
+            report = {class_names[priority]: stats.report() for priority, stats in latency.items()}
+            infoLogger.info("Egress queueing latency: " + json.dumps(report))
+            customLogger.debug("Egress queueing latency: " + json.dumps(report))
+    if executor is not None:
+        executor.shutdown(wait=True)
+    # requests that are still held, pending or not yet received are answered, so handlers keep their data for retry
+    unanswered = list(held.values())
+    for requests_of_class in pending.values():
+        # members of pending snapshots are answered below
+        unanswered += [request for _, _, request in requests_of_class if request[0] != snapshot_stream]
+    try:
+        while True:
+            unanswered.append(requests.get_nowait())
+    except queue.Empty:
+        pass
+    for stream, request_id in [(request[0], request[1]) for request in unanswered] + \
+            [member for snapshot_members in members.values() for member in snapshot_members]:
+        replies[stream].put((request_id, data_service.http_service_unavailable, {}))
+    report = {class_names[priority]: stats.report() for priority, stats in latency.items()}
+    infoLogger.info("Egress queueing latency: " + json.dumps(report))
+    data_service.configure_upstream(None, None)
+    http_egress.close()
+    customLogger.debug("Egress scheduler shutdown!")
+
+
+def create_scheduler(conf, streams, resilience_conf=None, upstream_conf=None, snapshot_url=None, http_conf=None):
+    '''
+    Creates egress scheduler process and clients for data streams.
+
+    Parameters
+    ----------
+    conf: dict
+        Egress scheduler config.
+    streams: dict
+        Default priority class of every data stream.
+    resilience_conf: dict
+        Circuit breaker and backoff config.
+    upstream_conf: dict
+        MQTT upstream bridge config, None if all data is sent over HTTP.
+    snapshot_url: str
+        Cloud service URL of device snapshots.
+    http_conf: dict
+        HTTP client config.
+
+    Returns
+    -------
+    scheduler: multiprocessing.Process
+        Scheduler process, None if scheduler is disabled.
+    flag: multiprocessing.Event
+        Object used for stopping scheduler process, None if scheduler is disabled.
+    clients: dict
+        Egress client of every data stream, empty if scheduler is disabled.
+    '''
+    if conf is None or not conf.get(enabled, False):
+        return None, None, {}
+    requests = Queue()
+    replies = {stream: Queue() for stream in streams}
+    flag = Event()
+    stream_priorities = conf.get(priorities, {})
+    clients = {}
+    for stream, priority in streams.items():
+        priority = {name: value for value, name in class_names.items()}.get(stream_priorities.get(stream), priority)
+        clients[stream] = EgressClient(stream, priority, requests, replies[stream],
+                                       conf.get(reply_timeout, default_reply_timeout))
+    snapshot_conf = None
+    consolidated = [stream for stream in conf.get(snapshot, {}).get(snapshot_streams, []) if stream in streams]
+    if snapshot_url is not None and len(consolidated) > 1:
+        snapshot_conf = (snapshot_url, tuple(consolidated),
+                         conf[snapshot].get(snapshot_window, default_snapshot_window))
+    scheduler = Process(target=run_scheduler, args=(requests, replies, conf.get(weights, {}), flag,
+                                                    conf.get(report_interval, default_report_interval),
+                                                    resilience_conf, upstream_conf, snapshot_conf, http_conf,
+                                                    conf.get(max_in_flight, 1)))
+    return scheduler, flag, clients
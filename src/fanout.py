@@ -0,0 +1,301 @@
+'''
+fanout
+============
+Module that delivers data stream's payloads to additional targets, besides cloud platform.
+
+Every payload is serialized once, when it is appended to outbox. Fan-out reads stored JSON text, compresses it once
+and sends the same request body to every target. Each target has its own outbox cursor, its own circuit breaker and
+its own delivery thread, so slow or unreachable target never blocks delivery to the other targets or cloud platform.
+Delivery thread keeps its connection to target open between requests, so payloads do not pay TCP and TLS handshakes.
+Payload that target rejects, e.g. with 400 or 413, is logged and dropped for that target, so it does not block later
+payloads.
+
+Classes
+---------
+FanOut
+    Delivery of outbox payloads to additional targets.
+
+Functions
+---------
+consumers(conf, stream)
+    Returns outbox consumer names of targets that receive data stream.
+create_fanout(conf, box, stream)
+    Creates fan-out of data stream based on fan-out config.
+
+Constants
+---------
+targets: str
+    Config key of fan-out targets.
+url: str
+    Config key of target URL. "{stream}" placeholder is replaced with data stream name.
+headers: str
+    Config key of extra request headers of target, e.g. API key.
+compress: str
+    Config key of gzip request body compression switch.
+streams: str
+    Config key of data streams delivered to target. If missing, target receives all streams.
+batch: str
+    Config key of max number of payloads read from outbox in one iteration.
+timeout: str
+    Config key of request timeout in seconds.
+poll_interval: str
+    Config key of max time in seconds between two outbox checks.
+'''
+import gzip
+import threading
+from collections import OrderedDict
+import requests
+import resilience
+import traffic
+import logging.config
+
+logging.config.fileConfig('logging.conf')
+infoLogger = logging.getLogger('customInfoLogger')
+errorLogger = logging.getLogger('customErrorLogger')
+customLogger = logging.getLogger('customConsoleLogger')
+
+targets = "targets"
+url = "url"
+headers = "headers"
+compress = "compress"
+streams = "streams"
+batch = "batch"
+timeout = "timeout"
+poll_interval = "poll_interval"
+
+default_batch = 100
+default_timeout = 10.0
+default_poll_interval = 5.0
+# max number of encoded request bodies shared between targets
+body_cache_size = 256
+
+
+def _consumer(stream, target):
+    return stream + "->" + target
+
+
+class FanOut:
+    '''
+    Delivery of outbox payloads to additional targets.
+
+    Attributes
+    ---------
+    stream: str
+        Data stream name.
+    targets: dict
+        Config of every target that receives data stream.
+    batch: int
+        Max number of payloads read from outbox in one iteration.
+    timeout: float
+        Request timeout [s].
+    poll_interval: float
+        Max time between two outbox checks [s].
+
+    Methods
+    ---------
+    start(self)
+        Starts delivery thread of every target.
+    notify(self)
+        Wakes up delivery threads after new payload is appended to outbox.
+    stop(self)
+        Stops delivery threads.
+    '''
+    def __init__(self, box, stream, stream_targets, batch=default_batch, timeout=default_timeout,
+                 poll_interval=default_poll_interval):
+        '''
+        Initializes FanOut object.
+
+        Parameters
+        ----------
+        box: outbox.Outbox
+            Outbox of data stream, opened with consumer of every target.
+        stream: str
+            Data stream name.
+        stream_targets: dict
+            Config of every target that receives data stream.
+        batch: int
+            Max number of payloads read from outbox in one iteration.
+        timeout: float
+            Request timeout [s].
+        poll_interval: float
+            Max time between two outbox checks [s].
+        '''
+        self.stream = stream
+        self.targets = stream_targets
+        self.batch = batch
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self._box = box
+        self._stopped = threading.Event()
+        self._wakeups = {name: threading.Event() for name in stream_targets}
+        self._threads = []
+        # encoded bodies by (offset, compression), shared by all targets
+        self._bodies = OrderedDict()
+        self._bodies_lock = threading.Lock()
+
+    def start(self):
+        '''
+        Starts delivery thread of every target.
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        '''
+        for name in self.targets:
+            thread = threading.Thread(target=self._deliver, args=(name,), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def notify(self):
+        '''
+        Wakes up delivery threads after new payload is appended to outbox.
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        '''
+        for wakeup in self._wakeups.values():
+            wakeup.set()
+
+    def stop(self):
+        '''
+        Stops delivery threads. Payloads that are not delivered stay in outbox.
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        '''
+        self._stopped.set()
+        self.notify()
+        for thread in self._threads:
+            thread.join(self.timeout)
+
+    def _body(self, offset, text, compressed):
+        key = (offset, compressed)
+        with self._bodies_lock:
+            body = self._bodies.get(key)
+            if body is not None:
+                self._bodies.move_to_end(key)
+                return body
+        body = text.encode("utf-8")
+        if compressed:
+            body = gzip.compress(body)
+        with self._bodies_lock:
+            self._bodies[key] = body
+            while len(self._bodies) > body_cache_size:
+                self._bodies.popitem(last=False)
+        return body
+
+    def _deliver(self, name):
+        target = self.targets[name]
+        target_url = target[url].replace("{stream}", self.stream)
+        compressed = target.get(compress, False)
+        request_headers = {"Content-Type": "application/json"}
+        if compressed:
+            request_headers["Content-Encoding"] = "gzip"
+        request_headers.update(target.get(headers, {}))
+        consumer = _consumer(self.stream, name)
+        breaker = resilience.breaker(target_url)
+        wakeup = self._wakeups[name]
+        # connection to target is reused by all requests of delivery thread
+        with requests.Session() as session:
+            while not self._stopped.is_set():
+                delivered = 0
+                for offset, text in self._box.pending_raw(self.batch, consumer):
+                    if self._stopped.is_set() or not breaker.allow_request():
+                        break
+                    body = self._body(offset, text, compressed)
+                    try:
+                        response = session.post(target_url, data=body, headers=request_headers, timeout=self.timeout)
+                    except requests.RequestException:
+                        traffic.record(target_url, failed=True)
+                        breaker.record_failure()
+                        errorLogger.error("Fan-out target " + name + " cant be reached!")
+                        break
+                    header_bytes, response_bytes = traffic.http1_sizes(response)
+                    traffic.record(target_url, len(text.encode("utf-8")), len(body), header_bytes, response_bytes,
+                                   response.status_code // 100 != 2)
+                    if resilience.is_rejected(response.status_code):
+                        # target is healthy, but payload would block all later payloads of target
+                        breaker.record_success()
+                        errorLogger.error("Fan-out target " + name + " rejected payload, dropping it! - Http status "
+                                          "code: " + str(response.status_code) + " - " + text)
+                        self._box.ack(offset, consumer)
+                        continue
+                    if response.status_code // 100 != 2:
+                        breaker.record_failure(resilience.parse_retry_after(response.headers.get("Retry-After")))
+                        errorLogger.error("Problem with fan-out target " + name + "! - Http status code: "
+                                          + str(response.status_code))
+                        break
+                    breaker.record_success()
+                    self._box.ack(offset, consumer)
+                    delivered += 1
+                if delivered > 0:
+                    customLogger.debug("Delivered {} {} payloads to fan-out target {}".format(delivered, self.stream,
+                                                                                                name))
+                # full batch means more payloads are probably waiting
+                if delivered == self.batch:
+                    continue
+                wakeup.wait(max(breaker.retry_in(), 0.0) or self.poll_interval)
+                wakeup.clear()
+
+
+def consumers(conf, stream):
+    '''
+    Returns outbox consumer names of targets that receive data stream.
+
+    Parameters
+    ----------
+    conf: dict
+        Fan-out config, or None.
+    stream: str
+        Data stream name.
+
+    Returns
+    -------
+    consumers: tuple
+    '''
+    if conf is None:
+        return ()
+    return tuple(_consumer(stream, name) for name, target in conf.get(targets, {}).items()
+                 if stream in target.get(streams, [stream]))
+
+
+def create_fanout(conf, box, stream):
+    '''
+    Creates fan-out of data stream.
+
+    Fan-out needs outbox, because every target tracks its own outbox cursor.
+
+    Parameters
+    ----------
+    conf: dict
+        Fan-out config, or None.
+    box: outbox.Outbox
+        Outbox of data stream, opened with consumers returned by consumers function.
+    stream: str
+        Data stream name.
+
+    Returns
+    -------
+    fanout: FanOut
+        Started fan-out, or None if no target receives data stream.
+    '''
+    if len(consumers(conf, stream)) == 0:
+        return None
+    if box is None:
+        errorLogger.error("Fan-out of " + stream + " data requires outbox! Additional targets are disabled.")
+        customLogger.error("Fan-out of " + stream + " data requires outbox! Additional targets are disabled.")
+        return None
+    stream_targets = {name: target for name, target in conf[targets].items()
+                      if stream in target.get(streams, [stream])}
+    fanout = FanOut(box, stream, stream_targets, conf.get(batch, default_batch), conf.get(timeout, default_timeout),
+                    conf.get(poll_interval, default_poll_interval))
+    fanout.start()
+    return fanout
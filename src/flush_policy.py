@@ -0,0 +1,262 @@
+'''
+flush_policy
+============
+Module that decides when collected sensor data should be flushed to cloud services.
+
+Collected data is flushed by whichever trigger fires first: number of buffered readings, size of buffered readings,
+or time since last flush. Flush interval adapts to observed cloud service behaviour in AIMD fashion: slow or failed
+flush multiplies the interval, while healthy flush decreases it by a constant step, always within configured bounds.
+
+Classes
+---------
+FlushPolicy
+    Size-or-deadline flush trigger with adaptive interval.
+
+Functions
+---------
+create_flush_policy(conf, interval)
+    Creates flush policy based on flush config.
+
+Constants
+---------
+max_items: str
+    Config key of max number of buffered readings.
+max_bytes: str
+    Config key of max size of buffered readings in bytes.
+min_interval: str
+    Config key of min flush interval in seconds.
+max_interval: str
+    Config key of max flush interval in seconds.
+target_latency: str
+    Config key of flush latency in seconds above which cloud service is considered congested.
+increase_factor: str
+    Config key of multiplicative interval increase on slow or failed flush.
+decrease_step: str
+    Config key of additive interval decrease in seconds on healthy flush.
+'''
+import time
+import threading
+import logging.config
+
+logging.config.fileConfig('logging.conf')
+infoLogger = logging.getLogger('customInfoLogger')
+customLogger = logging.getLogger('customConsoleLogger')
+
+max_items = "max_items"
+max_bytes = "max_bytes"
+min_interval = "min_interval"
+max_interval = "max_interval"
+target_latency = "target_latency"
+increase_factor = "increase_factor"
+decrease_step = "decrease_step"
+
+trigger_items = "items"
+trigger_bytes = "bytes"
+trigger_deadline = "deadline"
+
+
+class FlushPolicy:
+    '''
+    Size-or-deadline flush trigger with adaptive interval.
+
+    Attributes
+    ---------
+    interval: float
+        Current flush interval [s].
+    max_items: int
+        Max number of buffered readings, None if unlimited.
+    max_bytes: int
+        Max size of buffered readings [byte], None if unlimited.
+    min_interval: float
+        Min flush interval [s].
+    max_interval: float
+        Max flush interval [s].
+    target_latency: float
+        Flush latency above which cloud service is considered congested [s].
+    increase_factor: float
+        Multiplicative interval increase on slow or failed flush.
+    decrease_step: float
+        Additive interval decrease on healthy flush [s].
+
+    Methods
+    ---------
+    add(self, size)
+        Records newly buffered reading.
+    due(self)
+        Returns trigger that requires flush, if any.
+    flushed(self)
+        Resets buffered data counters after flush.
+    record(self, latency, success)
+        Adapts flush interval to flush result.
+    tick(self)
+        Returns how often flush triggers should be checked.
+    time_to_deadline(self)
+        Returns time until deadline trigger fires.
+    '''
+    def __init__(self, interval, max_items=None, max_bytes=None, min_interval=None, max_interval=None,
+                 target_latency=1.0, increase_factor=2.0, decrease_step=1.0):
+        '''
+        Initializes FlushPolicy object.
+
+        Parameters
+        ----------
+        interval: float
+            Initial flush interval [s].
+        max_items: int
+            Max number of buffered readings, None if unlimited.
+        max_bytes: int
+            Max size of buffered readings [byte], None if unlimited.
+        min_interval: float
+            Min flush interval [s], defaults to initial interval.
+        max_interval: float
+            Max flush interval [s], defaults to initial interval.
+        target_latency: float
+            Flush latency above which cloud service is considered congested [s].
+        increase_factor: float
+            Multiplicative interval increase on slow or failed flush.
+        decrease_step: float
+            Additive interval decrease on healthy flush [s].
+        '''
+        self.min_interval = interval if min_interval is None else min_interval
+        self.max_interval = interval if max_interval is None else max_interval
+        self.interval = min(max(interval, self.min_interval), self.max_interval)
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.target_latency = target_latency
+        self.increase_factor = increase_factor
+        self.decrease_step = decrease_step
+        self._items = 0
+        self._bytes = 0
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+
+    def add(self, size):
+        '''
+        Records newly buffered reading.
+
+        Parameters
+        ----------
+        size: int
+            Reading size [byte].
+
+        Returns
+        -------
+        '''
+        with self._lock:
+            self._items += 1
+            self._bytes += size
+
+    def due(self):
+        '''
+        Returns trigger that requires flush, if any.
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        trigger: str
+            Name of fired trigger, or None if flush is not due yet.
+        '''
+        with self._lock:
+            if self.max_items is not None and self._items >= self.max_items:
+                return trigger_items
+            if self.max_bytes is not None and self._bytes >= self.max_bytes:
+                return trigger_bytes
+            if time.monotonic() - self._last_flush >= self.interval:
+                return trigger_deadline
+            return None
+
+    def flushed(self):
+        '''
+        Resets buffered data counters after flush.
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        '''
+        with self._lock:
+            self._items = 0
+            self._bytes = 0
+            self._last_flush = time.monotonic()
+
+    def record(self, latency, success):
+        '''
+        Adapts flush interval to flush result.
+
+        Parameters
+        ----------
+        latency: float
+            Flush duration [s].
+        success: bool
+            Whether cloud service accepted flushed data.
+
+        Returns
+        -------
+        '''
+        with self._lock:
+            previous = self.interval
+            if not success or latency > self.target_latency:
+                self.interval = min(self.max_interval, self.interval * self.increase_factor)
+            else:
+                self.interval = max(self.min_interval, self.interval - self.decrease_step)
+            if self.interval != previous:
+                customLogger.debug("Flush interval changed from {:.1f}s to {:.1f}s".format(previous, self.interval))
+
+    def tick(self):
+        '''
+        Returns how often flush triggers should be checked.
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        tick: float
+            Time between two checks [s].
+        '''
+        # size triggers need frequent checks, deadline alone can be checked once per interval
+        if self.max_items is None and self.max_bytes is None:
+            return max(0.05, min(1.0, self.interval))
+        return max(0.05, min(0.2, self.min_interval / 10))
+
+    def time_to_deadline(self):
+        '''
+        Returns time until deadline trigger fires.
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        delay: float
+            Time [s], 0 if deadline has passed.
+        '''
+        with self._lock:
+            return max(0.0, self._last_flush + self.interval - time.monotonic())
+
+
+def create_flush_policy(conf, interval):
+    '''
+    Creates flush policy.
+
+    Without flush config, data is flushed strictly every interval, as before.
+
+    Parameters
+    ----------
+    conf: dict
+        Flush config. If None, interval is the only trigger and it does not adapt.
+    interval: float
+        Configured flush interval [s].
+
+    Returns
+    -------
+    policy: FlushPolicy
+    '''
+    if conf is None:
+        return FlushPolicy(interval)
+    return FlushPolicy(interval, conf.get(max_items), conf.get(max_bytes), conf.get(min_interval, interval),
+                       conf.get(max_interval, interval * 10), conf.get(target_latency, 1.0),
+                       conf.get(increase_factor, 2.0), conf.get(decrease_step, 1.0))
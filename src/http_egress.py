@@ -0,0 +1,587 @@
+'''
+http_egress
+============
+Module that contains HTTP client used for sending data to cloud services.
+
+Requests of one process reuse connections instead of opening new connection per request. Two protocols are
+supported:
+
+- HTTP/1.1 - requests session with connection pool, one connection per concurrent request.
+- HTTP/2 - single multiplexed connection per host shared by all concurrent requests, with HPACK header compression.
+  Requires optional h2 package (pip install h2). Plain http URLs use HTTP/2 prior knowledge (h2c), https URLs
+  negotiate HTTP/2 through ALPN. If h2 is not installed, HTTP/1.1 is used.
+
+Request body can be gzip compressed, if cloud services accept Content-Encoding: gzip. Every request is recorded by
+traffic module with its body size before and after compression, and its wire size. HTTP/2 request size is counted from frames written to
+connection. HTTP/2 response headers are counted decoded, so their size is upper bound of HPACK encoded size.
+
+HTTPS connections use TLS contexts from tls module, so new connections to cloud resume cached TLS session instead
+of doing full handshake. Connection can also be pre-warmed shortly before scheduled flush, so flush does not wait for
+TCP and TLS handshake.
+
+Repeated Authorization header is added to HPACK dynamic table, so after first request JWT costs only a few bytes per
+request. Generic HTTP/2 clients never index Authorization, to protect it from compression side channels when
+connection carries attacker controlled data - gateway connection carries only gateway's own requests.
+
+Classes
+---------
+Response
+    Response of HTTP/2 request.
+Http2Connection
+    Multiplexed HTTP/2 connection to single host.
+
+Functions
+---------
+configure(conf)
+    Sets HTTP client config of current process.
+post(url, payload, headers)
+    Sends JSON payload to cloud service.
+prewarm(url)
+    Opens connection to cloud service ahead of request.
+close()
+    Closes connections of current process.
+
+Constants
+---------
+protocol: str
+    Config key of HTTP protocol, "http/1.1" or "h2".
+timeout: str
+    Config key of request timeout in seconds. HTTP/2 requests use default_http2_timeout if it is not set.
+pool_size: str
+    Config key of max number of HTTP/1.1 connections per host.
+tls_conf: str
+    Config key of TLS config of HTTPS connections.
+prewarm_time: str
+    Config key of time in seconds before scheduled flush when connection is pre-warmed.
+compress: str
+    Config key of gzip request body compression switch, off by default.
+http1: str
+    HTTP/1.1 protocol name.
+http2: str
+    HTTP/2 protocol name.
+'''
+import gzip
+import json
+import socket
+import threading
+import time
+import urllib.parse
+import requests
+import requests.adapters
+import tls
+import traffic
+import tracing
+from requests.structures import CaseInsensitiveDict
+import logging.config
+
+try:
+    import h2.config
+    import h2.connection
+    import h2.events
+    import h2.exceptions
+except ImportError:
+    h2 = None
+
+logging.config.fileConfig('logging.conf')
+infoLogger = logging.getLogger('customInfoLogger')
+errorLogger = logging.getLogger('customErrorLogger')
+customLogger = logging.getLogger('customConsoleLogger')
+
+protocol = "protocol"
+timeout = "timeout"
+pool_size = "pool_size"
+tls_conf = "tls"
+prewarm_time = "prewarm"
+compress = "compress"
+
+http1 = "http/1.1"
+http2 = "h2"
+
+default_pool_size = 10
+# HTTP/2 requests share connection, so request without timeout would hold its stream forever [s]
+default_http2_timeout = 30.0
+# size of HTTP/2 frame header in bytes
+frame_header_size = 9
+
+# HTTP client config and clients of current process
+_conf = {}
+_session = None
+_connections = {}
+_clients_lock = threading.Lock()
+
+
+class Response:
+    '''
+    Response of HTTP/2 request.
+
+    Attributes
+    ---------
+    status_code: int
+        Http status code.
+    headers: requests.structures.CaseInsensitiveDict
+        Response headers.
+    content: bytes
+        Response body.
+    request_header_bytes: int
+        Size of request HEADERS frame and DATA frame headers in bytes.
+    response_bytes: int
+        Size of response frames in bytes.
+    '''
+    def __init__(self):
+        '''
+        Initializes empty Response object.
+        '''
+        self.status_code = None
+        self.headers = CaseInsensitiveDict()
+        self.content = b""
+        self.request_header_bytes = 0
+        self.response_bytes = 0
+        self._done = threading.Event()
+        self._error = None
+
+
+class _TlsAdapter(requests.adapters.HTTPAdapter):
+
+    def __init__(self, ssl_context, **kwargs):
+        self._ssl_context = ssl_context
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["ssl_context"] = self._ssl_context
+        super().init_poolmanager(*args, **kwargs)
+
+    # CA certificates are loaded into TLS context once, instead of on every new connection
+    def build_connection_pool_key_attributes(self, request, verify, cert=None):
+        host_params, pool_kwargs = super().build_connection_pool_key_attributes(request, verify, cert)
+        pool_kwargs.pop("ca_certs", None)
+        pool_kwargs.pop("ca_cert_dir", None)
+        return host_params, pool_kwargs
+
+    def cert_verify(self, conn, url, verify, cert):
+        super().cert_verify(conn, url, verify, cert)
+        conn.ca_certs = None
+        conn.ca_cert_dir = None
+
+
+class Http2Connection:
+    '''
+    Multiplexed HTTP/2 connection to single host.
+
+    Requests are written under lock, so stream ids are always increasing, and responses are read by background reader
+    thread, which completes waiting requests. Connection is re-established on first request after it was lost.
+
+    Attributes
+    ---------
+    scheme: str
+        URL scheme, http or https.
+    host: str
+        Host name.
+    port: int
+        Port.
+    timeout: float
+        Max time of whole request, flow control waits included [s].
+    tls_conf: dict
+        TLS config of https connection.
+
+    Methods
+    ---------
+    connect(self)
+        Establishes connection if it is not established.
+    post(self, path, body, headers)
+        Sends request and waits for response.
+    close(self)
+        Closes connection.
+    '''
+    def __init__(self, scheme, host, port, timeout=default_http2_timeout, tls_conf=None):
+        '''
+        Initializes Http2Connection object. Connection is established lazily.
+
+        Parameters
+        ----------
+        scheme: str
+            URL scheme, http or https.
+        host: str
+            Host name.
+        port: int
+            Port.
+        timeout: float
+            Max time of whole request, flow control waits included [s].
+        tls_conf: dict
+            TLS config of https connection, None for default verification.
+        '''
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.tls_conf = {} if tls_conf is None else tls_conf
+        self._lock = threading.Lock()
+        self._window_open = threading.Condition(self._lock)
+        self._socket = None
+        self._protocol = None
+        self._responses = {}
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        if self.scheme == "https":
+            sock = tls.client_context(self.tls_conf, ("h2",)).wrap_socket(sock, server_hostname=self.host)
+            if sock.selected_alpn_protocol() != "h2":
+                sock.close()
+                raise ConnectionError("Server does not support HTTP/2!")
+        sock.settimeout(None)
+        # outbound headers are normalized by caller, so Authorization is not forced to never-indexed representation
+        self._protocol = h2.connection.H2Connection(
+            config=h2.config.H2Configuration(client_side=True, normalize_outbound_headers=False))
+        self._protocol.initiate_connection()
+        sock.sendall(self._protocol.data_to_send())
+        self._socket = sock
+        threading.Thread(target=self._read, args=(sock, self._protocol), daemon=True).start()
+
+    def _read(self, sock, protocol):
+        error = None
+        while error is None:
+            try:
+                data = sock.recv(65536)
+                if not data:
+                    raise ConnectionError("Connection closed by server!")
+                with self._lock:
+                    events = protocol.receive_data(data)
+                    for event in events:
+                        self._handle(protocol, event)
+                    sock.sendall(protocol.data_to_send())
+            except (OSError, h2.exceptions.ProtocolError) as exception:
+                error = exception
+        with self._lock:
+            # requests waiting on lost connection fail, next request reconnects
+            if self._socket is sock:
+                self._socket = None
+                self._protocol = None
+            for response in self._responses.values():
+                response._error = error
+                response._done.set()
+            self._responses.clear()
+            self._window_open.notify_all()
+        sock.close()
+
+    def _handle(self, protocol, event):
+        if isinstance(event, h2.events.ResponseReceived):
+            response = self._responses.get(event.stream_id)
+            if response is not None:
+                response.response_bytes += frame_header_size
+                for name, value in event.headers:
+                    response.response_bytes += len(name) + len(value)
+                    name = name.decode("utf-8")
+                    if name == ":status":
+                        response.status_code = int(value)
+                    else:
+                        response.headers[name] = value.decode("utf-8")
+        elif isinstance(event, h2.events.DataReceived):
+            protocol.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+            response = self._responses.get(event.stream_id)
+            if response is not None:
+                response.content += event.data
+                response.response_bytes += frame_header_size + event.flow_controlled_length
+        elif isinstance(event, (h2.events.StreamEnded, h2.events.StreamReset)):
+            response = self._responses.pop(event.stream_id, None)
+            if response is not None:
+                if isinstance(event, h2.events.StreamReset):
+                    response._error = ConnectionError("Stream reset by server!")
+                response._done.set()
+        elif isinstance(event, h2.events.WindowUpdated):
+            self._window_open.notify_all()
+        elif isinstance(event, h2.events.ConnectionTerminated):
+            raise ConnectionError("Connection terminated by server!")
+
+    def connect(self):
+        '''
+        Establishes connection if it is not established.
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+
+        Raises
+        ------
+        OSError
+            If connection can not be established.
+        '''
+        with self._lock:
+            if self._socket is None:
+                self._connect()
+
+    def post(self, path, body, headers):
+        '''
+        Sends request and waits for response.
+
+        Parameters
+        ----------
+        path: str
+            Request path with query.
+        body: bytes
+            Request body.
+        headers: dict
+            Request headers.
+
+        Returns
+        -------
+        response: Response
+
+        Raises
+        ------
+        ConnectionError
+            If connection is lost or request times out.
+        '''
+        deadline = time.monotonic() + self.timeout
+        response = Response()
+        request_headers = [(":method", "POST"), (":scheme", self.scheme), (":authority", self.host + ":" +
+                                                                              str(self.port)),
+                           (":path", path), ("content-length", str(len(body)))]
+        request_headers += [(name.lower(), value) for name, value in headers.items()]
+        with self._lock:
+            if self._socket is None:
+                self._connect()
+            sock, protocol = self._socket, self._protocol
+            stream_id = protocol.get_next_available_stream_id()
+            self._responses[stream_id] = response
+            protocol.send_headers(stream_id, request_headers)
+            # everything written to connection while lock is held belongs to this request
+            sent = 0
+            offset = 0
+            while offset < len(body):
+                window = min(protocol.local_flow_control_window(stream_id), protocol.max_outbound_frame_size)
+                if window <= 0:
+                    data = protocol.data_to_send()
+                    sent += len(data)
+                    sock.sendall(data)
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        # peer that never opens window must not keep request, and its stream, forever
+                        self._responses.pop(stream_id, None)
+                        protocol.reset_stream(stream_id)
+                        sock.sendall(protocol.data_to_send())
+                        raise ConnectionError("HTTP/2 flow control window did not open in time!")
+                    self._window_open.wait(remaining)
+                    if self._socket is not sock:
+                        raise ConnectionError("Connection lost while sending request!")
+                    continue
+                protocol.send_data(stream_id, body[offset:offset + window])
+                offset += window
+            protocol.end_stream(stream_id)
+            data = protocol.data_to_send()
+            sock.sendall(data)
+            response.request_header_bytes = sent + len(data) - len(body)
+        if not response._done.wait(max(0.0, deadline - time.monotonic())):
+            with self._lock:
+                self._responses.pop(stream_id, None)
+                if self._socket is sock:
+                    protocol.reset_stream(stream_id)
+                    sock.sendall(protocol.data_to_send())
+            raise ConnectionError("HTTP/2 request timed out!")
+        if response._error is not None:
+            raise ConnectionError(str(response._error))
+        return response
+
+    def close(self):
+        '''
+        Closes connection.
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        '''
+        with self._lock:
+            if self._socket is not None:
+                try:
+                    self._protocol.close_connection()
+                    self._socket.sendall(self._protocol.data_to_send())
+                    self._socket.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                self._socket = None
+
+
+def configure(conf):
+    '''
+    Sets HTTP client config of current process and closes existing connections.
+
+    Parameters
+    ----------
+    conf: dict
+        HTTP client config. If None, HTTP/1.1 without request timeout is used.
+
+    Returns
+    -------
+    '''
+    close()
+    _conf.clear()
+    if conf is not None:
+        _conf.update(conf)
+    if _conf.get(protocol) == http2 and h2 is None:
+        errorLogger.error("HTTP/2 egress requires h2 package! Falling back to HTTP/1.1.")
+        customLogger.error("HTTP/2 egress requires h2 package! Falling back to HTTP/1.1.")
+
+
+def post(url, payload, headers):
+    '''
+    Sends JSON payload to cloud service over pooled (HTTP/1.1) or multiplexed (HTTP/2) connection.
+
+    Parameters
+    ----------
+    url: str
+        Cloud services' URL.
+    payload: dict or bytes
+        Request payload, or JSON text serialized earlier, which is sent as it is.
+    headers: dict
+        Request headers.
+
+    Returns
+    -------
+    response: requests.Response or Response
+        Response with status_code and headers attributes.
+
+    Raises
+    ------
+    requests.RequestException or ConnectionError
+        If cloud service can not be reached.
+    '''
+    if _conf.get(protocol) == http2 and h2 is not None:
+        connection, path = _http2_connection(url)
+        request_headers = {"content-type": "application/json"}
+        if _conf.get(compress, False):
+            request_headers["content-encoding"] = "gzip"
+        request_headers.update(headers)
+        with tracing.span("serialize"):
+            body = _serialize(payload)
+            wire_body = _compress(body)
+        try:
+            response = connection.post(path, wire_body, request_headers)
+        except Exception:
+            traffic.record(url, failed=True)
+            raise
+        traffic.record(url, len(body), len(wire_body), response.request_header_bytes, response.response_bytes,
+                       response.status_code // 100 != 2)
+        return response
+    with tracing.span("serialize"):
+        body = _serialize(payload)
+        wire_body = _compress(body)
+    request_headers = {"Content-Type": "application/json"}
+    if _conf.get(compress, False):
+        request_headers["Content-Encoding"] = "gzip"
+    request_headers.update(headers)
+    try:
+        response = _http1_session().post(url, data=wire_body, headers=request_headers, timeout=_conf.get(timeout))
+    except Exception:
+        traffic.record(url, failed=True)
+        raise
+    header_bytes, response_bytes = traffic.http1_sizes(response)
+    traffic.record(url, len(body), len(wire_body), header_bytes, response_bytes, response.status_code // 100 != 2)
+    return response
+
+
+def prewarm(url):
+    '''
+    Opens connection to cloud service ahead of request, so request does not wait for TCP and TLS handshake.
+
+    Does nothing if idle connection to cloud service already exists. Errors are only logged, request opens connection
+    again if pre-warming failed.
+
+    Parameters
+    ----------
+    url: str
+        Cloud services' URL.
+
+    Returns
+    -------
+    '''
+    try:
+        if _conf.get(protocol) == http2 and h2 is not None:
+            _http2_connection(url)[0].connect()
+            return
+        session = _http1_session()
+        adapter = session.get_adapter(url)
+        # pool is selected the same way requests selects it, including settings from environment
+        settings = session.merge_environment_settings(url, {}, None, None, None)
+        if hasattr(adapter, "get_connection_with_tls_context"):
+            pool = adapter.get_connection_with_tls_context(requests.Request("POST", url).prepare(),
+                                                           settings["verify"], settings["proxies"],
+                                                           settings["cert"])
+        else:
+            pool = adapter.get_connection(url, settings["proxies"])
+        # urllib3 pool has no public API for opening connection without request
+        connection = pool._get_conn()
+        try:
+            if getattr(connection, "sock", None) is None:
+                connection.timeout = _conf.get(timeout)
+                connection.connect()
+                tls.settle(connection.sock)
+        finally:
+            pool._put_conn(connection)
+    except Exception as error:
+        errorLogger.error("Pre-warming connection to " + url + " failed! - " + str(error))
+
+
+# body is encoded the same way requests encodes json argument, so that serialization is timed on its own
+def _serialize(payload):
+    if isinstance(payload, bytes):
+        return payload
+    return json.dumps(payload, allow_nan=False).encode("utf-8")
+
+
+def _compress(body):
+    return gzip.compress(body) if _conf.get(compress, False) else body
+
+
+def _http2_connection(url):
+    parts = urllib.parse.urlsplit(url)
+    port = parts.port or (443 if parts.scheme == "https" else 80)
+    key = (parts.scheme, parts.hostname, port)
+    with _clients_lock:
+        connection = _connections.get(key)
+        if connection is None:
+            connection = Http2Connection(parts.scheme, parts.hostname, port,
+                                         _conf.get(timeout) or default_http2_timeout, _conf.get(tls_conf))
+            _connections[key] = connection
+    return connection, parts.path + ("?" + parts.query if parts.query else "")
+
+
+def _http1_session():
+    global _session
+    with _clients_lock:
+        if _session is None:
+            _session = requests.Session()
+            size = _conf.get(pool_size, default_pool_size)
+            _session.mount("http://", requests.adapters.HTTPAdapter(pool_connections=size, pool_maxsize=size))
+            conf = _conf.get(tls_conf)
+            if conf is None:
+                _session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=size, pool_maxsize=size))
+            else:
+                _session.mount("https://", _TlsAdapter(tls.client_context(conf), pool_connections=size,
+                                                       pool_maxsize=size))
+                if conf.get(tls.insecure, False):
+                    _session.verify = False
+                elif conf.get(tls.ca_certs) is not None:
+                    _session.verify = conf[tls.ca_certs]
+        return _session
+
+
+def close():
+    '''
+    Closes connections of current process.
+
+    Parameters
+    ----------
+
+    Returns
+    -------
+    '''
+    global _session
+    with _clients_lock:
+        if _session is not None:
+            _session.close()
+            _session = None
+        for connection in _connections.values():
+            connection.close()
+        _connections.clear()
@@ -0,0 +1,958 @@
+'''
+metrics
+============
+Module that exposes live gateway metrics over local HTTP endpoint, in OpenMetrics or Prometheus text format.
+
+Every data handler owns shared memory block with its hot path metrics - ingest rate, parse errors, buffer depths, flush
+latency histogram, egress status codes, sensor sequence anomalies, sensor-to-cloud latency histogram, and loop stalls
+and scheduling lag detected by watchdog. Handler writes block directly, without IPC and without locking on MQTT message
+path, and main process reads all blocks when metrics are scraped. Endpoint also exposes traffic and retry
+counters published by stats_service.SharedCounters, resident memory of every gateway process and worker restarts.
+The same endpoint serves local admin requests that start and stop profiler.
+
+Block is array of int64 values. Every value is aligned and written by single thread, so reader never sees torn value.
+Values of one block are not read as atomic snapshot, e.g. histogram count can be ahead of its buckets by observation
+that is being recorded.
+
+Classes
+---------
+StreamMetrics
+    Shared memory block with hot path metrics of single data handler.
+MetricsServer
+    Local HTTP endpoint serving metrics of all data handlers.
+
+Functions
+---------
+configure(stream_metrics)
+    Sets metrics block of current process.
+ingest(size)
+    Counts received MQTT message.
+parse_error()
+    Counts sensor reading that can not be parsed.
+response(code)
+    Counts result of request to cloud service.
+flushed(latency, success)
+    Records flush of collected data.
+buffer_depth(readings, outbox_pending)
+    Sets current depth of data handler's buffers.
+sequence(gaps, duplicates, reorders, restarts)
+    Counts anomalies of sensor reading sequence.
+delivered(latencies)
+    Records sensor-to-cloud latencies of delivered readings.
+scheduling_lag(lag)
+    Records wake-up lag of watchdog thread.
+loop_progress(loop, overdue, stalled)
+    Records state of loop watched by watchdog.
+process_rss(pid)
+    Returns resident memory of process.
+create_metrics_server(conf, stream_metrics, stats_counters, workers, processes)
+    Creates and starts metrics server based on metrics config.
+
+Constants
+---------
+address: str
+    Config key of address endpoint listens on.
+port: str
+    Config key of port endpoint listens on.
+flush_buckets: tuple
+    Upper bounds of flush latency histogram buckets [s].
+latency_buckets: tuple
+    Upper bounds of sensor-to-cloud latency histogram buckets [s].
+lag_buckets: tuple
+    Upper bounds of scheduling lag histogram buckets [s].
+code_classes: tuple
+    Label values of egress status code counters.
+watched_loops: tuple
+    Label values of metrics of loops watched by watchdog.
+'''
+import os
+import json
+import threading
+import http.server
+import urllib.parse
+import profiler
+from multiprocessing import shared_memory
+import logging.config
+
+logging.config.fileConfig('logging.conf')
+infoLogger = logging.getLogger('customInfoLogger')
+errorLogger = logging.getLogger('customErrorLogger')
+customLogger = logging.getLogger('customConsoleLogger')
+
+address = "address"
+port = "port"
+
+default_address = "127.0.0.1"
+default_port = 9108
+flush_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+latency_buckets = (0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 900.0, 3600.0)
+lag_buckets = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+code_classes = ("2xx", "3xx", "4xx", "5xx", "error")
+watched_loops = ("handler", "mqtt")
+
+openmetrics_type = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+prometheus_type = "text/plain; version=0.0.4; charset=utf-8"
+
+# layout of shared memory block
+_ingest_messages = 0
+_ingest_bytes = 1
+_parse_errors = 2
+_buffer_readings = 3
+_outbox_pending = 4
+_flushes = 5
+_flush_failures = 6
+_flush_sum_us = 7
+_flush_buckets = 8
+_responses = _flush_buckets + len(flush_buckets)
+_sequence_gaps = _responses + len(code_classes)
+_sequence_duplicates = _sequence_gaps + 1
+_sequence_reorders = _sequence_gaps + 2
+_sequence_restarts = _sequence_gaps + 3
+_delivered = _sequence_gaps + 4
+_latency_sum_us = _sequence_gaps + 5
+_latency_buckets = _sequence_gaps + 6
+_lags = _latency_buckets + len(latency_buckets)
+_lag_sum_us = _lags + 1
+_lag_buckets = _lags + 2
+_loop_stalls = _lag_buckets + len(lag_buckets)
+_loop_overdue_us = _loop_stalls + len(watched_loops)
+_slots = _loop_overdue_us + len(watched_loops)
+
+# metrics block of current process
+_current = None
+
+
+class StreamMetrics:
+    '''
+    Shared memory block with hot path metrics of single data handler.
+
+    Block is created by main process and passed to data handler process as process argument, and every process
+    attaches it on unpickling. MQTT message counters are written only by MQTT network thread and watchdog metrics only
+    by watchdog thread, so they are updated without lock. Other metrics can be recorded by several threads of handler
+    and are updated under process-local lock.
+
+    Attributes
+    ---------
+    name: str
+        Shared memory block name.
+
+    Methods
+    ---------
+    ingest(self, size)
+        Counts received MQTT message.
+    parse_error(self)
+        Counts sensor reading that can not be parsed.
+    response(self, code)
+        Counts result of request to cloud service.
+    flushed(self, latency, success)
+        Records flush of collected data.
+    buffer_depth(self, readings, outbox_pending)
+        Sets current depth of data handler's buffers.
+    sequence(self, gaps, duplicates, reorders, restarts)
+        Counts anomalies of sensor reading sequence.
+    delivered(self, latencies)
+        Records sensor-to-cloud latencies of delivered readings.
+    scheduling_lag(self, lag)
+        Records wake-up lag of watchdog thread.
+    loop_progress(self, loop, overdue, stalled)
+        Records state of loop watched by watchdog.
+    snapshot(self)
+        Returns current metric values.
+    close(self)
+        Detaches shared memory block from current process.
+    unlink(self)
+        Frees shared memory block.
+    '''
+    def __init__(self, name=None):
+        '''
+        Initializes StreamMetrics object.
+
+        Parameters
+        ----------
+        name: str
+            Name of existing block to attach, new zeroed block is created if None.
+        '''
+        size = _slots * 8
+        if name is None:
+            self._memory = shared_memory.SharedMemory(create=True, size=size)
+            self._memory.buf[:size] = bytes(size)
+        else:
+            self._memory = shared_memory.SharedMemory(name=name)
+        self.name = self._memory.name
+        self._values = self._memory.buf[:size].cast("q")
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        return {"name": self.name}
+
+    def __setstate__(self, state):
+        self.__init__(state["name"])
+
+    def __del__(self):
+        # view of block must be released before block is closed on garbage collection
+        if hasattr(self, "_values"):
+            self._values.release()
+
+    def ingest(self, size):
+        '''
+        Counts received MQTT message. Must be called only by MQTT network thread.
+
+        Parameters
+        ----------
+        size: int
+            Message payload size in bytes.
+
+        Returns
+        -------
+        '''
+        values = self._values
+        values[_ingest_messages] += 1
+        values[_ingest_bytes] += size
+
+    def parse_error(self):
+        '''
+        Counts sensor reading that can not be parsed.
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        '''
+        with self._lock:
+            self._values[_parse_errors] += 1
+
+    def response(self, code):
+        '''
+        Counts result of request to cloud service.
+
+        Parameters
+        ----------
+        code: int
+            Http status code, None if cloud service could not be reached.
+
+        Returns
+        -------
+        '''
+        index = len(code_classes) - 1 if code is None or not 200 <= code < 600 else code // 100 - 2
+        with self._lock:
+            self._values[_responses + index] += 1
+
+    def flushed(self, latency, success):
+        '''
+        Records flush of collected data.
+
+        Parameters
+        ----------
+        latency: float
+            Time flush took [s].
+        success: bool
+            Whether data was delivered.
+
+        Returns
+        -------
+        '''
+        with self._lock:
+            values = self._values
+            for index, bound in enumerate(flush_buckets):
+                if latency <= bound:
+                    values[_flush_buckets + index] += 1
+                    break
+            values[_flush_sum_us] += int(latency * 1e6)
+            values[_flush_failures] += 0 if success else 1
+            values[_flushes] += 1
+
+    def buffer_depth(self, readings, outbox_pending=None):
+        '''
+        Sets current depth of data handler's buffers.
+
+        Parameters
+        ----------
+        readings: int
+            Number of collected readings waiting for flush.
+        outbox_pending: int
+            Number of payloads in outbox that are not delivered, None to keep previous value.
+
+        Returns
+        -------
+        '''
+        self._values[_buffer_readings] = readings
+        if outbox_pending is not None:
+            self._values[_outbox_pending] = outbox_pending
+
+    def sequence(self, gaps, duplicates, reorders, restarts):
+        '''
+        Counts anomalies of sensor reading sequence. Must be called only by MQTT network thread.
+
+        Parameters
+        ----------
+        gaps: int
+            Number of readings skipped in sequence.
+        duplicates: int
+            Number of readings received again.
+        reorders: int
+            Number of skipped readings that arrived late.
+        restarts: int
+            Number of sequence restarts.
+
+        Returns
+        -------
+        '''
+        values = self._values
+        values[_sequence_gaps] += gaps
+        values[_sequence_duplicates] += duplicates
+        values[_sequence_reorders] += reorders
+        values[_sequence_restarts] += restarts
+
+    def delivered(self, latencies):
+        '''
+        Records sensor-to-cloud latencies of delivered readings.
+
+        Parameters
+        ----------
+        latencies: list
+            Time from sending of reading by sensor until its data was delivered to cloud [s], for every reading.
+
+        Returns
+        -------
+        '''
+        counts = [0] * len(latency_buckets)
+        total = 0
+        for latency in latencies:
+            for index, bound in enumerate(latency_buckets):
+                if latency <= bound:
+                    counts[index] += 1
+                    break
+            total += int(latency * 1e6)
+        with self._lock:
+            values = self._values
+            for index, count in enumerate(counts):
+                values[_latency_buckets + index] += count
+            values[_latency_sum_us] += total
+            values[_delivered] += len(latencies)
+
+    def scheduling_lag(self, lag):
+        '''
+        Records wake-up lag of watchdog thread. Must be called only by watchdog thread.
+
+        Parameters
+        ----------
+        lag: float
+            Time watchdog thread woke up after it was due [s].
+
+        Returns
+        -------
+        '''
+        values = self._values
+        for index, bound in enumerate(lag_buckets):
+            if lag <= bound:
+                values[_lag_buckets + index] += 1
+                break
+        values[_lag_sum_us] += int(max(0.0, lag) * 1e6)
+        values[_lags] += 1
+
+    def loop_progress(self, loop, overdue, stalled):
+        '''
+        Records state of loop watched by watchdog. Must be called only by watchdog thread.
+
+        Parameters
+        ----------
+        loop: str
+            Loop name, loops not listed in watched_loops are ignored.
+        overdue: float
+            Time since loop was due to make progress [s], 0 if it is on time.
+        stalled: bool
+            Whether new stall of loop is detected.
+
+        Returns
+        -------
+        '''
+        if loop not in watched_loops:
+            return
+        index = watched_loops.index(loop)
+        values = self._values
+        values[_loop_overdue_us + index] = int(overdue * 1e6)
+        values[_loop_stalls + index] += 1 if stalled else 0
+
+    def snapshot(self):
+        '''
+        Returns current metric values.
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        snapshot: dict
+            Metric values by name. Latency histograms are cumulative counts of every bucket bound.
+        '''
+        values = self._values.tolist()
+        buckets = []
+        count = 0
+        for index, bound in enumerate(flush_buckets):
+            count += values[_flush_buckets + index]
+            buckets.append((bound, count))
+        latency = []
+        count = 0
+        for index, bound in enumerate(latency_buckets):
+            count += values[_latency_buckets + index]
+            latency.append((bound, count))
+        lag = []
+        count = 0
+        for index, bound in enumerate(lag_buckets):
+            count += values[_lag_buckets + index]
+            lag.append((bound, count))
+        return {"ingest_messages": values[_ingest_messages], "ingest_bytes": values[_ingest_bytes],
+                "parse_errors": values[_parse_errors], "buffer_readings": values[_buffer_readings],
+                "outbox_pending": values[_outbox_pending], "flushes": values[_flushes],
+                "flush_failures": values[_flush_failures], "flush_sum": values[_flush_sum_us] / 1e6,
+                "flush_buckets": buckets,
+                "responses": dict(zip(code_classes, values[_responses:_responses + len(code_classes)])),
+                "sequence_gaps": values[_sequence_gaps], "sequence_duplicates": values[_sequence_duplicates],
+                "sequence_reorders": values[_sequence_reorders], "sequence_restarts": values[_sequence_restarts],
+                "delivered": values[_delivered], "latency_sum": values[_latency_sum_us] / 1e6,
+                "latency_buckets": latency, "lags": values[_lags], "lag_sum": values[_lag_sum_us] / 1e6,
+                "lag_buckets": lag,
+                "loop_stalls": dict(zip(watched_loops, values[_loop_stalls:_loop_stalls + len(watched_loops)])),
+                "loop_overdue": {loop: values[_loop_overdue_us + index] / 1e6
+                                 for index, loop in enumerate(watched_loops)}}
+
+    def close(self):
+        '''
+        Detaches shared memory block from current process.
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        '''
+        self._values.release()
+        self._memory.close()
+
+    def unlink(self):
+        '''
+        Frees shared memory block. Must be called once, by process that created block.
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        '''
+        self._memory.unlink()
+
+
+class _Family:
+
+    def __init__(self, name, kind, description):
+        self.name = name
+        self.kind = kind
+        self.description = description
+        self.samples = []
+
+    def add(self, labels, value, suffix=""):
+        self.samples.append((suffix, labels, value))
+
+    def render(self, openmetrics):
+        # Prometheus text format names counter family with _total suffix, OpenMetrics without it
+        family = self.name if openmetrics or self.kind != "counter" else self.name + "_total"
+        lines = ["# HELP {} {}".format(family, self.description), "# TYPE {} {}".format(family, self.kind)]
+        for suffix, labels, value in self.samples:
+            text = ",".join('{}="{}"'.format(key, str(label).replace("\\", "\\\\").replace('"', '\\"'))
+                            for key, label in labels.items())
+            lines.append("{}{}{} {}".format(self.name, suffix, "{" + text + "}" if text else "", _number(value)))
+        return lines
+
+
+def _number(value):
+    if isinstance(value, float):
+        if value == float("inf"):
+            return "+Inf"
+        return repr(value)
+    return str(value)
+
+
+class MetricsServer:
+    '''
+    Local HTTP endpoint serving metrics of all data handlers.
+
+    Metrics are served on GET of every path. Response is in OpenMetrics format if scraper accepts it, in Prometheus
+    text format otherwise. POST /profile?duration=<s>&rate=<Hz> starts profiling of all gateway processes, and
+    POST /profile/stop stops it.
+
+    Attributes
+    ---------
+    address: str
+        Address endpoint listens on.
+    port: int
+        Port endpoint listens on.
+    stream_metrics: dict
+        StreamMetrics by stream name.
+    stats_counters: dict
+        stats_service.SharedCounters by stream name.
+    workers: list
+        Supervised data handlers.
+    processes: dict
+        Other gateway processes by name.
+
+    Methods
+    ---------
+    start(self)
+        Starts serving metrics.
+    stop(self)
+        Stops serving metrics.
+    render(self, openmetrics)
+        Returns current metrics in text exposition format.
+    '''
+    def __init__(self, stream_metrics, stats_counters, workers=(), processes=None, address=default_address,
+                 port=default_port):
+        '''
+        Initializes MetricsServer object.
+
+        Parameters
+        ----------
+        stream_metrics: dict
+            StreamMetrics by stream name.
+        stats_counters: dict
+            stats_service.SharedCounters by stream name.
+        workers: list
+            Supervised data handlers, supervisor.Worker objects.
+        processes: dict
+            Other gateway processes by name, multiprocessing.Process objects.
+        address: str
+            Address endpoint listens on.
+        port: int
+            Port endpoint listens on, 0 for any free port.
+        '''
+        self.address = address
+        self.port = port
+        self.stream_metrics = stream_metrics
+        self.stats_counters = stats_counters
+        self.workers = list(workers)
+        self.processes = {} if processes is None else processes
+        self._server = None
+        self._thread = None
+
+    def start(self):
+        '''
+        Starts serving metrics.
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+
+        Raises
+        ------
+        OSError
+            If address can not be bound.
+        '''
+        self._server = http.server.ThreadingHTTPServer((self.address, self.port), _handler(self))
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        infoLogger.info("Serving metrics on http://{}:{}/metrics".format(self.address, self.port))
+
+    def stop(self):
+        '''
+        Stops serving metrics.
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        '''
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._thread.join()
+            self._server = None
+
+    def render(self, openmetrics=True):
+        '''
+        Returns current metrics in text exposition format.
+
+        Parameters
+        ----------
+        openmetrics: bool
+            Whether OpenMetrics format is used instead of Prometheus text format.
+
+        Returns
+        -------
+        text: str
+        '''
+        families = {}
+
+        def family(name, kind, description):
+            if name not in families:
+                families[name] = _Family(name, kind, description)
+            return families[name]
+
+        for stream, block in self.stream_metrics.items():
+            values = block.snapshot()
+            labels = {"stream": stream}
+            family("gateway_ingest_messages", "counter", "Received MQTT messages.").add(
+                labels, values["ingest_messages"], "_total")
+            family("gateway_ingest_bytes", "counter", "Received MQTT payload bytes.").add(
+                labels, values["ingest_bytes"], "_total")
+            family("gateway_parse_errors", "counter", "Sensor readings that can not be parsed.").add(
+                labels, values["parse_errors"], "_total")
+            family("gateway_buffer_readings", "gauge", "Collected readings waiting for flush.").add(
+                labels, values["buffer_readings"])
+            family("gateway_outbox_pending", "gauge", "Outbox payloads that are not delivered.").add(
+                labels, values["outbox_pending"])
+            family("gateway_flush_failures", "counter", "Flushes that did not deliver data.").add(
+                labels, values["flush_failures"], "_total")
+            histogram = family("gateway_flush_duration_seconds", "histogram", "Time taken by flush of collected data.")
+            for bound, count in values["flush_buckets"]:
+                histogram.add(dict(labels, le=_number(float(bound))), count, "_bucket")
+            histogram.add(dict(labels, le="+Inf"), values["flushes"], "_bucket")
+            histogram.add(labels, values["flushes"], "_count")
+            histogram.add(labels, values["flush_sum"], "_sum")
+            responses = family("gateway_egress_responses", "counter",
+                               "Results of requests to cloud services by status code class.")
+            for code, count in values["responses"].items():
+                responses.add(dict(labels, code=code), count, "_total")
+            family("gateway_sequence_gaps", "counter",
+                   "Readings skipped in sensor sequence, late arrivals included.").add(
+                labels, values["sequence_gaps"], "_total")
+            family("gateway_sequence_duplicates", "counter", "Readings received more than once.").add(
+                labels, values["sequence_duplicates"], "_total")
+            family("gateway_sequence_reorders", "counter", "Skipped readings that arrived late.").add(
+                labels, values["sequence_reorders"], "_total")
+            family("gateway_sequence_restarts", "counter", "Restarts of sensor sequence.").add(
+                labels, values["sequence_restarts"], "_total")
+            histogram = family("gateway_reading_latency_seconds", "histogram",
+                               "Time from sending of reading by sensor until its data was delivered to cloud.")
+            for bound, count in values["latency_buckets"]:
+                histogram.add(dict(labels, le=_number(float(bound))), count, "_bucket")
+            histogram.add(dict(labels, le="+Inf"), values["delivered"], "_bucket")
+            histogram.add(labels, values["delivered"], "_count")
+            histogram.add(labels, values["latency_sum"], "_sum")
+            histogram = family("gateway_scheduling_lag_seconds", "histogram",
+                               "Time watchdog thread of data handler woke up after it was due.")
+            for bound, count in values["lag_buckets"]:
+                histogram.add(dict(labels, le=_number(float(bound))), count, "_bucket")
+            histogram.add(dict(labels, le="+Inf"), values["lags"], "_bucket")
+            histogram.add(labels, values["lags"], "_count")
+            histogram.add(labels, values["lag_sum"], "_sum")
+            stalls = family("gateway_loop_stalls", "counter", "Stalls of data handler loops detected by watchdog.")
+            for loop, count in values["loop_stalls"].items():
+                stalls.add(dict(labels, loop=loop), count, "_total")
+            overdue = family("gateway_loop_overdue_seconds", "gauge",
+                             "Time since data handler loop was due to make progress, 0 while it is on time.")
+            for loop, seconds in values["loop_overdue"].items():
+                overdue.add(dict(labels, loop=loop), seconds)
+        for stream, counters in self.stats_counters.items():
+            values = counters.snapshot()
+            labels = {"stream": stream}
+            family("gateway_egress_requests", "counter", "Requests to cloud services, retries included.").add(
+                labels, values["dataRequests"], "_total")
+            family("gateway_egress_retries", "counter", "Requests repeated after failed request to endpoint.").add(
+                labels, values["retries"], "_total")
+            family("gateway_egress_failures", "counter", "Failed requests to cloud services.").add(
+                labels, values["failures"], "_total")
+            family("gateway_egress_bytes", "counter", "Bytes sent to cloud services, headers included.").add(
+                labels, values["dataBytesForwarded"], "_total")
+            family("gateway_retry_buffer_bytes", "gauge", "Memory used by retry buffer.").add(
+                labels, values["bufferBytes"])
+        rss = family("gateway_process_resident_memory_bytes", "gauge", "Resident memory of gateway process.")
+        restarts = family("gateway_worker_restarts", "counter", "Restarts of supervised worker.")
+        processes = [("main", os.getpid())]
+        for worker in self.workers:
+            restarts.add({"worker": worker.name}, worker.restarts, "_total")
+            if worker.process is not None and worker.process.pid is not None:
+                processes.append((worker.name, worker.process.pid))
+        processes += [(name, process.pid) for name, process in self.processes.items() if process.pid is not None]
+        for name, pid in processes:
+            memory = process_rss(pid)
+            if memory is not None:
+                rss.add({"worker": name}, memory)
+        lines = []
+        for metric_family in families.values():
+            lines += metric_family.render(openmetrics)
+        if openmetrics:
+            lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+
+def _handler(server):
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            openmetrics = "application/openmetrics-text" in self.headers.get("Accept", "")
+            try:
+                body = server.render(openmetrics).encode("utf-8")
+            except Exception:
+                errorLogger.exception("Metrics can not be collected!")
+                self.send_error(500)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", openmetrics_type if openmetrics else prometheus_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            url = urllib.parse.urlsplit(self.path)
+            query = urllib.parse.parse_qs(url.query)
+            try:
+                if url.path == "/profile":
+                    result = profiler.request(*(float(query[key][0]) if key in query else None
+                                                for key in ("duration", "rate")))
+                elif url.path == "/profile/stop":
+                    result = profiler.request_stop()
+                else:
+                    self.send_error(404)
+                    return
+            except ValueError:
+                self.send_error(400)
+                return
+            # profiler is not enabled by config
+            if result is None:
+                self.send_error(404)
+                return
+            body = json.dumps(result).encode("utf-8")
+            self.send_response(202)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def configure(stream_metrics):
+    '''
+    Sets metrics block of current process.
+
+    Parameters
+    ----------
+    stream_metrics: StreamMetrics
+        Metrics block of data handler, None if metrics are not collected.
+
+    Returns
+    -------
+    '''
+    global _current
+    _current = stream_metrics
+
+
+def ingest(size):
+    '''
+    Counts received MQTT message. Must be called only by MQTT network thread.
+
+    Parameters
+    ----------
+    size: int
+        Message payload size in bytes.
+
+    Returns
+    -------
+    '''
+    if _current is not None:
+        _current.ingest(size)
+
+
+def parse_error():
+    '''
+    Counts sensor reading that can not be parsed.
+
+    Parameters
+    ----------
+
+    Returns
+    -------
+    '''
+    if _current is not None:
+        _current.parse_error()
+
+
+def response(code):
+    '''
+    Counts result of request to cloud service.
+
+    Parameters
+    ----------
+    code: int
+        Http status code, None if cloud service could not be reached.
+
+    Returns
+    -------
+    '''
+    if _current is not None:
+        _current.response(code)
+
+
+def flushed(latency, success):
+    '''
+    Records flush of collected data.
+
+    Parameters
+    ----------
+    latency: float
+        Time flush took [s].
+    success: bool
+        Whether data was delivered.
+
+    Returns
+    -------
+    '''
+    if _current is not None:
+        _current.flushed(latency, success)
+
+
+def buffer_depth(readings, outbox_pending=None):
+    '''
+    Sets current depth of data handler's buffers.
+
+    Parameters
+    ----------
+    readings: int
+        Number of collected readings waiting for flush.
+    outbox_pending: int
+        Number of payloads in outbox that are not delivered, None to keep previous value.
+
+    Returns
+    -------
+    '''
+    if _current is not None:
+        _current.buffer_depth(readings, outbox_pending)
+
+
+def sequence(gaps, duplicates, reorders, restarts):
+    '''
+    Counts anomalies of sensor reading sequence. Must be called only by MQTT network thread.
+
+    Parameters
+    ----------
+    gaps: int
+        Number of readings skipped in sequence.
+    duplicates: int
+        Number of readings received again.
+    reorders: int
+        Number of skipped readings that arrived late.
+    restarts: int
+        Number of sequence restarts.
+
+    Returns
+    -------
+    '''
+    if _current is not None:
+        _current.sequence(gaps, duplicates, reorders, restarts)
+
+
+def delivered(latencies):
+    '''
+    Records sensor-to-cloud latencies of delivered readings.
+
+    Parameters
+    ----------
+    latencies: list
+        Time from sending of reading by sensor until its data was delivered to cloud [s], for every reading.
+
+    Returns
+    -------
+    '''
+    if _current is not None and len(latencies) > 0:
+        _current.delivered(latencies)
+
+
+def scheduling_lag(lag):
+    '''
+    Records wake-up lag of watchdog thread. Must be called only by watchdog thread.
+
+    Parameters
+    ----------
+    lag: float
+        Time watchdog thread woke up after it was due [s].
+
+    Returns
+    -------
+    '''
+    if _current is not None:
+        _current.scheduling_lag(lag)
+
+
+def loop_progress(loop, overdue, stalled):
+    '''
+    Records state of loop watched by watchdog. Must be called only by watchdog thread.
+
+    Parameters
+    ----------
+    loop: str
+        Loop name, loops not listed in watched_loops are ignored.
+    overdue: float
+        Time since loop was due to make progress [s], 0 if it is on time.
+    stalled: bool
+        Whether new stall of loop is detected.
+
+    Returns
+    -------
+    '''
+    if _current is not None:
+        _current.loop_progress(loop, overdue, stalled)
+
+
+def process_rss(pid):
+    '''
+    Returns resident memory of process.
+
+    Parameters
+    ----------
+    pid: int
+        Process id.
+
+    Returns
+    -------
+    rss: int
+        Resident memory in bytes, None if it can not be read.
+    '''
+    try:
+        with open("/proc/{}/statm".format(pid)) as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def create_metrics_server(conf, stream_metrics, stats_counters, workers=(), processes=None):
+    '''
+    Creates and starts metrics server.
+
+    Parameters
+    ----------
+    conf: dict
+        Metrics config. If None, metrics are not served.
+    stream_metrics: dict
+        StreamMetrics by stream name.
+    stats_counters: dict
+        stats_service.SharedCounters by stream name.
+    workers: list
+        Supervised data handlers.
+    processes: dict
+        Other gateway processes by name.
+
+    Returns
+    -------
+    server: MetricsServer
+        Started server, or None if metrics config is None or endpoint can not be started.
+    '''
+    if conf is None:
+        return None
+    server = MetricsServer(stream_metrics, stats_counters, workers, processes, conf.get(address, default_address),
+                           conf.get(port, default_port))
+    try:
+        server.start()
+    except OSError as error:
+        errorLogger.error("Metrics endpoint can not be started! - " + str(error))
+        customLogger.error("Metrics endpoint can not be started!")
+        return None
+    return server
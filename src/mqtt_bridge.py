@@ -0,0 +1,279 @@
+'''
+mqtt_bridge
+============
+Module that contains MQTT upstream bridge, alternative transport for delivering data to cloud services.
+
+Instead of sending every payload as separate HTTP POST request, selected data streams are published to cloud MQTT
+broker over single long-lived connection. Session is persistent (clean start disabled, session expiry set), so
+unacknowledged QoS 1/2 messages survive short reconnects. Bridge has its own QoS, batch size and stream to topic
+mapping - backlog of stream can be published as JSON array of up to batch size payloads in single message. With TLS
+enabled, reconnects resume cached TLS session.
+
+Classes
+---------
+MqttBridge
+    Persistent MQTT connection to cloud broker.
+
+Functions
+---------
+upstream_config(conf, stream_urls, device)
+    Creates bridge config with routes of data streams that are delivered over MQTT.
+create_bridge(conf, client_id)
+    Creates MQTT bridge based on bridge config.
+
+Constants
+---------
+address: str
+    Config key of cloud broker address.
+port: str
+    Config key of cloud broker port.
+username: str
+    Config key of cloud broker username.
+password: str
+    Config key of cloud broker password.
+qos: str
+    Config key of upstream quality of service.
+batch_size: str
+    Config key of max number of payloads published in single message.
+keepalive: str
+    Config key of MQTT keepalive in seconds.
+session_expiry: str
+    Config key of persistent session expiry in seconds.
+publish_timeout: str
+    Config key of max time in seconds bridge waits for connection or publish acknowledgement.
+streams: str
+    Config key of data streams delivered over MQTT and their topics.
+tls_conf: str
+    Config key of TLS config of cloud broker connection.
+routes: str
+    Key of cloud service URL to topic mapping in bridge config.
+'''
+import json
+import threading
+import logging.config
+import tls
+import traffic
+import paho.mqtt.client as mqtt
+from paho.mqtt.properties import Properties
+from paho.mqtt.packettypes import PacketTypes
+
+logging.config.fileConfig('logging.conf')
+infoLogger = logging.getLogger('customInfoLogger')
+errorLogger = logging.getLogger('customErrorLogger')
+customLogger = logging.getLogger('customConsoleLogger')
+
+address = "address"
+port = "port"
+username = "username"
+password = "password"
+qos = "qos"
+batch_size = "batch_size"
+keepalive = "keepalive"
+session_expiry = "session_expiry"
+publish_timeout = "publish_timeout"
+streams = "streams"
+tls_conf = "tls"
+routes = "routes"
+
+default_port = 1883
+default_qos = 1
+default_batch_size = 1
+default_keepalive = 60
+default_session_expiry = 3600
+default_publish_timeout = 10.0
+
+http_ok = 200
+http_service_unavailable = 503
+
+
+class MqttBridge:
+    '''
+    Persistent MQTT connection to cloud broker.
+
+    Connection is established in background and re-established automatically by paho network thread.
+
+    Attributes
+    ---------
+    routes: dict
+        Topic of every cloud service URL delivered over MQTT.
+    qos: int
+        Upstream quality of service.
+    batch_size: int
+        Max number of payloads published in single message.
+    timeout: float
+        Max time bridge waits for connection or publish acknowledgement [s].
+
+    Methods
+    ---------
+    routes_url(self, url)
+        Checks whether cloud service URL is delivered over MQTT.
+    publish(self, url, payload)
+        Publishes payload to topic of cloud service URL.
+    close(self)
+        Closes connection to cloud broker.
+    '''
+    def __init__(self, conf, client_id):
+        '''
+        Initializes MqttBridge object and starts connecting to cloud broker.
+
+        Parameters
+        ----------
+        conf: dict
+            Bridge config created by upstream_config.
+        client_id: str
+            MQTT client id. Must be stable, so broker can resume persistent session.
+        '''
+        self.routes = conf[routes]
+        self.qos = conf.get(qos, default_qos)
+        self.batch_size = max(1, conf.get(batch_size, default_batch_size))
+        self.timeout = conf.get(publish_timeout, default_publish_timeout)
+        self._connected = threading.Event()
+        self.client = mqtt.Client(client_id=client_id, transport="tcp", protocol=mqtt.MQTTv5)
+        if conf.get(username) is not None:
+            self.client.username_pw_set(username=conf[username], password=conf.get(password))
+        tls.configure_mqtt(self.client, conf.get(tls_conf))
+        self.client.on_connect = self._on_connect
+        self.client.on_disconnect = self._on_disconnect
+        self.client.reconnect_delay_set(min_delay=1, max_delay=60)
+        properties = Properties(PacketTypes.CONNECT)
+        properties.SessionExpiryInterval = conf.get(session_expiry, default_session_expiry)
+        self.client.connect_async(conf[address], port=conf.get(port, default_port),
+                                  keepalive=conf.get(keepalive, default_keepalive), clean_start=False,
+                                  properties=properties)
+        self.client.loop_start()
+
+    def _on_connect(self, client, userdata, flags, rc, props):
+        if rc == 0:
+            self._connected.set()
+            infoLogger.info("Upstream bridge established connection with cloud MQTT broker!")
+            customLogger.debug("Upstream bridge established connection with cloud MQTT broker!")
+        else:
+            errorLogger.error("Upstream bridge failed to establish connection with cloud MQTT broker!")
+            customLogger.critical("Upstream bridge failed to establish connection with cloud MQTT broker!")
+
+    def _on_disconnect(self, client, userdata, rc, props=None):
+        self._connected.clear()
+        if rc != 0:
+            errorLogger.error("Upstream bridge lost connection with cloud MQTT broker!")
+            customLogger.error("Upstream bridge lost connection with cloud MQTT broker!")
+
+    def routes_url(self, url):
+        '''
+        Checks whether cloud service URL is delivered over MQTT.
+
+        Parameters
+        ----------
+        url: str
+            Cloud services' URL.
+
+        Returns
+        -------
+        routed: bool
+        '''
+        return url in self.routes
+
+    def publish(self, url, payload):
+        '''
+        Publishes payload to topic of cloud service URL.
+
+        With QoS 1 or 2, method returns after cloud broker acknowledges message. With QoS 0, which has no
+        acknowledgement, it returns after message is written to connection by network thread.
+
+        Parameters
+        ----------
+        url: str
+            Cloud services' URL.
+        payload: dict, list or bytes
+            Single payload, or list of payloads published as one message, or their JSON text serialized earlier.
+
+        Returns
+        -------
+        http status code
+            http_ok if message is delivered to cloud broker, http_service_unavailable otherwise.
+        '''
+        topic = self.routes[url]
+        if not self._connected.wait(self.timeout):
+            errorLogger.error("Upstream bridge is not connected to cloud MQTT broker!")
+            traffic.record(topic, failed=True)
+            return http_service_unavailable
+        body = payload if isinstance(payload, bytes) else json.dumps(payload).encode("utf-8")
+        header_bytes, response_bytes = traffic.mqtt_publish_sizes(topic, len(body), self.qos)
+        try:
+            info = self.client.publish(topic, body, qos=self.qos)
+            # network thread sends message, so even QoS 0 message is not published yet when publish returns
+            info.wait_for_publish(self.timeout)
+        except (ValueError, RuntimeError) as error:
+            errorLogger.error("Upstream bridge failed to publish message! - " + str(error))
+            traffic.record(topic, failed=True)
+            return http_service_unavailable
+        if info.rc != mqtt.MQTT_ERR_SUCCESS or not info.is_published():
+            errorLogger.error("Cloud MQTT broker did not acknowledge message in time!" if self.qos > 0
+                              else "Message was not sent to cloud MQTT broker in time!")
+            # message is queued in session and may still be delivered, so its bytes are accounted
+            traffic.record(topic, len(body), len(body), header_bytes, 0, True)
+            return http_service_unavailable
+        traffic.record(topic, len(body), len(body), header_bytes, response_bytes)
+        return http_ok
+
+    def close(self):
+        '''
+        Closes connection to cloud broker.
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        '''
+        self.client.disconnect()
+        self.client.loop_stop()
+
+
+def upstream_config(conf, stream_urls, device):
+    '''
+    Creates bridge config with routes of data streams that are delivered over MQTT.
+
+    Topic of every stream is taken from bridge config, "{device}" placeholder is replaced with device username.
+    Streams that are not listed in bridge config are sent over HTTP.
+
+    Parameters
+    ----------
+    conf: dict
+        Bridge config from app config file.
+    stream_urls: dict
+        Cloud service URL of every data stream.
+    device: str
+        Device username.
+
+    Returns
+    -------
+    conf: dict
+        Bridge config passed to data handlers, or None if no stream is delivered over MQTT.
+    '''
+    if conf is None or len(conf.get(streams, {})) == 0:
+        return None
+    bridge_conf = {key: value for key, value in conf.items() if key != streams}
+    bridge_conf[routes] = {stream_urls[stream]: topic.replace("{device}", device)
+                           for stream, topic in conf[streams].items() if stream in stream_urls}
+    return bridge_conf
+
+
+def create_bridge(conf, client_id):
+    '''
+    Creates MQTT bridge.
+
+    Parameters
+    ----------
+    conf: dict
+        Bridge config created by upstream_config, or None.
+    client_id: str
+        MQTT client id.
+
+    Returns
+    -------
+    bridge: MqttBridge
+        Connected bridge, or None if bridge config is None.
+    '''
+    if conf is None:
+        return None
+    return MqttBridge(conf, client_id)
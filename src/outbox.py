@@ -0,0 +1,354 @@
+'''
+outbox
+============
+Module that contains durable store-and-forward outbox for payloads that are not delivered to cloud services yet.
+
+Payloads are kept in SQLite database in WAL mode, one database file per data stream. Appended payloads are committed
+in batches, so one fsync covers many payloads. Batch is committed when it is full or, by timer, when sync interval has
+elapsed, so payloads appended before traffic stops are not left uncommitted. Critical payloads can be committed right
+away. Delivered payloads are acknowledged by offset and removed from the
+database, while payloads that survived a crash or restart are replayed once cloud services are reachable again.
+
+Besides data stream's own cursor, outbox can keep cursor of every additional consumer (fan-out target). Payload is
+removed only after all consumers acknowledged it, so every consumer progresses at its own pace.
+
+Classes
+---------
+Outbox
+    Durable append-only payload store with acknowledged offset tracking.
+
+Functions
+---------
+open_outbox(conf, stream, consumers)
+    Opens outbox of data stream based on outbox config.
+
+Constants
+---------
+path: str
+    Config key of outbox directory.
+sync_batch: str
+    Config key of max number of appended payloads that are not synced to disk.
+sync_interval: str
+    Config key of max time in seconds between appending payload and syncing it to disk.
+replay_batch: str
+    Config key of max number of payloads replayed in one forwarding iteration.
+'''
+import os
+import json
+import time
+import sqlite3
+import threading
+import logging.config
+
+logging.config.fileConfig('logging.conf')
+infoLogger = logging.getLogger('customInfoLogger')
+errorLogger = logging.getLogger('customErrorLogger')
+customLogger = logging.getLogger('customConsoleLogger')
+
+path = "path"
+sync_batch = "sync_batch"
+sync_interval = "sync_interval"
+replay_batch = "replay_batch"
+
+default_sync_batch = 64
+default_sync_interval = 1.0
+default_replay_batch = 100
+
+
+class Outbox:
+    '''
+    Durable store of payloads waiting to be delivered to cloud services.
+
+    Every payload gets monotonically increasing offset. Offset of last delivered payload is persisted together with
+    payloads, so after crash only payloads that were not acknowledged are replayed. Offset is tracked separately for
+    data stream and every additional consumer.
+
+    Attributes
+    ---------
+    path: str
+        Database file path.
+    stream: str
+        Data stream name.
+    sync_batch: int
+        Max number of appended payloads that are not synced to disk.
+    sync_interval: float
+        Max time in seconds between appending payload and syncing it to disk.
+    consumers: tuple
+        Names of additional consumers.
+
+    Methods
+    ---------
+    append(self, payload, sync)
+        Stores payload.
+    pending(self, limit, consumer)
+        Returns payloads that are not acknowledged.
+    pending_raw(self, limit, consumer)
+        Returns serialized payloads that are not acknowledged.
+    ack(self, offset, consumer)
+        Acknowledges all payloads up to offset.
+    sync(self)
+        Syncs appended payloads to disk.
+    size(self, consumer)
+        Returns number of payloads that are not acknowledged.
+    close(self)
+        Syncs and closes outbox.
+    '''
+    def __init__(self, path, stream, sync_batch=default_sync_batch, sync_interval=default_sync_interval,
+                 consumers=()):
+        '''
+        Initializes Outbox object and recovers payloads left from previous run.
+
+        Parameters
+        ----------
+        path: str
+            Database file path.
+        stream: str
+            Data stream name.
+        sync_batch: int
+            Max number of appended payloads that are not synced to disk.
+        sync_interval: float
+            Max time in seconds between appending payload and syncing it to disk.
+        consumers: tuple
+            Names of additional consumers. Cursors of consumers that are no longer configured are dropped.
+        '''
+        self.path = path
+        self.stream = stream
+        self.consumers = tuple(consumers)
+        self.sync_batch = max(1, sync_batch)
+        self.sync_interval = sync_interval
+        self._lock = threading.Lock()
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+        self._timer = None
+        self._closed = False
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        try:
+            self._connection = self._open()
+        except sqlite3.DatabaseError:
+            # corrupted database is moved aside, so gateway can keep storing new data
+            corrupted_path = path + ".corrupt-" + str(int(time.time()))
+            errorLogger.error("Outbox database is corrupted, moving it to " + corrupted_path)
+            os.replace(path, corrupted_path)
+            # stale write-ahead log would be replayed into new database, so it is moved aside with it
+            for suffix in ("-wal", "-shm"):
+                if os.path.exists(path + suffix):
+                    os.replace(path + suffix, corrupted_path + suffix)
+            self._connection = self._open()
+        recovered = self.size()
+        if recovered > 0:
+            infoLogger.info("Recovered " + str(recovered) + " undelivered " + stream + " payloads from outbox!")
+            customLogger.warning("Recovered " + str(recovered) + " undelivered " + stream + " payloads from outbox!")
+
+    def _open(self):
+        connection = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        # every commit is fsynced, so batching commits batches fsync calls
+        connection.execute("PRAGMA synchronous=FULL")
+        connection.execute("CREATE TABLE IF NOT EXISTS records (offset INTEGER PRIMARY KEY AUTOINCREMENT, "
+                           "created REAL NOT NULL, payload TEXT NOT NULL)")
+        connection.execute("CREATE TABLE IF NOT EXISTS cursor (stream TEXT PRIMARY KEY, acked INTEGER NOT NULL)")
+        names = (self.stream,) + self.consumers
+        for name in names:
+            connection.execute("INSERT OR IGNORE INTO cursor (stream, acked) VALUES (?, 0)", (name,))
+        connection.execute("DELETE FROM cursor WHERE stream NOT IN (" + ", ".join("?" * len(names)) + ")", names)
+        if connection.execute("PRAGMA quick_check").fetchone()[0] != "ok":
+            connection.close()
+            raise sqlite3.DatabaseError("Outbox database integrity check failed!")
+        return connection
+
+    def _sync(self):
+        if self._connection.in_transaction:
+            self._connection.execute("COMMIT")
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def _written(self, sync=False):
+        self._unsynced += 1
+        if sync or self._unsynced >= self.sync_batch or time.monotonic() - self._last_sync >= self.sync_interval:
+            self._sync()
+        elif self._timer is None:
+            # write is synced by timer if no later write fills batch in time
+            self._timer = threading.Timer(self._last_sync + self.sync_interval - time.monotonic(), self._on_timer)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _on_timer(self):
+        with self._lock:
+            self._timer = None
+            if not self._closed and self._unsynced > 0:
+                self._sync()
+
+    def append(self, payload, sync=False):
+        '''
+        Stores payload.
+
+        Payload is synced to disk when sync batch is full, when sync interval has elapsed or when sync is requested.
+
+        Parameters
+        ----------
+        payload: dict
+            Request payload.
+        sync: bool
+            Whether payload is synced to disk right away, e.g. critical alert.
+
+        Returns
+        -------
+        offset: int
+            Offset of stored payload.
+        '''
+        with self._lock:
+            if not self._connection.in_transaction:
+                self._connection.execute("BEGIN")
+            offset = self._connection.execute("INSERT INTO records (created, payload) VALUES (?, ?)",
+                                              (time.time(), json.dumps(payload))).lastrowid
+            self._written(sync)
+            return offset
+
+    def pending(self, limit=None, consumer=None):
+        '''
+        Returns payloads that are not acknowledged, in order of appending.
+
+        Parameters
+        ----------
+        limit: int
+            Max number of returned payloads.
+        consumer: str
+            Consumer name, None for data stream itself.
+
+        Returns
+        -------
+        records: list
+            List of (offset, payload) tuples.
+        '''
+        return [(offset, json.loads(payload)) for offset, payload in self.pending_raw(limit, consumer)]
+
+    def pending_raw(self, limit=None, consumer=None):
+        '''
+        Returns payloads that are not acknowledged, in order of appending, as stored JSON text.
+
+        Payloads are serialized once, when they are appended, so consumers can send them without serializing again.
+
+        Parameters
+        ----------
+        limit: int
+            Max number of returned payloads.
+        consumer: str
+            Consumer name, None for data stream itself.
+
+        Returns
+        -------
+        records: list
+            List of (offset, JSON text) tuples.
+        '''
+        with self._lock:
+            acked = self._acked(consumer)
+            return self._connection.execute("SELECT offset, payload FROM records WHERE offset > ? ORDER BY offset "
+                                            "LIMIT ?", (acked, -1 if limit is None else limit)).fetchall()
+
+    def _acked(self, consumer=None):
+        return self._connection.execute("SELECT acked FROM cursor WHERE stream = ?",
+                                        (self.stream if consumer is None else consumer,)).fetchone()[0]
+
+    def ack(self, offset, consumer=None):
+        '''
+        Acknowledges delivery of all payloads up to offset.
+
+        Payloads acknowledged by all consumers are removed from outbox.
+
+        Parameters
+        ----------
+        offset: int
+            Offset of last delivered payload.
+        consumer: str
+            Consumer name, None for data stream itself.
+
+        Returns
+        -------
+        '''
+        with self._lock:
+            if not self._connection.in_transaction:
+                self._connection.execute("BEGIN")
+            self._connection.execute("UPDATE cursor SET acked = MAX(acked, ?) WHERE stream = ?",
+                                     (offset, self.stream if consumer is None else consumer))
+            self._connection.execute("DELETE FROM records WHERE offset <= (SELECT MIN(acked) FROM cursor)")
+            self._written()
+
+    def sync(self):
+        '''
+        Syncs appended payloads and acknowledgements to disk.
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        '''
+        with self._lock:
+            self._sync()
+
+    def size(self, consumer=None):
+        '''
+        Returns number of payloads that are not acknowledged.
+
+        Parameters
+        ----------
+        consumer: str
+            Consumer name, None for data stream itself.
+
+        Returns
+        -------
+        size: int
+        '''
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM records WHERE offset > ?",
+                                            (self._acked(consumer),)).fetchone()[0]
+
+    def close(self):
+        '''
+        Syncs and closes outbox.
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        '''
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            self._sync()
+            self._closed = True
+            self._connection.close()
+
+
+def open_outbox(conf, stream, consumers=()):
+    '''
+    Opens outbox of data stream.
+
+    Parameters
+    ----------
+    conf: dict
+        Outbox config. If None, outbox is disabled.
+    stream: str
+        Data stream name.
+    consumers: tuple
+        Names of additional consumers, such as fan-out targets.
+
+    Returns
+    -------
+    outbox: Outbox
+        Opened outbox, or None if outbox is disabled or can not be opened.
+    '''
+    if conf is None:
+        return None
+    try:
+        return Outbox(os.path.join(conf.get(path, "outbox"), stream + ".db"), stream,
+                      conf.get(sync_batch, default_sync_batch), conf.get(sync_interval, default_sync_interval),
+                      consumers)
+    except (sqlite3.Error, OSError):
+        errorLogger.error("Cant open " + stream + " outbox! Undelivered data will be kept in memory.")
+        customLogger.critical("Cant open " + stream + " outbox! Undelivered data will be kept in memory.")
+        return None
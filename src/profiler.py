@@ -0,0 +1,363 @@
+'''
+profiler
+============
+Module with on-demand sampling profiler of gateway processes.
+
+Profiler is idle until it is started at runtime, so gateway does not have to be restarted under profiler when it
+starts burning CPU. Sampling thread periodically reads stacks of all threads of the process and counts identical
+stacks. When profiling ends, counts are written in collapsed stack format, one "thread;frame;...;frame count" line per
+stack, ready for flame graph tools, e.g. "cat profiles/*.folded | flamegraph.pl > gateway.svg".
+
+Profiling is started and stopped by SIGUSR1 sent to main process, which forwards it to data handler processes, or by
+local admin endpoint served by metrics server - POST /profile?duration=30&rate=100 and POST /profile/stop. Data handler
+can also be profiled alone by sending SIGUSR1 to its process. Every profiling stops after its duration, and duration
+and sampling rate are bounded by config, so forgotten or mistyped request can not slow gateway down for long.
+
+Parameters of admin request are handed to data handlers in request file, because signal carries no data.
+
+Functions
+---------
+configure(conf, name, children)
+    Sets profiler config of current process and installs SIGUSR1 handler.
+start(seconds, rate)
+    Starts profiling current process.
+stop()
+    Stops profiling current process.
+running()
+    Returns whether current process is being profiled.
+request(seconds, rate)
+    Starts profiling of all gateway processes.
+request_stop()
+    Stops profiling of all gateway processes.
+collapse(frame)
+    Returns stack of frame in collapsed stack format.
+
+Constants
+---------
+sample_rate: str
+    Config key of default sampling rate [Hz].
+duration: str
+    Config key of default profiling duration [s].
+max_sample_rate: str
+    Config key of max sampling rate [Hz].
+max_duration: str
+    Config key of max profiling duration [s].
+output_path: str
+    Config key of directory with collapsed stack files.
+'''
+import os
+import sys
+import json
+import time
+import signal
+import threading
+import logging.config
+
+logging.config.fileConfig('logging.conf')
+infoLogger = logging.getLogger('customInfoLogger')
+errorLogger = logging.getLogger('customErrorLogger')
+customLogger = logging.getLogger('customConsoleLogger')
+
+sample_rate = "sample_rate"
+duration = "duration"
+max_sample_rate = "max_sample_rate"
+max_duration = "max_duration"
+output_path = "output_path"
+
+default_sample_rate = 100.0
+default_duration = 30.0
+default_max_sample_rate = 250.0
+default_max_duration = 300.0
+default_output_path = "profiles"
+request_file = "profile.request"
+
+# profiler state of current process
+_conf = None
+_name = None
+_pid = None
+_children = None
+_sampler = None
+_last_request = None
+# signal handler runs in main thread, possibly while main thread holds the lock
+_lock = threading.RLock()
+
+
+class _Sampler(threading.Thread):
+
+    def __init__(self, rate, seconds, path):
+        super().__init__(name="profiler", daemon=True)
+        self.rate = rate
+        self.seconds = seconds
+        self.path = path
+        self.stopped = threading.Event()
+        self.stacks = {}
+        self.samples = 0
+
+    def run(self):
+        interval = 1 / self.rate
+        start = time.monotonic()
+        deadline = start + self.seconds
+        busy = 0.0
+        while not self.stopped.is_set() and time.monotonic() < deadline:
+            tick = time.perf_counter()
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == self.ident:
+                    continue
+                stack = names.get(ident, "thread-" + str(ident)) + ";" + collapse(frame)
+                self.stacks[stack] = self.stacks.get(stack, 0) + 1
+            self.samples += 1
+            busy += time.perf_counter() - tick
+            self.stopped.wait(interval)
+        elapsed = time.monotonic() - start
+        self._write()
+        infoLogger.info("Profiling of {} process finished: {} samples in {:.1f}s, sampler used {:.2f}% of CPU, "
+                        "stacks written to {}".format(_name, self.samples, elapsed,
+                                                      100 * busy / elapsed if elapsed > 0 else 0, self.path))
+
+    def _write(self):
+        temporary_path = self.path + ".tmp"
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(temporary_path, "w") as profile_file:
+                for stack, count in sorted(self.stacks.items()):
+                    profile_file.write(stack + " " + str(count) + "\n")
+            os.replace(temporary_path, self.path)
+        except OSError as error:
+            errorLogger.error("Cant write profile! - " + str(error))
+
+
+def collapse(frame):
+    '''
+    Returns stack of frame in collapsed stack format.
+
+    Parameters
+    ----------
+    frame: frame
+        Innermost frame of stack.
+
+    Returns
+    -------
+    stack: str
+        Frames from outermost to innermost, separated by semicolons. Frame is function's qualified name, file and
+        first line of function.
+    '''
+    frames = []
+    while frame is not None:
+        code = frame.f_code
+        frames.append("{} ({}:{})".format(code.co_qualname, os.path.basename(code.co_filename), code.co_firstlineno))
+        frame = frame.f_back
+    frames.reverse()
+    return ";".join(frames)
+
+
+def configure(conf, name, children=None):
+    '''
+    Sets profiler config of current process and installs SIGUSR1 handler, which toggles profiling.
+
+    Must be called by main thread of the process.
+
+    Parameters
+    ----------
+    conf: dict
+        Profiler config. If None, profiler is disabled and SIGUSR1 handler is not installed.
+    name: str
+        Process name used in names of collapsed stack files.
+    children: callable
+        Returns PIDs of processes SIGUSR1 is forwarded to, None if signal is not forwarded.
+
+    Returns
+    -------
+    '''
+    global _conf, _name, _pid, _children, _last_request
+    _conf = conf
+    _name = name
+    _pid = os.getpid()
+    _children = children
+    if conf is None:
+        return
+    # request left by previous run is not applied again
+    _last_request = _read_request().get("id")
+    signal.signal(signal.SIGUSR1, _on_signal)
+
+
+def start(seconds=None, rate=None):
+    '''
+    Starts profiling current process.
+
+    Parameters
+    ----------
+    seconds: float
+        Profiling duration [s], bounded by max duration. Configured duration is used if None.
+    rate: float
+        Sampling rate [Hz], bounded by max sampling rate. Configured rate is used if None.
+
+    Returns
+    -------
+    started: bool
+        Whether profiling is started, False if profiler is disabled or process is already profiled.
+    '''
+    global _sampler
+    if _conf is None:
+        return False
+    seconds, rate = _bounded(seconds, rate)
+    with _lock:
+        if _sampler is not None and _sampler.is_alive():
+            return False
+        path = os.path.join(_conf.get(output_path, default_output_path),
+                            "{}-{}-{}.folded".format(_name, os.getpid(), time.strftime("%Y%m%d-%H%M%S")))
+        _sampler = _Sampler(rate, seconds, path)
+        _sampler.start()
+    infoLogger.info("Profiling {} process for {:.0f}s at {:.0f}Hz".format(_name, seconds, rate))
+    return True
+
+
+def stop():
+    '''
+    Stops profiling current process. Collected stacks are written by sampling thread.
+
+    Parameters
+    ----------
+
+    Returns
+    -------
+    stopped: bool
+        Whether process was being profiled.
+    '''
+    with _lock:
+        if _sampler is None or not _sampler.is_alive():
+            return False
+        _sampler.stopped.set()
+        return True
+
+
+def running():
+    '''
+    Returns whether current process is being profiled.
+
+    Parameters
+    ----------
+
+    Returns
+    -------
+    running: bool
+    '''
+    return _sampler is not None and _sampler.is_alive()
+
+
+def request(seconds=None, rate=None):
+    '''
+    Starts profiling of current process and all processes it forwards SIGUSR1 to.
+
+    Parameters
+    ----------
+    seconds: float
+        Profiling duration [s], bounded by max duration. Configured duration is used if None.
+    rate: float
+        Sampling rate [Hz], bounded by max sampling rate. Configured rate is used if None.
+
+    Returns
+    -------
+    result: dict
+        Applied duration and rate, and PIDs of profiled processes, or None if profiler is disabled.
+    '''
+    if _conf is None:
+        return None
+    seconds, rate = _bounded(seconds, rate)
+    pids = _broadcast({"duration": seconds, "rate": rate})
+    # process that is already profiled keeps its profiling, so it is restarted with requested parameters
+    stop()
+    _join()
+    start(seconds, rate)
+    return {"duration": seconds, "rate": rate, "pids": [os.getpid()] + pids}
+
+
+def request_stop():
+    '''
+    Stops profiling of current process and all processes it forwards SIGUSR1 to.
+
+    Parameters
+    ----------
+
+    Returns
+    -------
+    result: dict
+        PIDs of signaled processes, or None if profiler is disabled.
+    '''
+    if _conf is None:
+        return None
+    pids = _broadcast({"stop": True})
+    stop()
+    return {"pids": [os.getpid()] + pids}
+
+
+def _bounded(seconds, rate):
+    seconds = _conf.get(duration, default_duration) if seconds is None else seconds
+    rate = _conf.get(sample_rate, default_sample_rate) if rate is None else rate
+    return (min(max(seconds, 0.1), _conf.get(max_duration, default_max_duration)),
+            min(max(rate, 1.0), _conf.get(max_sample_rate, default_max_sample_rate)))
+
+
+def _join():
+    sampler = _sampler
+    if sampler is not None:
+        sampler.join()
+
+
+def _request_path():
+    return os.path.join(_conf.get(output_path, default_output_path), request_file)
+
+
+def _read_request():
+    try:
+        with open(_request_path()) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def _broadcast(parameters):
+    global _last_request
+    parameters["id"] = time.time_ns()
+    _last_request = parameters["id"]
+    try:
+        os.makedirs(_conf.get(output_path, default_output_path), exist_ok=True)
+        temporary_path = _request_path() + ".tmp"
+        with open(temporary_path, "w") as file:
+            json.dump(parameters, file)
+        os.replace(temporary_path, _request_path())
+    except OSError as error:
+        errorLogger.error("Cant write profile request! - " + str(error))
+        return []
+    return _signal_children()
+
+
+def _signal_children():
+    pids = []
+    for pid in (_children() if _children is not None else ()):
+        try:
+            os.kill(pid, signal.SIGUSR1)
+            pids.append(pid)
+        except (ProcessLookupError, PermissionError):
+            pass
+    return pids
+
+
+def _on_signal(signum, frame):
+    global _last_request
+    # handler inherited by forked process that did not configure profiler only profiles that process
+    forwarding = os.getpid() == _pid
+    parameters = _read_request()
+    if parameters.get("id") is not None and parameters["id"] != _last_request:
+        # signal sent by admin request of main process
+        _last_request = parameters["id"]
+        stop()
+        if not parameters.get("stop"):
+            # sampler is started again only after stopped sampler wrote its stacks
+            threading.Thread(target=lambda: (_join(), start(parameters["duration"], parameters["rate"])),
+                             daemon=True).start()
+        return
+    if forwarding:
+        _signal_children()
+    if not stop():
+        start()
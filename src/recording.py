@@ -0,0 +1,390 @@
+'''
+recording
+============
+Module with recorder of MQTT traffic and replayer, which publishes recorded traffic again with its timing.
+
+Recorder subscribes to sensor topics on broker, so it can record field traffic next to running gateway, and writes
+every message with its topic and arrival time to recording file. Replayer publishes recorded messages to broker the
+gateway listens on, at original speed, N times faster with gaps between messages shortened N times, or as fast as
+broker accepts them, so load spikes seen in production can be reproduced locally.
+
+Recording file starts with header - magic, format version and UNIX time of recording start. Header is followed by
+records of two kinds. Topic record defines next topic ID and holds topic name, so every topic is stored only once.
+Message record holds arrival time as microseconds since recording start, topic ID, QoS and retain flag, and payload.
+Recorder that is killed leaves at most last record incomplete, and incomplete record is skipped by reader.
+
+Usage: python recording.py record <file> [options], python recording.py replay <file> [options]
+
+Broker address and credentials are read from sensors' config file, the same way sensor devices connect to broker.
+
+Classes
+---------
+RecordingWriter
+    Writes MQTT messages to recording file.
+
+Functions
+---------
+read_recording(path)
+    Reads recording file.
+record(path, broker_conf, topics, seconds, flag)
+    Records MQTT messages from broker to recording file.
+replay(path, broker_conf, speed, flag, sent)
+    Publishes recorded MQTT messages to broker with recorded timing.
+main()
+    Recorder and replayer entrypoint.
+
+Constants
+---------
+magic: bytes
+    Recording file signature.
+version: int
+    Recording file format version.
+max_speed: float
+    Replay speed of publishing without delays.
+'''
+import sys
+import json
+import time
+import struct
+import argparse
+import threading
+import tls
+import sensor_devices
+import paho.mqtt.client as mqtt
+import logging.config
+
+logging.config.fileConfig('logging.conf')
+infoLogger = logging.getLogger('customInfoLogger')
+errorLogger = logging.getLogger('customErrorLogger')
+customLogger = logging.getLogger('customConsoleLogger')
+
+magic = b"MQTR"
+version = 1
+max_speed = float("inf")
+
+_header = struct.Struct("<4sBd")
+_kind = struct.Struct("<B")
+_topic = struct.Struct("<H")
+_message = struct.Struct("<QHBI")
+_topic_record = 1
+_message_record = 2
+_flush_interval = 1.0
+
+
+class RecordingWriter:
+    '''
+    Writes MQTT messages to recording file.
+
+    Writer is thread-safe, so it can be used by MQTT client callbacks. Records are buffered and written to file at
+    least once per second.
+
+    Attributes
+    ---------
+    path: str
+        Recording file path.
+    start: float
+        UNIX time of recording start.
+    messages: int
+        Number of recorded messages.
+
+    Methods
+    ---------
+    write(self, topic, payload, qos, retain, timestamp)
+        Appends message to recording.
+    close(self)
+        Writes buffered records and closes recording file.
+    '''
+
+    def __init__(self, path, start=None):
+        '''
+        Creates recording file. Existing file is overwritten.
+
+        Parameters
+        ----------
+        path: str
+            Recording file path.
+        start: float
+            UNIX time of recording start, current time if None.
+        '''
+        self.path = path
+        self.start = time.time() if start is None else start
+        self.messages = 0
+        self._topics = {}
+        self._lock = threading.Lock()
+        self._flushed = time.monotonic()
+        self._file = open(path, "wb")
+        self._file.write(_header.pack(magic, version, self.start))
+
+    def write(self, topic, payload, qos=0, retain=False, timestamp=None):
+        '''
+        Appends message to recording.
+
+        Parameters
+        ----------
+        topic: str
+            Message topic.
+        payload: bytes
+            Message payload.
+        qos: int
+            Message quality of service.
+        retain: bool
+            Whether message is retained.
+        timestamp: float
+            UNIX time of message arrival, current time if None.
+
+        Returns
+        -------
+        '''
+        offset = max(0, round(((time.time() if timestamp is None else timestamp) - self.start) * 1e6))
+        with self._lock:
+            topic_id = self._topics.get(topic)
+            if topic_id is None:
+                topic_id = self._topics[topic] = len(self._topics)
+                name = topic.encode("utf-8")
+                self._file.write(_kind.pack(_topic_record) + _topic.pack(len(name)) + name)
+            self._file.write(_kind.pack(_message_record) + _message.pack(offset, topic_id, qos | retain << 2,
+                                                                          len(payload)))
+            self._file.write(payload)
+            self.messages += 1
+            if time.monotonic() - self._flushed >= _flush_interval:
+                self._file.flush()
+                self._flushed = time.monotonic()
+
+    def close(self):
+        '''
+        Writes buffered records and closes recording file.
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        '''
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+
+
+def read_recording(path):
+    '''
+    Reads recording file.
+
+    Parameters
+    ----------
+    path: str
+        Recording file path.
+
+    Returns
+    -------
+    messages: generator
+        Yields (arrival time in seconds since recording start, topic, payload, qos, retain) tuples in recorded order.
+    '''
+    with open(path, "rb") as file:
+        header = file.read(_header.size)
+        if len(header) < _header.size or header[:len(magic)] != magic:
+            raise ValueError("Not a recording file - " + path)
+        _, file_version, _ = _header.unpack(header)
+        if file_version != version:
+            raise ValueError("Unsupported recording format version " + str(file_version))
+        topics = []
+        while True:
+            kind = file.read(_kind.size)
+            if len(kind) == 0:
+                return
+            if kind[0] == _topic_record:
+                size = file.read(_topic.size)
+                if len(size) < _topic.size:
+                    break
+                size = _topic.unpack(size)[0]
+                name = file.read(size)
+                if len(name) < size:
+                    break
+                topics.append(name.decode("utf-8"))
+            elif kind[0] == _message_record:
+                fields = file.read(_message.size)
+                if len(fields) < _message.size:
+                    break
+                offset, topic_id, flags, size = _message.unpack(fields)
+                payload = file.read(size)
+                if len(payload) < size:
+                    break
+                yield offset / 1e6, topics[topic_id], payload, flags & 3, bool(flags & 4)
+            else:
+                raise ValueError("Corrupted recording file - " + path)
+    errorLogger.error("Last record of recording " + path + " is incomplete!")
+
+
+def _client(broker_conf, client_id):
+    client = mqtt.Client(client_id=client_id, transport=sensor_devices.transport_protocol, protocol=mqtt.MQTTv5)
+    if broker_conf.get(sensor_devices.mqtt_user) is not None:
+        client.username_pw_set(username=broker_conf[sensor_devices.mqtt_user],
+                               password=broker_conf.get(sensor_devices.mqtt_password))
+    tls.configure_mqtt(client, broker_conf.get(sensor_devices.tls_conf))
+    return client
+
+
+def record(path, broker_conf, topics, seconds=None, flag=None):
+    '''
+    Records MQTT messages from broker to recording file.
+
+    Parameters
+    ----------
+    path: str
+        Recording file path.
+    broker_conf: dict
+        Broker config - address, port, username, password and TLS config.
+    topics: list
+        Recorded topic filters.
+    seconds: float
+        Recording duration [s], recording lasts until flag is set if None.
+    flag: threading.Event
+        Token used for stopping recording.
+
+    Returns
+    -------
+    results: dict
+        Number of recorded messages and recording duration [s].
+    '''
+    flag = threading.Event() if flag is None else flag
+    writer = RecordingWriter(path)
+    client = _client(broker_conf, "iot-gateway-recorder")
+
+    def on_connect(client, userdata, flags, rc, props):
+        if rc != 0:
+            errorLogger.error("Recorder failed to connect to MQTT broker, return code " + str(rc))
+            return
+        # subscription is renewed after reconnect, messages published meanwhile are not recorded
+        for topic in topics:
+            client.subscribe(topic, qos=2)
+        infoLogger.info("Recording MQTT messages of " + ", ".join(topics) + " to " + path)
+
+    client.on_connect = on_connect
+    client.on_message = lambda client, userdata, message: writer.write(message.topic, message.payload, message.qos,
+                                                                       message.retain)
+    client.connect(broker_conf[sensor_devices.address], broker_conf[sensor_devices.port])
+    client.loop_start()
+    try:
+        flag.wait(seconds)
+    finally:
+        client.disconnect()
+        client.loop_stop()
+        writer.close()
+    elapsed = time.time() - writer.start
+    infoLogger.info("Recorded {} MQTT messages in {:.1f}s to {}".format(writer.messages, elapsed, path))
+    return {"messages": writer.messages, "seconds": round(elapsed, 3)}
+
+
+def replay(path, broker_conf, speed=1.0, flag=None, sent=None):
+    '''
+    Publishes recorded MQTT messages to broker with recorded timing.
+
+    Message is published when time elapsed since replay start reaches its arrival time since first recorded message,
+    divided by speed. Replayer that falls behind schedule publishes without delays until it catches up, so lag is
+    reported instead of stretching the recording.
+
+    Parameters
+    ----------
+    path: str
+        Recording file path.
+    broker_conf: dict
+        Broker config - address, port, username, password and TLS config.
+    speed: float
+        Replay speed relative to recorded timing, max_speed publishes without delays.
+    flag: threading.Event
+        Token used for stopping replay.
+    sent: dict
+        If not None, UNIX times of publishing are appended to it by topic.
+
+    Returns
+    -------
+    results: dict
+        Number of published messages and payload bytes, replay duration [s], throughput [messages/s], recorded
+        duration [s] and max lag behind schedule [ms].
+    '''
+    if speed <= 0:
+        raise ValueError("Replay speed must be positive!")
+    flag = threading.Event() if flag is None else flag
+    client = _client(broker_conf, "iot-gateway-replayer")
+    # publisher must not be the bottleneck, so QoS handshakes of all messages can be in flight
+    client.max_inflight_messages_set(0)
+    client.connect(broker_conf[sensor_devices.address], broker_conf[sensor_devices.port])
+    client.loop_start()
+    messages = 0
+    payload_bytes = 0
+    lag = 0.0
+    first = None
+    offset = 0.0
+    info = None
+    start = time.monotonic()
+    try:
+        for offset, topic, payload, qos, retain in read_recording(path):
+            if flag.is_set():
+                break
+            if first is None:
+                first = offset
+            if speed != max_speed:
+                delay = start + (offset - first) / speed - time.monotonic()
+                if delay > 0:
+                    flag.wait(delay)
+                else:
+                    lag = max(lag, -delay)
+            info = client.publish(topic, payload, qos=qos, retain=retain)
+            if sent is not None:
+                sent.setdefault(topic, []).append(time.time())
+            messages += 1
+            payload_bytes += len(payload)
+        if info is not None:
+            info.wait_for_publish(30)
+        elapsed = time.monotonic() - start
+    finally:
+        client.disconnect()
+        client.loop_stop()
+    infoLogger.info("Replayed {} MQTT messages from {} in {:.1f}s".format(messages, path, elapsed))
+    return {"messages": messages, "bytes": payload_bytes, "seconds": round(elapsed, 3),
+            "messages_per_sec": round(messages / elapsed, 1) if elapsed > 0 else None,
+            "recorded_seconds": round(offset - first, 3) if first is not None else 0.0,
+            "speed": speed if speed != max_speed else "max", "max_lag_ms": round(lag * 1000, 1)}
+
+
+def _speed(value):
+    return max_speed if value == "max" else float(value)
+
+
+def main():
+    '''
+    Recorder and replayer entrypoint. Recording stops after duration or on new line, replay stops at end of
+    recording. Results are printed as JSON.
+
+    Parameters
+    ----------
+
+    Returns
+    -------
+    '''
+    parser = argparse.ArgumentParser(description="Records MQTT traffic and replays it with recorded timing.")
+    parser.add_argument("--config", default=sensor_devices.conf_file_path,
+                        help="sensors' config file with broker config")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    record_parser = subparsers.add_parser("record", help="record MQTT messages to file")
+    record_parser.add_argument("path")
+    record_parser.add_argument("--topic", nargs="+", default=[sensor_devices.temp_topic, sensor_devices.load_topic,
+                                                              sensor_devices.fuel_topic])
+    record_parser.add_argument("--duration", type=float, help="recording duration [s], until new line if missing")
+    replay_parser = subparsers.add_parser("replay", help="publish recorded MQTT messages")
+    replay_parser.add_argument("path")
+    replay_parser.add_argument("--speed", type=_speed, default=1.0, help="speed multiplier, or max for no delays")
+    args = parser.parse_args()
+    sensor_devices.conf_file_path = args.config
+    broker_conf = sensor_devices.read_conf()[sensor_devices.mqtt_broker]
+    if args.command == "record":
+        flag = threading.Event()
+        if args.duration is None:
+            threading.Thread(target=lambda: (sys.stdin.readline(), flag.set()), daemon=True).start()
+        json.dump(record(args.path, broker_conf, args.topic, args.duration, flag), sys.stdout)
+    else:
+        json.dump(replay(args.path, broker_conf, args.speed), sys.stdout)
+    sys.stdout.write("\n")
+
+
+if __name__ == '__main__':
+    main()
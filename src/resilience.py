@@ -0,0 +1,393 @@
+'''
+resilience
+============
+Module that contains shared resilience logic for requests to cloud services.
+
+Every cloud service endpoint has its own circuit breaker. After several consecutive failures breaker opens and
+requests to that endpoint are skipped until retry delay elapses. Retry delay grows exponentially with every failed
+attempt and is randomized (full jitter), so gateways do not retry in lockstep when cloud services come back. Delay
+requested by cloud services through Retry-After header is honored. When delay elapses, breaker becomes half-open and
+lets exactly one probe request through - its result decides whether breaker closes or opens again.
+
+Classes
+---------
+Backoff
+    Exponential backoff with full jitter.
+CircuitBreaker
+    Per endpoint circuit breaker.
+
+Functions
+---------
+configure(conf)
+    Sets resilience config used for creating circuit breakers.
+breaker(url)
+    Returns circuit breaker of cloud service endpoint.
+is_failure(code)
+    Checks whether http status code means that endpoint is failing.
+is_rejected(code)
+    Checks whether http status code means that endpoint refuses request payload itself.
+parse_retry_after(value)
+    Parses Retry-After header value.
+
+Constants
+---------
+failure_threshold: str
+    Config key of number of consecutive failures that opens breaker.
+backoff_base: str
+    Config key of first retry delay in seconds.
+backoff_cap: str
+    Config key of max retry delay in seconds.
+backoff_factor: str
+    Config key of retry delay growth factor.
+state_closed: str
+    Breaker state in which all requests are allowed.
+state_open: str
+    Breaker state in which requests are skipped.
+state_half_open: str
+    Breaker state in which single probe request is allowed.
+'''
+import time
+import random
+import threading
+import email.utils
+import logging.config
+
+logging.config.fileConfig('logging.conf')
+infoLogger = logging.getLogger('customInfoLogger')
+errorLogger = logging.getLogger('customErrorLogger')
+customLogger = logging.getLogger('customConsoleLogger')
+
+failure_threshold = "failure_threshold"
+backoff_base = "backoff_base"
+backoff_cap = "backoff_cap"
+backoff_factor = "backoff_factor"
+
+state_closed = "closed"
+state_open = "open"
+state_half_open = "half-open"
+
+http_too_many_requests = 429
+# client errors that are solved by waiting or by new JWT, not by changing payload
+_retryable_client_errors = (401, 403, 404, 408, http_too_many_requests)
+http_service_unavailable = 503
+
+default_conf = {failure_threshold: 3, backoff_base: 1.0, backoff_cap: 300.0, backoff_factor: 2.0}
+
+# resilience config and circuit breakers of current process
+_conf = dict(default_conf)
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+class Backoff:
+    '''
+    Exponential backoff with full jitter.
+
+    Attributes
+    ---------
+    base: float
+        First retry delay upper bound [s].
+    cap: float
+        Max retry delay [s].
+    factor: float
+        Retry delay growth factor.
+    attempt: int
+        Number of failed attempts since last reset.
+
+    Methods
+    ---------
+    next_delay(self)
+        Returns delay before next attempt.
+    reset(self)
+        Resets backoff after successful attempt.
+    '''
+    def __init__(self, base=1.0, cap=300.0, factor=2.0):
+        '''
+        Initializes Backoff object.
+
+        Parameters
+        ----------
+        base: float
+            First retry delay upper bound [s].
+        cap: float
+            Max retry delay [s].
+        factor: float
+            Retry delay growth factor.
+        '''
+        self.base = base
+        self.cap = cap
+        self.factor = factor
+        self.attempt = 0
+
+    def next_delay(self):
+        '''
+        Returns randomized delay before next attempt and increases attempt counter.
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        delay: float
+            Delay in seconds, uniformly chosen between 0 and exponentially growing upper bound.
+        '''
+        upper_bound = min(self.cap, self.base * self.factor ** min(self.attempt, 64))
+        self.attempt += 1
+        return random.uniform(0, upper_bound)
+
+    def reset(self):
+        '''
+        Resets backoff after successful attempt.
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        '''
+        self.attempt = 0
+
+
+class CircuitBreaker:
+    '''
+    Circuit breaker of single cloud service endpoint.
+
+    Attributes
+    ---------
+    name: str
+        Endpoint URL.
+    threshold: int
+        Number of consecutive failures that opens breaker.
+    backoff: Backoff
+        Retry delay generator.
+    state: str
+        Current breaker state.
+    failures: int
+        Number of consecutive failures.
+
+    Methods
+    ---------
+    allow_request(self)
+        Checks whether request to endpoint should be made.
+    record_success(self)
+        Records successful request.
+    record_failure(self, retry_after)
+        Records failed request.
+    retry_in(self)
+        Returns time until next request is allowed.
+    '''
+    def __init__(self, name, threshold=3, backoff=None):
+        '''
+        Initializes CircuitBreaker object.
+
+        Parameters
+        ----------
+        name: str
+            Endpoint URL.
+        threshold: int
+            Number of consecutive failures that opens breaker.
+        backoff: Backoff
+            Retry delay generator.
+        '''
+        self.name = name
+        self.threshold = max(1, threshold)
+        self.backoff = backoff if backoff is not None else Backoff()
+        self.state = state_closed
+        self.failures = 0
+        self._retry_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow_request(self):
+        '''
+        Checks whether request to endpoint should be made.
+
+        When retry delay of open breaker elapses, breaker becomes half-open and allows single probe request.
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        allowed: bool
+        '''
+        with self._lock:
+            if self.state == state_closed:
+                return True
+            if self.state == state_open and time.monotonic() >= self._retry_at:
+                self.state = state_half_open
+                customLogger.info("Circuit of " + self.name + " is half-open, sending probe request!")
+                return True
+            # breaker is open, or probe request is already in flight
+            return False
+
+    def record_success(self):
+        '''
+        Records successful request and closes breaker.
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        '''
+        with self._lock:
+            if self.state != state_closed:
+                infoLogger.info("Circuit of " + self.name + " is closed!")
+                customLogger.debug("Circuit of " + self.name + " is closed!")
+            self.state = state_closed
+            self.failures = 0
+            self.backoff.reset()
+
+    def record_failure(self, retry_after=None):
+        '''
+        Records failed request.
+
+        Breaker opens when failure threshold is reached or probe request fails.
+
+        Parameters
+        ----------
+        retry_after: float
+            Delay in seconds requested by cloud service, if any.
+
+        Returns
+        -------
+        '''
+        with self._lock:
+            self.failures += 1
+            if self.state == state_half_open or self.failures >= self.threshold or retry_after is not None:
+                delay = max(self.backoff.next_delay(), retry_after or 0.0)
+                self._retry_at = time.monotonic() + delay
+                self.state = state_open
+                errorLogger.error("Circuit of " + self.name + " is open! Next attempt in {:.1f}s".format(delay))
+                customLogger.error("Circuit of " + self.name + " is open! Next attempt in {:.1f}s".format(delay))
+
+    def retry_in(self):
+        '''
+        Returns time until next request is allowed.
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        delay: float
+            Time in seconds, 0 if request is allowed right away.
+        '''
+        with self._lock:
+            if self.state != state_open:
+                return 0.0
+            return max(0.0, self._retry_at - time.monotonic())
+
+
+def configure(conf):
+    '''
+    Sets resilience config used for creating circuit breakers of current process.
+
+    Parameters
+    ----------
+    conf: dict
+        Resilience config. Missing values are replaced with defaults.
+
+    Returns
+    -------
+    '''
+    with _breakers_lock:
+        _conf.clear()
+        _conf.update(default_conf)
+        if conf is not None:
+            _conf.update(conf)
+        _breakers.clear()
+
+
+def new_backoff():
+    '''
+    Creates backoff based on current resilience config.
+
+    Parameters
+    ----------
+
+    Returns
+    -------
+    backoff: Backoff
+    '''
+    return Backoff(_conf[backoff_base], _conf[backoff_cap], _conf[backoff_factor])
+
+
+def breaker(url):
+    '''
+    Returns circuit breaker of cloud service endpoint, creating it on first use.
+
+    Parameters
+    ----------
+    url: str
+        Endpoint URL.
+
+    Returns
+    -------
+    breaker: CircuitBreaker
+    '''
+    with _breakers_lock:
+        if url not in _breakers:
+            _breakers[url] = CircuitBreaker(url, _conf[failure_threshold], new_backoff())
+        return _breakers[url]
+
+
+def is_failure(code):
+    '''
+    Checks whether http status code means that endpoint is failing.
+
+    Client errors, such as expired JWT, are not endpoint failures.
+
+    Parameters
+    ----------
+    code: int
+        Http status code.
+
+    Returns
+    -------
+    failure: bool
+    '''
+    return code == http_too_many_requests or code >= 500
+
+
+def is_rejected(code):
+    '''
+    Checks whether http status code means that endpoint refuses request payload itself, e.g. malformed or too large
+    payload, so sending the same payload again can not succeed.
+
+    Parameters
+    ----------
+    code: int
+        Http status code.
+
+    Returns
+    -------
+    rejected: bool
+    '''
+    return 400 <= code < 500 and code not in _retryable_client_errors
+
+
+def parse_retry_after(value):
+    '''
+    Parses Retry-After header value.
+
+    Parameters
+    ----------
+    value: str
+        Header value, either delay in seconds or http date.
+
+    Returns
+    -------
+    delay: float
+        Delay in seconds, or None if value is missing or invalid.
+    '''
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,256 @@
+'''
+retry_buffer
+============
+Module that contains memory bounded buffer for sensor data that is not delivered to cloud services yet.
+
+When buffered data exceeds memory limit, oldest raw readings are folded into per-period aggregates (count, sum, min,
+max). During long outages buffered history loses resolution instead of exhausting device memory. If aggregates
+alone exceed memory limit, neighbouring periods are merged, so resolution keeps degrading gracefully.
+
+Classes
+---------
+RetryBuffer
+    Memory bounded buffer of raw readings and per-period aggregates.
+
+Functions
+---------
+create_retry_buffer(conf, time_format)
+    Creates retry buffer based on retry buffer config.
+
+Constants
+---------
+max_bytes: str
+    Config key of buffer memory limit in bytes.
+period: str
+    Config key of aggregation period in seconds.
+'''
+import sys
+import time
+from collections import deque, OrderedDict
+import logging.config
+
+logging.config.fileConfig('logging.conf')
+infoLogger = logging.getLogger('customInfoLogger')
+errorLogger = logging.getLogger('customErrorLogger')
+customLogger = logging.getLogger('customConsoleLogger')
+
+max_bytes = "max_bytes"
+period = "period"
+
+default_max_bytes = 256 * 1024
+default_period = 60
+
+# approximate memory footprint of single aggregate (dict with 6 entries and its values)
+aggregate_bytes = sys.getsizeof({}) + 6 * 32 + 128
+
+
+class RetryBuffer:
+    '''
+    Memory bounded buffer of sensor data waiting to be delivered to cloud services.
+
+    Attributes
+    ---------
+    max_bytes: int
+        Buffer memory limit [byte].
+    period: int
+        Aggregation period [s].
+    time_format: str
+        Time format of sensor readings.
+    bytes: int
+        Current buffer memory usage [byte].
+    peak_bytes: int
+        Max buffer memory usage [byte].
+    summarizations: int
+        Number of overflow events that caused summarizing.
+    folded: int
+        Number of raw readings folded into aggregates.
+
+    Methods
+    ---------
+    extend(self, readings)
+        Adds raw readings to buffer.
+    drain(self)
+        Removes and returns buffered data.
+    restore(self, readings, aggregates)
+        Returns drained data to buffer after failed delivery.
+    metrics(self)
+        Returns buffer metrics.
+    '''
+    def __init__(self, max_bytes=default_max_bytes, period=default_period, time_format="%d.%m.%Y %H:%M:%S"):
+        '''
+        Initializes RetryBuffer object.
+
+        Parameters
+        ----------
+        max_bytes: int
+            Buffer memory limit [byte].
+        period: int
+            Aggregation period [s].
+        time_format: str
+            Time format of sensor readings.
+        '''
+        self.max_bytes = max_bytes
+        self.period = max(1, period)
+        self.time_format = time_format
+        self.bytes = 0
+        self.peak_bytes = 0
+        self.summarizations = 0
+        self.folded = 0
+        self._readings = deque()
+        # aggregates ordered by start of period
+        self._aggregates = OrderedDict()
+
+    def __len__(self):
+        return len(self._readings) + sum(aggregate["count"] for aggregate in self._aggregates.values())
+
+    def extend(self, readings):
+        '''
+        Adds raw readings to buffer, summarizing oldest data if memory limit is exceeded.
+
+        Parameters
+        ----------
+        readings: list
+            Raw sensor readings.
+
+        Returns
+        -------
+        '''
+        for reading in readings:
+            self._readings.append(reading)
+            self.bytes += sys.getsizeof(reading)
+        self._enforce_limit()
+
+    def drain(self):
+        '''
+        Removes and returns buffered data.
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        readings: list
+            Raw sensor readings, oldest first.
+        aggregates: list
+            Aggregates of summarized readings, oldest first.
+        '''
+        readings = list(self._readings)
+        aggregates = list(self._aggregates.values())
+        self._readings.clear()
+        self._aggregates.clear()
+        self.bytes = 0
+        return readings, aggregates
+
+    def restore(self, readings, aggregates):
+        '''
+        Returns drained data to buffer after failed delivery.
+
+        Restored data is older than data added in the meantime, so it is put in front of it.
+
+        Parameters
+        ----------
+        readings: list
+            Raw sensor readings returned by drain.
+        aggregates: list
+            Aggregates returned by drain.
+
+        Returns
+        -------
+        '''
+        self._readings.extendleft(reversed(readings))
+        self.bytes += sum(sys.getsizeof(reading) for reading in readings)
+        for aggregate in aggregates:
+            if aggregate["start"] in self._aggregates:
+                self._merge(self._aggregates[aggregate["start"]], aggregate)
+            else:
+                self._aggregates[aggregate["start"]] = aggregate
+                self.bytes += aggregate_bytes
+        self._aggregates = OrderedDict(sorted(self._aggregates.items()))
+        self._enforce_limit()
+
+    def metrics(self):
+        '''
+        Returns buffer metrics.
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        metrics: dict
+            Memory usage, number of buffered readings and aggregates, and summarization counters.
+        '''
+        return {"bytes": self.bytes, "peak_bytes": self.peak_bytes, "readings": len(self._readings),
+                "aggregates": len(self._aggregates), "summarizations": self.summarizations, "folded": self.folded}
+
+    def _enforce_limit(self):
+        self.peak_bytes = max(self.peak_bytes, self.bytes)
+        if self.bytes <= self.max_bytes:
+            return
+        self.summarizations += 1
+        folded = 0
+        while self.bytes > self.max_bytes and len(self._readings) > 0:
+            self._fold(self._readings.popleft())
+            folded += 1
+        # aggregates alone exceed limit, so neighbouring periods are merged
+        while self.bytes > self.max_bytes and len(self._aggregates) > 1:
+            first, second = list(self._aggregates.values())[:2]
+            del self._aggregates[second["start"]]
+            self._merge(first, second)
+            self.bytes -= aggregate_bytes
+        self.folded += folded
+        infoLogger.info("Retry buffer limit exceeded, summarized {} readings into {} aggregates!"
+                        .format(folded, len(self._aggregates)))
+        customLogger.warning("Retry buffer limit exceeded, summarized {} readings into {} aggregates!"
+                             .format(folded, len(self._aggregates)))
+
+    def _fold(self, reading):
+        self.bytes -= sys.getsizeof(reading)
+        try:
+            tokens = reading.split(" ")
+            value = float(tokens[1].split("=")[1])
+        except:
+            errorLogger.error("Invalid sensor data format! - " + reading)
+            return
+        try:
+            timestamp = time.mktime(time.strptime(tokens[3].split("=")[1] + " " + tokens[4], self.time_format))
+        except:
+            timestamp = time.time()
+        unit = tokens[6].split("=")[1] if len(tokens) > 6 and "=" in tokens[6] else "unknown"
+        start = int(timestamp // self.period * self.period)
+        aggregate = self._aggregates.get(start)
+        if aggregate is None:
+            out_of_order = len(self._aggregates) > 0 and start < next(reversed(self._aggregates))
+            aggregate = {"start": start, "count": 0, "sum": 0.0, "min": value, "max": value, "unit": unit}
+            self._aggregates[start] = aggregate
+            self.bytes += aggregate_bytes
+            if out_of_order:
+                self._aggregates = OrderedDict(sorted(self._aggregates.items()))
+        self._merge(aggregate, {"count": 1, "sum": value, "min": value, "max": value})
+
+    @staticmethod
+    def _merge(target, source):
+        target["count"] += source["count"]
+        target["sum"] += source["sum"]
+        target["min"] = min(target["min"], source["min"])
+        target["max"] = max(target["max"], source["max"])
+
+
+def create_retry_buffer(conf, time_format):
+    '''
+    Creates retry buffer.
+
+    Parameters
+    ----------
+    conf: dict
+        Retry buffer config. If None, defaults are used.
+    time_format: str
+        Time format of sensor readings.
+
+    Returns
+    -------
+    buffer: RetryBuffer
+    '''
+    if conf is None:
+        conf = {}
+    return RetryBuffer(conf.get(max_bytes, default_max_bytes), conf.get(period, default_period), time_format)
@@ -17,14 +17,16 @@ on_connect_load_sensor(client, userdata, flags, rc,props)
 on_connect_fuel_sensor(client, userdata, flags, rc,props)
     Logic executed after successfully establishing connection between fuel sensor and MQTT broker.
 
-measure_temperature_periodically(period, min_val, avg_val, broker_address, broker_port,mqtt_username,mqtt_pass, flag)
+measure_temperature_periodically(period, min_val, avg_val, broker_address, broker_port,mqtt_username,mqtt_pass, flag,
+                                 tls_config, watchdog_config)
     Periodically generates value representing current temperature.
 
-measure_load_randomly(min_t, max_t, min_val, max_val, broker_address, broker_port, mqtt_username,mqtt_pass, flag)
+measure_load_randomly(min_t, max_t, min_val, max_val, broker_address, broker_port, mqtt_username,mqtt_pass, flag,
+                      tls_config, watchdog_config)
     Periodically generates value representing current arm load mass.
 
 measure_fuel_periodically(period, capacity, consumption, efficiency, refill, broker_address, broker_port,
-                              mqtt_username, mqtt_pass, flag=
+                              mqtt_username, mqtt_pass, flag, tls_config, watchdog_config)
     Periodically generates value representing current fuel level.
 
 read_conf()
@@ -47,6 +49,8 @@ import random
 import numpy
 import json
 import math
+import tls
+import watchdog
 import paho.mqtt.client as mqtt
 from multiprocessing import Process, Event
 import logging.config
@@ -76,6 +80,8 @@ avg= "avg_val"
 mqtt_broker="mqtt_broker"
 address="address"
 port="port"
+tls_conf="tls"
+watchdog_conf="watchdog"
 
 # sensors config file
 conf_file_path = "sensor_conf.json"
@@ -89,7 +95,8 @@ temp_topic="sensors/temperature"
 load_topic="sensors/arm-load"
 fuel_topic="sensors/fuel-level"
 
-data_pattern="[ value={} , time={} , unit={} ]"
+# every sensor numbers its readings from 0, send time is UNIX time, so gateway can detect lost readings and data age
+data_pattern="[ value={} , time={} , unit={} , seq={} , sent={} ]"
 time_format = "%d.%m.%Y %H:%M:%S"
 
 celzius = "C"
@@ -182,7 +189,8 @@ def on_connect_fuel_sensor(client, userdata, flags, rc,props):
         customLogger.critical("Fuel sensor failed to establish connection with MQTT broker!")
 
 # period = measuring interval in sec, min_val/max_val = min/max measured value
-def measure_temperature_periodically(period, min_val, avg_val, broker_address, broker_port,mqtt_username,mqtt_pass, flag):
+def measure_temperature_periodically(period, min_val, avg_val, broker_address, broker_port,mqtt_username,mqtt_pass, flag,
+                                     tls_config=None, watchdog_config=None):
     '''
     Emulates temperature sensor.
 
@@ -206,6 +214,10 @@ def measure_temperature_periodically(period, min_val, avg_val, broker_address, b
         Password required for establishing connection with MQTT broker.
     flag: multiprocessing.Event
         Object used for stopping temperature sensor process.
+    tls_config: dict
+        TLS config of MQTT broker connection. If None, TLS is not used.
+    watchdog_config: dict
+        Stall watchdog config. If None, sensor is not watched.
 
     Returns
     -------
@@ -220,6 +232,11 @@ def measure_temperature_periodically(period, min_val, avg_val, broker_address, b
     # establishing connection with MQTT broker
     client = mqtt.Client(client_id="temp-sensor-mqtt-client", transport=transport_protocol, protocol=mqtt.MQTTv5)
     client.username_pw_set(username=mqtt_username, password=mqtt_pass)
+    # reconnects resume cached TLS session instead of full handshake
+    tls.configure_mqtt(client, tls_config)
+    # sensor is stalled when it hangs in connecting or reconnecting to broker
+    watchdog.configure(watchdog_config, "temperature-sensor")
+    watchdog.progress("sensor")
     client.on_connect=on_connect_temp_sensor
     client.on_publish=on_publish
     while not client.is_connected():
@@ -238,8 +255,10 @@ def measure_temperature_periodically(period, min_val, avg_val, broker_address, b
     raising=True
     # starting temp
     value = min_val
+    sequence = 0
     # shutting down sensor depending on flag
     while not flag.is_set():
+        watchdog.progress("sensor", period)
         time.sleep(period)
         # check connection to mqtt broker
         while not client.is_connected():
@@ -255,13 +274,16 @@ def measure_temperature_periodically(period, min_val, avg_val, broker_address, b
             else:
                 value = avg_val+data[counter % values_count]
                 counter += 1
-            customLogger.error("Temperature: "+data_pattern.format("{:.2f}".format(value), str(time.strftime(time_format, time.localtime())), celzius))
+            reading = data_pattern.format("{:.2f}".format(value), str(time.strftime(time_format, time.localtime())),
+                                          celzius, sequence, "{:.6f}".format(time.time()))
+            customLogger.error("Temperature: " + reading)
             # send data to MQTT broker
-            client.publish(temp_topic, data_pattern.format("{:.2f}".format(value), str(time.strftime(time_format,
-                                                                                         time.localtime())), celzius),qos=qos)
+            client.publish(temp_topic, reading, qos=qos)
         except:
             errorLogger.error("Connection between temperature sensor and MQTT broker is broken!")
             customLogger.critical("Connection between temperature sensor and MQTT broker is broken!")
+        # reading that could not be published leaves gap in sequence
+        sequence += 1
     client.loop_stop()
     client.disconnect()
     infoLogger.info("Temperature sensor shutdown!")
@@ -269,7 +291,8 @@ def measure_temperature_periodically(period, min_val, avg_val, broker_address, b
 
 
 # min_t/max_t = min/max measuring period in sec, min_val/max_val = min/max measured value
-def measure_load_randomly(min_t, max_t, min_val, max_val, broker_address, broker_port, mqtt_username,mqtt_pass, flag):
+def measure_load_randomly(min_t, max_t, min_val, max_val, broker_address, broker_port, mqtt_username,mqtt_pass, flag,
+                          tls_config=None, watchdog_config=None):
     '''
     Emulates arm load sensor.
 
@@ -295,6 +318,10 @@ def measure_load_randomly(min_t, max_t, min_val, max_val, broker_address, broker
         Password required for establishing connection with MQTT broker.
     flag: multiprocessing.Event
         Object used for stopping temperature sensor process.
+    tls_config: dict
+        TLS config of MQTT broker connection. If None, TLS is not used.
+    watchdog_config: dict
+        Stall watchdog config. If None, sensor is not watched.
 
     Returns
     -------
@@ -310,6 +337,11 @@ def measure_load_randomly(min_t, max_t, min_val, max_val, broker_address, broker
     # establishing connection with MQTT broker
     client = mqtt.Client(client_id="arm-load-sensor-mqtt-client", transport=transport_protocol, protocol=mqtt.MQTTv5)
     client.username_pw_set(username=mqtt_username, password=mqtt_pass)
+    # reconnects resume cached TLS session instead of full handshake
+    tls.configure_mqtt(client, tls_config)
+    # sensor is stalled when it hangs in connecting or reconnecting to broker
+    watchdog.configure(watchdog_config, "load-sensor")
+    watchdog.progress("sensor")
     client.on_connect = on_connect_load_sensor
     client.on_publish = on_publish
     while not client.is_connected():
@@ -327,23 +359,28 @@ def measure_load_randomly(min_t, max_t, min_val, max_val, broker_address, broker
     # measured data
     data = numpy.random.uniform(min_val, max_val, values_count)
     counter = 0
+    sequence = 0
     # shut down sensor depending on set flag
     while not flag.is_set():
-        time.sleep(round(intervals[counter % values_count]))
+        wait = round(intervals[counter % values_count])
+        watchdog.progress("sensor", wait)
+        time.sleep(wait)
         # check connection to mqtt broker
         while not client.is_connected():
             errorLogger.error("Arm load sensor lost connection to MQTT broker!")
             client.reconnect()
             time.sleep(0.1)
         try:
-            customLogger.info("Load: "+data_pattern.format("{:.2f}".format(data[counter % values_count]),
-                                      str(time.strftime(time_format, time.localtime())), kg))
+            reading = data_pattern.format("{:.2f}".format(data[counter % values_count]),
+                                          str(time.strftime(time_format, time.localtime())), kg, sequence,
+                                          "{:.6f}".format(time.time()))
+            customLogger.info("Load: " + reading)
             # send data to MQTT broker
-            client.publish(load_topic, data_pattern.format("{:.2f}".format(data[counter % values_count]),str(time.strftime(time_format, time.localtime())),kg),
-                           qos=qos)
+            client.publish(load_topic, reading, qos=qos)
         except:
             errorLogger.error("Connection between arm load sensor and MQTT broker is broken!")
             customLogger.critical("Connection between arm load sensor and MQTT broker is broken!")
+        sequence += 1
         counter += 1
     client.loop_stop()
     client.disconnect()
@@ -354,7 +391,7 @@ def measure_load_randomly(min_t, max_t, min_val, max_val, broker_address, broker
 # period = measuring interval , capacity = fuel tank capacity , refill = fuel tank refill probability (0-1)
 # consumption = fuel usage consumption per working hour, efficiency = machine work efficiency (0-1)
 def measure_fuel_periodically(period, capacity, consumption, efficiency, refill, broker_address, broker_port,
-                              mqtt_username, mqtt_pass, flag):
+                              mqtt_username, mqtt_pass, flag, tls_config=None, watchdog_config=None):
     '''
     Emulates fuel sensor.
 
@@ -382,6 +419,10 @@ def measure_fuel_periodically(period, capacity, consumption, efficiency, refill,
         Password required for establishing connection with MQTT broker.
     flag: multiprocessing.Event
         Object used for stopping temperature sensor process.
+    tls_config: dict
+        TLS config of MQTT broker connection. If None, TLS is not used.
+    watchdog_config: dict
+        Stall watchdog config. If None, sensor is not watched.
 
     Returns
     -------
@@ -398,6 +439,11 @@ def measure_fuel_periodically(period, capacity, consumption, efficiency, refill,
     # establishing connection with MQTT broker
     client = mqtt.Client(client_id="fuel-sensor-mqtt-client", transport=transport_protocol, protocol=mqtt.MQTTv5)
     client.username_pw_set(username=mqtt_username, password=mqtt_pass)
+    # reconnects resume cached TLS session instead of full handshake
+    tls.configure_mqtt(client, tls_config)
+    # sensor is stalled when it hangs in connecting or reconnecting to broker
+    watchdog.configure(watchdog_config, "fuel-sensor")
+    watchdog.progress("sensor")
     client.on_connect = on_connect_fuel_sensor
     client.on_publish = on_publish
     while not client.is_connected():
@@ -414,7 +460,9 @@ def measure_fuel_periodically(period, capacity, consumption, efficiency, refill,
     scale = 1 / (60 * 60)
     # shutting down sensor depending on set flag
     refilling = False
+    sequence = 0
     while not flag.is_set():
+        watchdog.progress("sensor", period)
         time.sleep(period)
         # fuel tank is filling
         if refilling:
@@ -437,15 +485,15 @@ def measure_fuel_periodically(period, capacity, consumption, efficiency, refill,
             client.reconnect()
             time.sleep(0.1)
         try:
-            customLogger.warning("Fuel: "+data_pattern.format("{:.2f}".format(value),
-                                      str(time.strftime(time_format, time.localtime())), liter))
+            reading = data_pattern.format("{:.2f}".format(value), str(time.strftime(time_format, time.localtime())),
+                                          liter, sequence, "{:.6f}".format(time.time()))
+            customLogger.warning("Fuel: " + reading)
             # send data to MQTT broker
-            client.publish(fuel_topic,
-                           data_pattern.format("{:.2f}".format(value),str(time.strftime(time_format, time.localtime())), liter),
-                           qos=qos)
+            client.publish(fuel_topic, reading, qos=qos)
         except:
             errorLogger.error("Connection between fuel level sensor and MQTT broker is broken!")
             customLogger.critical("Connection between fuel level sensor and MQTT broker is broken!")
+        sequence += 1
     client.loop_stop()
     client.disconnect()
     infoLogger.info("Fuel level sensor shutdown!")
@@ -505,7 +553,9 @@ def sensors_devices(temp_flag, load_flag, fuel_flag):
                                                                                 conf_data[mqtt_broker][port],
                                                                                 conf_data[mqtt_broker][mqtt_user],
                                                                                 conf_data[mqtt_broker][mqtt_password],
-                                                                                temp_flag, ))
+                                                                                temp_flag,
+                                                                                conf_data[mqtt_broker].get(tls_conf),
+                                                                                conf_data.get(watchdog_conf)))
     excavator_arm_sensor = Process(target=measure_load_randomly, args=(conf_data[arm_sensor][arm_min_t],
                                                                        conf_data[arm_sensor][arm_max_t],
                                                                        conf_data[arm_sensor][min],
@@ -514,7 +564,9 @@ def sensors_devices(temp_flag, load_flag, fuel_flag):
                                                                        conf_data[mqtt_broker][port],
                                                                        conf_data[mqtt_broker][mqtt_user],
                                                                        conf_data[mqtt_broker][mqtt_password],
-                                                                       load_flag,))
+                                                                       load_flag,
+                                                                       conf_data[mqtt_broker].get(tls_conf),
+                                                                       conf_data.get(watchdog_conf)))
     fuel_level_sensor = Process(target=measure_fuel_periodically, args=(conf_data[fuel_sensor][interval],
                                                                         conf_data[fuel_sensor][fuel_capacity],
                                                                         conf_data[fuel_sensor][fuel_consumption],
@@ -524,7 +576,9 @@ def sensors_devices(temp_flag, load_flag, fuel_flag):
                                                                         conf_data[mqtt_broker][port],
                                                                         conf_data[mqtt_broker][mqtt_user],
                                                                         conf_data[mqtt_broker][mqtt_password],
-                                                                        fuel_flag,))
+                                                                        fuel_flag,
+                                                                        conf_data[mqtt_broker].get(tls_conf),
+                                                                        conf_data.get(watchdog_conf)))
     return [temperature_sensor, excavator_arm_sensor, fuel_level_sensor]
 
 
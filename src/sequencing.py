@@ -0,0 +1,196 @@
+'''
+sequencing
+============
+Module that tracks sequence numbers and send times of sensor readings, so data handler can tell how many readings were
+lost and how old data is when it reaches cloud.
+
+Sensor devices number readings of every sensor from 0 and put UNIX send time into every reading. Data handler checks
+sequence number of every received reading - readings skipped in sequence are counted as gaps, skipped reading that
+arrives later as reorder and reading that arrives again as duplicate, so net loss is gaps minus reorders. Sequence
+number 0, or number far behind the highest one, restarts the sequence, e.g. after sensor restart.
+
+Send times of flushed readings are kept until their data is delivered to cloud, i.e. until flush or replay leaves no
+backlog behind, and then recorded as sensor-to-cloud latencies. Latency is measured between sensor and gateway clocks,
+so it includes their skew when sensors run on other machine.
+
+Readings without sequence number and send time, e.g. published by older sensors, are not tracked.
+
+Classes
+---------
+SequenceTracker
+    Tracks sequence numbers of single sensor.
+
+Functions
+---------
+parse_sequence(reading)
+    Returns sequence number and send time of reading.
+received(reading)
+    Tracks sequence number of received reading.
+flushed(readings)
+    Keeps send times of flushed readings until their data is delivered.
+delivered()
+    Records sensor-to-cloud latencies of readings whose data is delivered.
+
+Constants
+---------
+window: int
+    Number of sequence numbers behind the highest one that are tracked for late arrival.
+max_pending: int
+    Max number of kept send times of undelivered readings, send times of oldest readings are dropped first.
+'''
+import time
+import threading
+import metrics
+from collections import deque
+
+window = 1024
+max_pending = 100000
+
+# reading that continues sequence
+_in_order = (0, 0, 0, 0)
+
+
+class SequenceTracker:
+    '''
+    Tracks sequence numbers of single sensor.
+
+    Attributes
+    ---------
+    highest: int
+        Highest received sequence number, None before first reading.
+
+    Methods
+    ---------
+    observe(self, number)
+        Tracks received sequence number.
+    '''
+
+    def __init__(self):
+        '''
+        Initializes SequenceTracker object.
+        '''
+        self.highest = None
+        self._missing = set()
+
+    def observe(self, number):
+        '''
+        Tracks received sequence number.
+
+        Parameters
+        ----------
+        number: int
+            Sequence number of received reading.
+
+        Returns
+        -------
+        anomalies: tuple
+            Number of skipped readings, duplicates, late readings and sequence restarts caused by reading.
+        '''
+        highest = self.highest
+        if highest is None or (number == 0 and highest > 0) or number < highest - window:
+            self.highest = number
+            self._missing.clear()
+            return _in_order if highest is None else (0, 0, 0, 1)
+        if number == highest + 1:
+            self.highest = number
+            return _in_order
+        if number > highest:
+            self._missing.update(range(max(highest + 1, number - window), number))
+            self.highest = number
+            if len(self._missing) > 2 * window:
+                self._missing = {missing for missing in self._missing if missing >= number - window}
+            return number - highest - 1, 0, 0, 0
+        if number in self._missing:
+            self._missing.discard(number)
+            return 0, 0, 1, 0
+        return 0, 1, 0, 0
+
+
+# sequence state of current process
+_tracker = SequenceTracker()
+_pending = deque(maxlen=max_pending)
+_lock = threading.Lock()
+
+
+def parse_sequence(reading):
+    '''
+    Returns sequence number and send time of reading.
+
+    Parameters
+    ----------
+    reading: str
+        Reading in sensor_devices.data_pattern format.
+
+    Returns
+    -------
+    sequence: tuple
+        Sequence number and UNIX send time, None if reading does not carry them.
+    '''
+    number = sent = None
+    for token in reading.split(" ")[7:]:
+        if token.startswith("seq="):
+            number = token[4:]
+        elif token.startswith("sent="):
+            sent = token[5:]
+    if number is None or sent is None:
+        return None
+    try:
+        return int(number), float(sent)
+    except ValueError:
+        return None
+
+
+def received(reading):
+    '''
+    Tracks sequence number of received reading and counts anomalies in data handler's metrics. Must be called only by
+    MQTT network thread.
+
+    Parameters
+    ----------
+    reading: str
+        Received reading.
+
+    Returns
+    -------
+    '''
+    sequence = parse_sequence(reading)
+    if sequence is None:
+        return
+    anomalies = _tracker.observe(sequence[0])
+    if anomalies != _in_order:
+        metrics.sequence(*anomalies)
+
+
+def flushed(readings):
+    '''
+    Keeps send times of flushed readings until their data is delivered.
+
+    Parameters
+    ----------
+    readings: list
+        Flushed readings.
+
+    Returns
+    -------
+    '''
+    sent = [sequence[1] for sequence in map(parse_sequence, readings) if sequence is not None]
+    with _lock:
+        _pending.extend(sent)
+
+
+def delivered():
+    '''
+    Records sensor-to-cloud latencies of readings whose data is delivered. Must be called only when data handler has
+    no undelivered data left.
+
+    Parameters
+    ----------
+
+    Returns
+    -------
+    '''
+    now = time.time()
+    with _lock:
+        sent = list(_pending)
+        _pending.clear()
+    metrics.delivered([max(0.0, now - timestamp) for timestamp in sent])
@@ -0,0 +1,350 @@
+'''
+shm_ring
+============
+Module that contains shared memory ring transport for parsed sensor readings.
+
+multiprocessing.Queue pickles every item and pushes it through pipe by feeder thread. Ring keeps fixed-size reading
+records in shared memory block, producer packs reading right into free slot and consumer unpacks it right from the
+slot, so readings pass between processes without serialization and without system call per reading. Consumer sleeps
+on eventfd, or pipe where eventfd is not available, and producer wakes it only when it is waiting.
+
+Ring has single producer and single consumer. Producer is the only writer of head cursor, consumer is the only writer
+of tail cursor. Cursors are int64 values that only grow, slot of cursor is cursor modulo number of slots. Every slot
+starts with commit word that producer writes after record, set to cursor of record plus one. Consumer takes record
+only if commit word matches its cursor both before and after copying it, so on processors with weaker memory ordering
+than x86, e.g. ARM, record whose bytes are not visible yet is left for next read even if head already moved past it.
+Wakeups are additionally bounded by wake_poll_interval, so reading is never stuck because of wakeup that was missed.
+
+Classes
+---------
+ShmRing
+    Single producer, single consumer ring of reading records in shared memory.
+
+Functions
+---------
+parse_reading(reading, time_format)
+    Parses sensor reading published by sensor devices.
+
+Constants
+---------
+record_format: str
+    struct format of reading record: commit word, value, UNIX timestamp and unit.
+default_slots: int
+    Default number of ring slots.
+wake_poll_interval: float
+    Max time in seconds consumer waits before it checks ring again without wakeup.
+'''
+import os
+import time
+import select
+import struct
+from multiprocessing import shared_memory
+from multiprocessing import reduction
+import logging.config
+
+logging.config.fileConfig('logging.conf')
+infoLogger = logging.getLogger('customInfoLogger')
+errorLogger = logging.getLogger('customErrorLogger')
+customLogger = logging.getLogger('customConsoleLogger')
+
+record_format = "<qdd16s"
+default_slots = 4096
+wake_poll_interval = 0.05
+
+_record = struct.Struct(record_format)
+# record without commit word, which is written separately after it
+_payload = struct.Struct("<" + record_format[2:])
+# record size in int64 words, commit word is first word of record
+_record_words = _record.size // 8
+# cursors are kept on separate cache lines, so producer and consumer do not invalidate each other's line
+_cache_line = 64
+_head = 0
+_tail = _cache_line // 8
+_waiting = 2 * _cache_line // 8
+_dropped = 3 * _cache_line // 8
+_header_size = 4 * _cache_line
+
+
+class ShmRing:
+    '''
+    Single producer, single consumer ring of reading records in shared memory.
+
+    Ring is created by parent process and passed to producer and consumer processes as process argument.
+
+    Attributes
+    ---------
+    name: str
+        Shared memory block name.
+    slots: int
+        Number of record slots.
+
+    Methods
+    ---------
+    push(self, value, timestamp, unit)
+        Puts reading into ring.
+    push_many(self, readings)
+        Puts readings into ring.
+    pop_many(self, max_items, timeout)
+        Takes readings from ring.
+    dropped(self)
+        Returns number of readings dropped because ring was full.
+    close(self)
+        Detaches ring from current process.
+    unlink(self)
+        Frees shared memory block.
+    '''
+    def __init__(self, slots=default_slots, name=None, wakeup=None):
+        '''
+        Initializes ShmRing object.
+
+        Parameters
+        ----------
+        slots: int
+            Number of record slots.
+        name: str
+            Name of existing ring to attach, new ring is created if None.
+        wakeup: tuple
+            Read and write file descriptors of existing ring's wakeup channel.
+        '''
+        self.slots = slots
+        size = _header_size + slots * _record.size
+        if name is None:
+            self._memory = shared_memory.SharedMemory(create=True, size=size)
+            self._memory.buf[:_header_size] = bytes(_header_size)
+            if hasattr(os, "eventfd"):
+                descriptor = os.eventfd(0, os.EFD_NONBLOCK)
+                wakeup = (descriptor, descriptor)
+            else:
+                wakeup = os.pipe()
+                os.set_blocking(wakeup[0], False)
+        else:
+            self._memory = shared_memory.SharedMemory(name=name)
+        self.name = self._memory.name
+        self._wakeup = wakeup
+        self._header = self._memory.buf[:_header_size].cast("q")
+        self._records = self._memory.buf[_header_size:size]
+        self._commits = self._records.cast("q")
+
+    def __getstate__(self):
+        # eventfd is both read and write end, so it is passed once
+        return {"slots": self.slots, "name": self.name,
+                "wakeup": tuple(reduction.DupFd(descriptor) for descriptor in dict.fromkeys(self._wakeup))}
+
+    def __setstate__(self, state):
+        wakeup = tuple(descriptor.detach() for descriptor in state["wakeup"])
+        self.__init__(state["slots"], state["name"], wakeup if len(wakeup) == 2 else wakeup * 2)
+
+    def __del__(self):
+        # views of block must be released before block is closed on garbage collection
+        if hasattr(self, "_header"):
+            self._header.release()
+            self._commits.release()
+            self._records.release()
+
+    def push(self, value, timestamp, unit):
+        '''
+        Puts reading into ring.
+
+        Must be called only by producer. Reading is dropped if ring is full, producer is never blocked.
+
+        Parameters
+        ----------
+        value: float
+            Measured value.
+        timestamp: float
+            Measurement time as UNIX timestamp.
+        unit: str
+            Measurement unit, truncated to 16 bytes.
+
+        Returns
+        -------
+        pushed: bool
+            Whether reading was put into ring.
+        '''
+        header = self._header
+        head = header[_head]
+        if head - header[_tail] >= self.slots:
+            header[_dropped] += 1
+            return False
+        self._write(head, value, timestamp, unit)
+        header[_head] = head + 1
+        if header[_waiting]:
+            self._wake()
+        return True
+
+    def push_many(self, readings):
+        '''
+        Puts readings into ring.
+
+        Must be called only by producer. Readings that do not fit into ring are dropped.
+
+        Parameters
+        ----------
+        readings: list
+            Readings as (value, timestamp, unit) tuples.
+
+        Returns
+        -------
+        pushed: int
+            Number of readings put into ring.
+        '''
+        header = self._header
+        head = header[_head]
+        count = min(len(readings), self.slots - (head - header[_tail]))
+        for index in range(count):
+            self._write(head + index, *readings[index])
+        header[_head] = head + count
+        if count < len(readings):
+            header[_dropped] += len(readings) - count
+        if count > 0 and header[_waiting]:
+            self._wake()
+        return count
+
+    def pop_many(self, max_items=None, timeout=None):
+        '''
+        Takes readings from ring.
+
+        Must be called only by consumer. Waits until at least one reading is available or timeout expires.
+
+        Parameters
+        ----------
+        max_items: int
+            Max number of taken readings, all available readings are taken if None.
+        timeout: float
+            Max waiting time [s], 0 for no waiting, None for no limit.
+
+        Returns
+        -------
+        readings: list
+            Readings as (value, timestamp, unit) tuples, empty if timeout expired.
+        '''
+        header = self._header
+        tail = header[_tail]
+        head = header[_head]
+        if head == tail and timeout != 0:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while head == tail:
+                remaining = wake_poll_interval if deadline is None else deadline - time.monotonic()
+                if remaining <= 0:
+                    return []
+                # producer checks flag after it moves head, so head is checked again after flag is set
+                header[_waiting] = 1
+                head = header[_head]
+                if head == tail:
+                    select.select([self._wakeup[0]], [], [], min(remaining, wake_poll_interval))
+                    self._drain_wakeup()
+                    head = header[_head]
+                header[_waiting] = 0
+        count = head - tail
+        if max_items is not None:
+            count = min(count, max_items)
+        records = self._records
+        commits = self._commits
+        readings = []
+        for cursor in range(tail, tail + count):
+            slot = cursor % self.slots
+            if commits[slot * _record_words] != cursor + 1:
+                break
+            value, timestamp, unit = _payload.unpack_from(records, slot * _record.size + 8)
+            if commits[slot * _record_words] != cursor + 1:
+                break
+            # unit truncated by producer may end with part of multi-byte character
+            readings.append((value, timestamp, unit.rstrip(b"\0").decode("utf-8", errors="ignore")))
+        header[_tail] = tail + len(readings)
+        return readings
+
+    def dropped(self):
+        '''
+        Returns number of readings dropped because ring was full.
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        dropped: int
+        '''
+        return self._header[_dropped]
+
+    def close(self):
+        '''
+        Detaches ring from current process.
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        '''
+        self._header.release()
+        self._commits.release()
+        self._records.release()
+        self._memory.close()
+        for descriptor in set(self._wakeup):
+            os.close(descriptor)
+
+    def unlink(self):
+        '''
+        Frees shared memory block. Must be called once, by process that created ring.
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        '''
+        self._memory.unlink()
+
+    def _write(self, cursor, value, timestamp, unit):
+        slot = cursor % self.slots
+        _payload.pack_into(self._records, slot * _record.size + 8, value, timestamp, unit.encode("utf-8"))
+        self._commits[slot * _record_words] = cursor + 1
+
+    def _wake(self):
+        try:
+            if self._wakeup[0] == self._wakeup[1]:
+                os.eventfd_write(self._wakeup[1], 1)
+            else:
+                os.write(self._wakeup[1], b"\0")
+        except BlockingIOError:
+            # wakeup is already pending
+            pass
+
+    def _drain_wakeup(self):
+        try:
+            if self._wakeup[0] == self._wakeup[1]:
+                os.eventfd_read(self._wakeup[0])
+            else:
+                os.read(self._wakeup[0], 4096)
+        except BlockingIOError:
+            pass
+
+
+def parse_reading(reading, time_format):
+    '''
+    Parses sensor reading published by sensor devices.
+
+    Parameters
+    ----------
+    reading: str
+        Reading in sensor_devices.data_pattern format.
+    time_format: str
+        Time format of reading.
+
+    Returns
+    -------
+    reading: tuple
+        Value, UNIX timestamp and unit, or None if reading can not be parsed.
+    '''
+    try:
+        tokens = reading.split(" ")
+        value = float(tokens[1].split("=")[1])
+    except (IndexError, ValueError):
+        errorLogger.error("Invalid sensor data format! - " + reading)
+        return None
+    try:
+        timestamp = time.mktime(time.strptime(tokens[3].split("=")[1] + " " + tokens[4], time_format))
+    except (IndexError, ValueError):
+        timestamp = time.time()
+    unit = tokens[6].split("=")[1] if len(tokens) > 6 and "=" in tokens[6] else "unknown"
+    return value, timestamp, unit
@@ -0,0 +1,900 @@
+'''
+standins
+============
+Module with local stand-ins of cloud services and MQTT broker, used by benchmarks instead of real cloud platform and
+broker.
+
+Every stand-in listens on localhost, answers requests after configurable latency and counts accepted connections and
+requests, so benchmarks can compare protocols and connection handling without network noise. Given certificate and
+key files, HTTP/1.1 stand-in serves over TLS. Fault proxy placed in front of stand-in brings network noise back in
+controlled way, so behaviour of gateway on lossy, high-latency links can be measured.
+
+Classes
+---------
+Http1StandIn
+    HTTP/1.1 stand-in with persistent connections.
+H2StandIn
+    HTTP/2 stand-in (h2c, prior knowledge) with multiplexed streams. Requires optional h2 package.
+CloudStandIn
+    Stand-in of cloud platform REST API that records arrival of every request.
+MqttBrokerStandIn
+    Minimal in-process MQTT broker.
+FaultProxyStandIn
+    TCP proxy that injects latency, jitter, bandwidth cap, connection resets and blackouts.
+'''
+import os
+import json
+import gzip
+import time
+import queue
+import base64
+import random
+import socket
+import struct
+import ssl
+import sys
+import weakref
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+try:
+    import h2.config
+    import h2.connection
+    import h2.events
+except ImportError:
+    h2 = None
+
+
+class Http1StandIn:
+    '''
+    HTTP/1.1 stand-in with persistent connections.
+
+    Attributes
+    ---------
+    latency: float
+        Response delay [s].
+    status: int
+        Http status code of responses.
+    url: str
+        Base URL of stand-in.
+    connections: int
+        Number of accepted connections.
+    requests: int
+        Number of received requests.
+    header_bytes: int
+        Number of received request line and header bytes.
+    handshakes: int
+        Number of TLS handshakes.
+    resumed: int
+        Number of TLS handshakes that resumed session.
+
+    Methods
+    ---------
+    close(self)
+        Stops stand-in.
+    '''
+    def __init__(self, latency=0.0, status=200, certfile=None, keyfile=None):
+        '''
+        Initializes Http1StandIn object and starts serving in background thread.
+
+        Parameters
+        ----------
+        latency: float
+            Response delay [s].
+        status: int
+            Http status code of responses.
+        certfile: str
+            Server certificate file, None for plain HTTP.
+        keyfile: str
+            Server private key file.
+        '''
+        self.latency = latency
+        self.status = status
+        self.connections = 0
+        self.requests = 0
+        self.header_bytes = 0
+        self.handshakes = 0
+        self.resumed = 0
+        self._lock = threading.Lock()
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # TLS 1.3 session tickets are sent right after handshake, response must not wait for their ACK
+            disable_nagle_algorithm = True
+
+            def setup(self):
+                with stand_in._lock:
+                    stand_in.connections += 1
+                    if isinstance(self.request, ssl.SSLSocket):
+                        stand_in.handshakes += 1
+                        stand_in.resumed += int(self.request.session_reused)
+                super().setup()
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                with stand_in._lock:
+                    stand_in.requests += 1
+                    stand_in.header_bytes += len(self.requestline) + 2 + len(self.headers.as_bytes())
+                if stand_in.latency > 0:
+                    threading.Event().wait(stand_in.latency)
+                self.send_response(stand_in.status)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        self.url = "http://127.0.0.1:" + str(self._server.server_address[1])
+        if certfile is not None:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(certfile, keyfile)
+            self._server.socket = context.wrap_socket(self._server.socket, server_side=True)
+            self.url = "https://localhost:" + str(self._server.server_address[1])
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def close(self):
+        '''
+        Stops stand-in.
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        '''
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class H2StandIn:
+    '''
+    HTTP/2 stand-in (h2c, prior knowledge) with multiplexed streams.
+
+    Every stream is answered independently after latency, so concurrent requests on single connection overlap.
+
+    Attributes
+    ---------
+    latency: float
+        Response delay [s].
+    status: int
+        Http status code of responses.
+    url: str
+        Base URL of stand-in.
+    connections: int
+        Number of accepted connections.
+    requests: int
+        Number of received requests.
+    header_bytes: int
+        Number of received HPACK encoded header bytes.
+
+    Methods
+    ---------
+    close(self)
+        Stops stand-in.
+    '''
+    def __init__(self, latency=0.0, status=200):
+        '''
+        Initializes H2StandIn object and starts serving in background thread.
+
+        Parameters
+        ----------
+        latency: float
+            Response delay [s].
+        status: int
+            Http status code of responses.
+        '''
+        if h2 is None:
+            raise RuntimeError("HTTP/2 stand-in requires h2 package!")
+        self.latency = latency
+        self.status = status
+        self.connections = 0
+        self.requests = 0
+        self.header_bytes = 0
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._socket = socket.create_server(("127.0.0.1", 0))
+        self.url = "http://127.0.0.1:" + str(self._socket.getsockname()[1])
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while not self._closed.is_set():
+            try:
+                connection, _ = self._socket.accept()
+            except OSError:
+                return
+            with self._lock:
+                self.connections += 1
+            threading.Thread(target=self._serve, args=(connection,), daemon=True).start()
+
+    def _serve(self, connection):
+        protocol = h2.connection.H2Connection(config=h2.config.H2Configuration(client_side=False))
+        protocol.initiate_connection()
+        write_lock = threading.Lock()
+
+        def respond(stream_id):
+            with write_lock:
+                try:
+                    protocol.send_headers(stream_id, [(":status", str(self.status)), ("content-length", "0")],
+                                          end_stream=True)
+                    connection.sendall(protocol.data_to_send())
+                except Exception:
+                    pass
+
+        with write_lock:
+            connection.sendall(protocol.data_to_send())
+        while not self._closed.is_set():
+            try:
+                data = connection.recv(65536)
+            except OSError:
+                break
+            if not data:
+                break
+            with write_lock:
+                # header block sizes are taken from HEADERS frames (type 0x1) before they are decoded
+                self._count_header_bytes(data)
+                events = protocol.receive_data(data)
+                for event in events:
+                    if isinstance(event, h2.events.DataReceived):
+                        protocol.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+                    elif isinstance(event, h2.events.StreamEnded):
+                        with self._lock:
+                            self.requests += 1
+                        threading.Timer(self.latency, respond, (event.stream_id,)).start()
+                connection.sendall(protocol.data_to_send())
+        connection.close()
+
+    def _count_header_bytes(self, data):
+        # rough count, frames split across reads are skipped
+        position = 24 if data.startswith(b"PRI * HTTP/2.0") else 0
+        while position + 9 <= len(data):
+            length = int.from_bytes(data[position:position + 3], "big")
+            if data[position + 3] == 0x1:
+                with self._lock:
+                    self.header_bytes += length
+            position += 9 + length
+
+    def close(self):
+        '''
+        Stops stand-in.
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        '''
+        self._closed.set()
+        self._socket.close()
+
+
+class _QuietHTTPServer(ThreadingHTTPServer):
+
+    def handle_error(self, request, client_address):
+        # connections closed by client or by fault proxy are expected
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class CloudStandIn:
+    '''
+    Stand-in of cloud platform REST API that records arrival of every request.
+
+    Login and signup return JWT that does not expire during benchmark, and JWT check accepts every token. Every POST,
+    e.g. /data/temp or /stats, is answered after latency with status, and its arrival time and body are recorded by
+    path.
+
+    Attributes
+    ---------
+    latency: float
+        Response delay [s].
+    status: int
+        Http status code of responses to POST requests.
+    url: str
+        Base URL of stand-in, used as cloud services' URL.
+    arrivals: dict
+        UNIX timestamps of received POST requests by path.
+    bodies: dict
+        Bodies of received POST requests by path, in order of arrival, decompressed if they were gzip compressed.
+    body_bytes: int
+        Number of received request body bytes, as sent.
+
+    Methods
+    ---------
+    close(self)
+        Stops stand-in.
+    '''
+    def __init__(self, latency=0.0, status=200):
+        '''
+        Initializes CloudStandIn object and starts serving in background thread.
+
+        Parameters
+        ----------
+        latency: float
+            Response delay [s].
+        status: int
+            Http status code of responses to POST requests.
+        '''
+        self.latency = latency
+        self.status = status
+        self.arrivals = {}
+        self.bodies = {}
+        self.body_bytes = 0
+        self._lock = threading.Lock()
+        encode = lambda part: base64.urlsafe_b64encode(json.dumps(part).encode("utf-8")).decode("utf-8").rstrip("=")
+        jwt = (encode({"alg": "HS256", "typ": "JWT"}) + "." +
+               encode({"sub": "iotdevice", "exp": int(time.time()) + 30 * 24 * 60 * 60}) + ".c3RhbmQtaW4")
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                # login and JWT check
+                self._respond(200, jwt.encode("utf-8") if self.path.startswith("/auth/login") else b"")
+
+            def do_POST(self):
+                arrival = time.time()
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length)
+                if len(body) < length:
+                    # connection was closed before whole request arrived
+                    self.close_connection = True
+                    return
+                path = self.path.split("?")[0]
+                if path.startswith("/auth/"):
+                    self._respond(200, jwt.encode("utf-8"))
+                    return
+                with stand_in._lock:
+                    stand_in.body_bytes += len(body)
+                    if self.headers.get("Content-Encoding") == "gzip":
+                        body = gzip.decompress(body)
+                    stand_in.arrivals.setdefault(path, []).append(arrival)
+                    stand_in.bodies.setdefault(path, []).append(body)
+                if stand_in.latency > 0:
+                    threading.Event().wait(stand_in.latency)
+                self._respond(stand_in.status, b"")
+
+            def _respond(self, status, body):
+                self.send_response(status)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = _QuietHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        self.url = "http://127.0.0.1:" + str(self._server.server_address[1])
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def close(self):
+        '''
+        Stops stand-in.
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        '''
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def _read_packet(connection):
+    header = connection.recv(1)
+    if not header:
+        return None, None
+    length = 0
+    for shift in range(0, 28, 7):
+        byte = connection.recv(1)
+        if not byte:
+            return None, None
+        length |= (byte[0] & 0x7f) << shift
+        if byte[0] < 0x80:
+            break
+    body = b""
+    while len(body) < length:
+        chunk = connection.recv(length - len(body))
+        if not chunk:
+            return None, None
+        body += chunk
+    return header[0], body
+
+
+def _packet(header, body):
+    length = len(body)
+    encoded = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        encoded.append(byte | (0x80 if length > 0 else 0))
+        if length == 0:
+            break
+    return bytes([header]) + bytes(encoded) + body
+
+
+def _skip_properties(body, position):
+    length = 0
+    for shift in range(0, 28, 7):
+        byte = body[position]
+        position += 1
+        length |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            break
+    return position + length
+
+
+def _matches(topic_filter, topic):
+    filter_levels = topic_filter.split("/")
+    topic_levels = topic.split("/")
+    for index, level in enumerate(filter_levels):
+        if level == "#":
+            return True
+        if index >= len(topic_levels) or (level != "+" and level != topic_levels[index]):
+            return False
+    return len(filter_levels) == len(topic_levels)
+
+
+class _Session:
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.version = 4
+        self.subscriptions = {}
+        self.next_id = 0
+        self.lock = threading.Lock()
+
+    def send(self, data):
+        with self.lock:
+            self.connection.sendall(data)
+
+    def packet_id(self):
+        with self.lock:
+            self.next_id = self.next_id % 65535 + 1
+            return self.next_id
+
+
+class MqttBrokerStandIn:
+    '''
+    Minimal in-process MQTT broker.
+
+    Broker speaks MQTT 3.1.1 and 5 without authentication, retained messages, persistent sessions and will messages.
+    Messages of all QoS levels are routed to matching subscriptions, with + and # wildcards, at lower of publish and
+    subscription QoS. QoS 2 messages are routed when PUBLISH arrives, duplicates are dropped until PUBREL. Slow
+    subscriber slows down publishers through TCP flow control, messages are never dropped.
+
+    Attributes
+    ---------
+    address: str
+        Address broker listens on.
+    port: int
+        Port broker listens on.
+    connections: int
+        Number of accepted connections.
+    subscriptions: int
+        Number of received subscriptions.
+    published: int
+        Number of messages received from publishers.
+    delivered: int
+        Number of messages routed to subscribers.
+
+    Methods
+    ---------
+    close(self)
+        Stops broker.
+    '''
+    def __init__(self, port=0):
+        '''
+        Initializes MqttBrokerStandIn object and starts serving in background thread.
+
+        Parameters
+        ----------
+        port: int
+            Port broker listens on, 0 for any free port.
+        '''
+        self.connections = 0
+        self.subscriptions = 0
+        self.published = 0
+        self.delivered = 0
+        self._sessions = []
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._socket = socket.create_server(("127.0.0.1", port))
+        self.address = "127.0.0.1"
+        self.port = self._socket.getsockname()[1]
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while not self._closed.is_set():
+            try:
+                connection, _ = self._socket.accept()
+            except OSError:
+                return
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            session = _Session(connection)
+            with self._lock:
+                self.connections += 1
+                self._sessions.append(session)
+            threading.Thread(target=self._serve, args=(session,), daemon=True).start()
+
+    def _serve(self, session):
+        # packet ids of QoS 2 messages received but not released yet
+        receiving = set()
+        try:
+            while not self._closed.is_set():
+                header, body = _read_packet(session.connection)
+                if header is None:
+                    break
+                kind = header >> 4
+                if kind == 1:
+                    # CONNECT, protocol level follows protocol name
+                    session.version = body[2 + int.from_bytes(body[:2], "big")]
+                    session.send(_packet(0x20, b"\0\0\0" if session.version == 5 else b"\0\0"))
+                elif kind == 3:
+                    self._publish(session, header, body, receiving)
+                elif kind == 6:
+                    # PUBREL
+                    receiving.discard(int.from_bytes(body[:2], "big"))
+                    session.send(_packet(0x70, body[:2]))
+                elif kind == 5:
+                    # PUBREC of message routed to this subscriber
+                    session.send(_packet(0x62, body[:2]))
+                elif kind == 8:
+                    self._subscribe(session, body)
+                elif kind == 10:
+                    # UNSUBSCRIBE, subscriptions end with session
+                    session.send(_packet(0xb0, body[:2] + (b"\0" if session.version == 5 else b"")))
+                elif kind == 12:
+                    session.send(_packet(0xd0, b""))
+                elif kind == 14:
+                    break
+        except OSError:
+            pass
+        with self._lock:
+            self._sessions.remove(session)
+        session.connection.close()
+
+    def _subscribe(self, session, body):
+        position = 2
+        if session.version == 5:
+            position = _skip_properties(body, position)
+        granted = bytearray()
+        while position < len(body):
+            length = int.from_bytes(body[position:position + 2], "big")
+            topic_filter = body[position + 2:position + 2 + length].decode("utf-8")
+            options = body[position + 2 + length]
+            position += 3 + length
+            with self._lock:
+                session.subscriptions[topic_filter] = options & 0x03
+                self.subscriptions += 1
+            granted.append(options & 0x03)
+        session.send(_packet(0x90, body[:2] + (b"\0" if session.version == 5 else b"") + bytes(granted)))
+
+    def _publish(self, session, header, body, receiving):
+        qos = (header >> 1) & 0x03
+        length = int.from_bytes(body[:2], "big")
+        topic = body[2:2 + length].decode("utf-8")
+        position = 2 + length
+        packet_id = body[position:position + 2] if qos > 0 else None
+        position += 2 if qos > 0 else 0
+        if session.version == 5:
+            position = _skip_properties(body, position)
+        payload = body[position:]
+        duplicate = qos == 2 and packet_id in receiving
+        if qos == 2:
+            receiving.add(packet_id)
+        if not duplicate:
+            with self._lock:
+                self.published += 1
+                targets = [(subscriber, min(qos, max(granted for topic_filter, granted
+                                                    in subscriber.subscriptions.items()
+                                                    if _matches(topic_filter, topic))))
+                           for subscriber in self._sessions
+                           if any(_matches(topic_filter, topic) for topic_filter in subscriber.subscriptions)]
+            for subscriber, delivery_qos in targets:
+                encoded_topic = length.to_bytes(2, "big") + topic.encode("utf-8")
+                if delivery_qos > 0:
+                    encoded_topic += subscriber.packet_id().to_bytes(2, "big")
+                properties = b"\0" if subscriber.version == 5 else b""
+                try:
+                    subscriber.send(_packet(0x30 | delivery_qos << 1, encoded_topic + properties + payload))
+                    with self._lock:
+                        self.delivered += 1
+                except OSError:
+                    pass
+        if qos == 1:
+            session.send(_packet(0x40, packet_id))
+        elif qos == 2:
+            session.send(_packet(0x50, packet_id))
+
+    def close(self):
+        '''
+        Stops broker.
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        '''
+        self._closed.set()
+        self._socket.close()
+        with self._lock:
+            sessions = list(self._sessions)
+        for session in sessions:
+            try:
+                session.connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+# sockets of proxies are closed in forked processes, copies of their descriptors would keep reset connections open
+_proxies = weakref.WeakSet()
+
+
+def _close_proxies_in_child():
+    for proxy in list(_proxies):
+        for connection in [proxy._socket] + [connection for link in list(proxy._links)
+                                             for connection in (link.client, link.server) if connection is not None]:
+            connection.close()
+
+
+os.register_at_fork(after_in_child=_close_proxies_in_child)
+
+
+class _Link:
+
+    def __init__(self, client):
+        self.client = client
+        self.server = None
+        self.open_directions = 2
+        self.closed = False
+
+
+class FaultProxyStandIn:
+    '''
+    TCP proxy that injects network faults between gateway and cloud or broker stand-in.
+
+    Every chunk of data is held for latency plus random jitter, and chunks of one direction keep their order, as they
+    do in TCP stream. Each direction of connection is paced to bandwidth cap. During blackout no data passes in either
+    direction, and new connections are accepted but connected to target only after blackout, like link that silently
+    drops packets. Reset closes all open connections with TCP RST. Faults can be changed at any time and apply to data
+    that arrives afterwards.
+
+    Attributes
+    ---------
+    address: str
+        Address proxy listens on.
+    port: int
+        Port proxy listens on.
+    latency: float
+        One-way delay [s].
+    jitter: float
+        Max random deviation of delay [s].
+    bandwidth: float
+        Throughput cap of each direction of connection [bytes/s], None for no cap.
+    connections: int
+        Number of accepted connections.
+    resets: int
+        Number of connections closed by reset.
+    forwarded_bytes: int
+        Number of bytes forwarded in both directions.
+
+    Methods
+    ---------
+    blackout(self, seconds)
+        Stops all traffic for given time.
+    reset(self)
+        Closes all open connections with TCP RST.
+    close(self)
+        Stops proxy.
+    '''
+    def __init__(self, target_address, target_port, port=0, seed=None):
+        '''
+        Initializes FaultProxyStandIn object, without faults, and starts serving in background thread.
+
+        Parameters
+        ----------
+        target_address: str
+            Address of proxied service.
+        target_port: int
+            Port of proxied service.
+        port: int
+            Port proxy listens on, 0 for any free port.
+        seed: int
+            Seed of jitter, so runs of scenario can be repeated.
+        '''
+        self.target_address = target_address
+        self.target_port = target_port
+        self.latency = 0.0
+        self.jitter = 0.0
+        self.bandwidth = None
+        self.connections = 0
+        self.resets = 0
+        self.forwarded_bytes = 0
+        self._blackout_end = 0.0
+        self._random = random.Random(seed)
+        self._links = []
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._socket = socket.create_server(("127.0.0.1", port))
+        self.address = "127.0.0.1"
+        self.port = self._socket.getsockname()[1]
+        _proxies.add(self)
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def blackout(self, seconds):
+        '''
+        Stops all traffic for given time. Blackout that is already in progress is extended if it ends earlier.
+
+        Parameters
+        ----------
+        seconds: float
+            Blackout duration [s].
+
+        Returns
+        -------
+        '''
+        with self._lock:
+            self._blackout_end = max(self._blackout_end, time.monotonic() + seconds)
+
+    def reset(self):
+        '''
+        Closes all open connections with TCP RST.
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        reset: int
+            Number of closed connections.
+        '''
+        with self._lock:
+            links = list(self._links)
+        for link in links:
+            self._close(link, True)
+        with self._lock:
+            self.resets += len(links)
+        return len(links)
+
+    def _link_up(self):
+        # waits until blackout ends, returns False if proxy is closed meanwhile
+        while not self._closed.is_set():
+            remaining = self._blackout_end - time.monotonic()
+            if remaining <= 0:
+                return True
+            self._closed.wait(remaining)
+        return False
+
+    def _accept(self):
+        while not self._closed.is_set():
+            try:
+                connection, _ = self._socket.accept()
+            except OSError:
+                return
+            with self._lock:
+                self.connections += 1
+            threading.Thread(target=self._open, args=(connection,), daemon=True).start()
+
+    def _open(self, client):
+        link = _Link(client)
+        with self._lock:
+            self._links.append(link)
+        if self._link_up():
+            try:
+                link.server = socket.create_connection((self.target_address, self.target_port), timeout=10)
+                link.server.settimeout(None)
+            except OSError:
+                pass
+        if link.server is None:
+            self._close(link, True)
+            return
+        with self._lock:
+            closed = link.closed
+        if closed:
+            link.server.close()
+            return
+        for connection in (link.client, link.server):
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        for source, target in ((link.client, link.server), (link.server, link.client)):
+            chunks = queue.Queue()
+            threading.Thread(target=self._read, args=(source, chunks), daemon=True).start()
+            threading.Thread(target=self._write, args=(link, target, chunks), daemon=True).start()
+
+    def _read(self, source, chunks):
+        release = 0.0
+        while True:
+            try:
+                data = source.recv(65536)
+            except OSError:
+                data = b""
+            delay = self.latency + (self._random.uniform(-self.jitter, self.jitter) if self.jitter > 0 else 0.0)
+            release = max(release, time.monotonic() + max(0.0, delay))
+            chunks.put((release, data))
+            if len(data) == 0:
+                return
+
+    def _write(self, link, target, chunks):
+        next_send = 0.0
+        while True:
+            release, data = chunks.get()
+            delay = release - time.monotonic()
+            if delay > 0:
+                self._closed.wait(delay)
+            if not self._link_up() or link.closed:
+                return
+            if len(data) == 0:
+                self._half_close(link, target)
+                return
+            bandwidth = self.bandwidth
+            # data is split, so capped link delivers it gradually instead of in bursts
+            step = len(data) if bandwidth is None else max(1, int(bandwidth / 50))
+            for offset in range(0, len(data), step):
+                piece = data[offset:offset + step]
+                if bandwidth is not None:
+                    now = time.monotonic()
+                    if next_send > now:
+                        self._closed.wait(next_send - now)
+                    next_send = max(next_send, now) + len(piece) / bandwidth
+                if not self._link_up() or link.closed:
+                    return
+                try:
+                    target.sendall(piece)
+                except OSError:
+                    self._close(link, False)
+                    return
+                with self._lock:
+                    self.forwarded_bytes += len(piece)
+
+    def _half_close(self, link, target):
+        try:
+            target.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+        with self._lock:
+            link.open_directions -= 1
+            finished = link.open_directions == 0
+        if finished:
+            self._close(link, False)
+
+    def _close(self, link, reset):
+        with self._lock:
+            if link.closed:
+                return
+            link.closed = True
+            self._links.remove(link)
+        for connection in (link.client, link.server):
+            if connection is None:
+                continue
+            try:
+                # connection to target is closed gracefully, reset is injected towards client only
+                if reset and connection is link.client:
+                    connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+                # wakes up reading thread, close alone does not interrupt blocked recv
+                connection.shutdown(socket.SHUT_RD)
+            except OSError:
+                pass
+            connection.close()
+
+    def close(self):
+        '''
+        Stops proxy and closes all open connections.
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        '''
+        self._closed.set()
+        self._socket.close()
+        with self._lock:
+            links = list(self._links)
+        for link in links:
+            self._close(link, False)
@@ -0,0 +1,255 @@
+'''
+startup
+============
+Module that contains gateway startup helpers.
+
+After power cycle, data handlers have to connect to MQTT broker and cloud services and gateway has to obtain JWT
+before first data is forwarded. Handlers bring up MQTT and HTTP connections concurrently, MQTT connection is retried
+in background with bounded backoff instead of blocking handler, and data is collected right away and kept buffered
+until JWT is ready. Startup timer collects time of every startup phase from all processes and reports breakdown, so
+time to first forward can be tracked.
+
+Classes
+---------
+StartupTimer
+    Collects startup phase timings from all gateway processes.
+
+Functions
+---------
+connect_mqtt(client, address, port, keepalive, timer, phase)
+    Starts connecting MQTT client in background.
+
+Constants
+---------
+min_connect_delay: float
+    Time in seconds before first MQTT connect retry.
+max_connect_delay: float
+    Max time in seconds between MQTT connect retries.
+report_timeout: float
+    Time in seconds after which startup breakdown is reported even if some phases have not completed.
+'''
+import json
+import time
+import threading
+from multiprocessing import Queue
+from queue import Empty
+import logging.config
+
+logging.config.fileConfig('logging.conf')
+infoLogger = logging.getLogger('customInfoLogger')
+errorLogger = logging.getLogger('customErrorLogger')
+customLogger = logging.getLogger('customConsoleLogger')
+
+min_connect_delay = 0.2
+max_connect_delay = 10.0
+report_timeout = 300.0
+
+# suffix of phases that mark first delivered data of stream
+first_forward_suffix = "_first_forward"
+
+
+class StartupTimer:
+    '''
+    Collects startup phase timings from all gateway processes.
+
+    Timer is created by main process and passed to data handler processes as process argument. Every process marks
+    phases it completed, and reporting thread of main process logs breakdown once all expected phases are marked.
+
+    Attributes
+    ---------
+    started: float
+        Startup time as UNIX timestamp.
+    phases: list
+        Names of phases expected to complete during startup.
+    timeout: float
+        Time after which breakdown is reported even if some phases have not completed [s].
+
+    Methods
+    ---------
+    mark(self, phase)
+        Marks phase as completed.
+    mark_when(self, wait, phase)
+        Marks phase as completed once wait function returns.
+    start(self)
+        Starts reporting thread.
+    stop(self)
+        Reports breakdown of phases completed so far and stops reporting thread.
+    breakdown(self)
+        Returns startup breakdown.
+    '''
+    def __init__(self, phases, timeout=report_timeout):
+        '''
+        Initializes StartupTimer object.
+
+        Parameters
+        ----------
+        phases: list
+            Names of phases expected to complete during startup.
+        timeout: float
+            Time after which breakdown is reported even if some phases have not completed [s].
+        '''
+        self.started = time.time()
+        self.phases = list(phases)
+        self.timeout = timeout
+        self._marks = Queue()
+        # phases marked by current process, so every phase is sent once
+        self._marked = set()
+        self._completed = {}
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_marked"] = set()
+        state["_completed"] = {}
+        state["_stopped"] = None
+        state["_thread"] = None
+        return state
+
+    def mark(self, phase):
+        '''
+        Marks phase as completed.
+
+        Only first mark of phase in current process is recorded.
+
+        Parameters
+        ----------
+        phase: str
+            Phase name.
+
+        Returns
+        -------
+        '''
+        if phase in self._marked:
+            return
+        self._marked.add(phase)
+        self._marks.put((phase, time.time()))
+
+    def mark_when(self, wait, phase):
+        '''
+        Marks phase as completed once wait function returns.
+
+        Parameters
+        ----------
+        wait: callable
+            Function that blocks until phase completes and returns whether it completed.
+        phase: str
+            Phase name.
+
+        Returns
+        -------
+        '''
+        def worker():
+            if wait():
+                self.mark(phase)
+        threading.Thread(target=worker, daemon=True).start()
+
+    def start(self):
+        '''
+        Starts reporting thread.
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        '''
+        self._thread = threading.Thread(target=self._report, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        '''
+        Reports breakdown of phases completed so far and stops reporting thread.
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        '''
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def breakdown(self):
+        '''
+        Returns startup breakdown.
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        breakdown: dict
+            Time of every completed phase since startup and time to first forward in milliseconds, and names of
+            phases that have not completed.
+        '''
+        phases = {phase: round((completed - self.started) * 1000, 1)
+                  for phase, completed in sorted(self._completed.items(), key=lambda item: item[1])}
+        forwards = [elapsed for phase, elapsed in phases.items() if phase.endswith(first_forward_suffix)]
+        return {"phases_ms": phases,
+                "time_to_first_forward_ms": min(forwards) if len(forwards) > 0 else None,
+                "pending": [phase for phase in self.phases if phase not in phases]}
+
+    def _report(self):
+        deadline = time.monotonic() + self.timeout
+        while not self._stopped.is_set() and any(phase not in self._completed for phase in self.phases):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                phase, completed = self._marks.get(timeout=min(0.5, remaining))
+            except Empty:
+                continue
+            if phase not in self._completed:
+                self._completed[phase] = completed
+                customLogger.debug("Startup phase " + phase + " completed in {:.1f}ms".format(
+                    (completed - self.started) * 1000))
+        # marks sent right before stop are not lost
+        while True:
+            try:
+                phase, completed = self._marks.get_nowait()
+            except Empty:
+                break
+            self._completed.setdefault(phase, completed)
+        infoLogger.info("Startup breakdown: " + json.dumps(self.breakdown()))
+
+
+def connect_mqtt(client, address, port, keepalive, timer=None, phase=None):
+    '''
+    Starts connecting MQTT client in background.
+
+    Client's network thread connects to broker and keeps retrying with exponential backoff, bounded by
+    max_connect_delay, until connection is established, so caller is not blocked while broker is unavailable.
+    Reconnects after lost connection use the same backoff.
+
+    Parameters
+    ----------
+    client: paho.mqtt.client.Client
+        MQTT client with callbacks already set.
+    address: str
+        MQTT broker's address.
+    port: int
+        MQTT broker's port.
+    keepalive: int
+        Keepalive interval [s].
+    timer: StartupTimer
+        Startup timer. If None, connection is not timed.
+    phase: str
+        Name of phase marked when client connects first time.
+
+    Returns
+    -------
+    '''
+    if timer is not None:
+        on_connect = client.on_connect
+
+        def on_connect_timed(client, userdata, flags, rc, props):
+            if rc == 0:
+                timer.mark(phase)
+            on_connect(client, userdata, flags, rc, props)
+        client.on_connect = on_connect_timed
+    client.reconnect_delay_set(min_connect_delay, max_connect_delay)
+    client.connect_async(address, port=port, keepalive=keepalive)
+    client.loop_start()
@@ -3,30 +3,280 @@ sensor_devices
 ============
 Module that contains logic used for collecting stats about savings in sensor data sent over the internet.
 
+Collected bytes are MQTT payload bytes received from sensors. Forwarded bytes are bytes sent to cloud services on the
+wire - request line, headers and protocol framing, and request body after compression - as recorded by traffic
+module, of every attempted request including failed requests and retries.
+
 Classes
 ---------
 
+SharedCounters
+    Fixed-layout shared memory block with live stats counters of single data handler.
+LiveStats
+    Reads live stats counters of all data handlers.
 Stats
     Class representing stats regarding single sensor data transmission.
 OverallStats
     Class representing stats regarding whole gateway app data transmission.
+StatsUploader
+    Periodically uploads per stream stats deltas to stats cloud service.
 
 Functions
 ---------
+create_stats_uploader(conf, url, counters, token, time_pattern)
+    Creates stats uploader based on stats config.
 
 Constants
 ---------
-
+counter_fields: tuple
+    Names of stats counters in shared memory, in layout order.
+delta_fields: tuple
+    Names of cumulative stats counters uploaded as deltas.
+upload_interval: str
+    Config key of time in seconds between two stats uploads.
+persist_interval: str
+    Config key of time in seconds between two saves of stats that are not uploaded yet.
+state_path: str
+    Config key of path of file with stats that are not uploaded yet.
 '''
+import os
+import json
 import time
+import threading
 import requests
+from multiprocessing import shared_memory
+import resilience
+import traffic
 import logging.config
 
 # setting up loggers
 logging.config.fileConfig('logging.conf')
+infoLogger = logging.getLogger('customInfoLogger')
 errorLogger = logging.getLogger('customErrorLogger')
 customLogger=logging.getLogger('customConsoleLogger')
 
+counter_fields = ("dataBytes", "dataBytesForwarded", "dataRequests", "bufferBytes", "bufferPeakBytes",
+                  "bufferSummarizations", "bufferFolded", "dataMessages", "serializedBytes", "headerBytes",
+                  "responseBytes", "retries", "failures")
+# buffer stats are current values, not totals, so they are not uploaded as deltas
+delta_fields = tuple(field for field in counter_fields if field not in ("bufferBytes", "bufferPeakBytes"))
+upload_interval = "upload_interval"
+persist_interval = "persist_interval"
+state_path = "state_path"
+
+default_persist_interval = 30.0
+default_state_path = "stats.state"
+# max time waited for stats cloud service response [s]
+upload_timeout = 30.0
+# layout of shared memory block: sequence number, update time [ms], counters
+header_size = 2
+# max time spent reading consistent snapshot while writer is updating counters [s]
+snapshot_timeout = 0.1
+
+
+class SharedCounters:
+    '''
+    Fixed-layout shared memory block with live stats counters of single data handler.
+
+    Block is array of int64 values: sequence number, time of last update in milliseconds and counters listed in
+    counter_fields. Only data handler that owns block writes it. Writer makes sequence number odd while it updates
+    counters and even once it is done, so readers in other processes take consistent snapshot without locks or IPC
+    round trips by retrying while sequence number is odd or has changed during read.
+
+    Block is passed to other processes by name, and every process attaches it on unpickling.
+
+    Attributes
+    ---------
+    name: str
+        Shared memory block name.
+
+    Methods
+    ---------
+    write(self, stats)
+        Publishes stats counters.
+    snapshot(self)
+        Returns consistent snapshot of counters.
+    close(self)
+        Detaches shared memory block from current process.
+    unlink(self)
+        Frees shared memory block.
+    '''
+    def __init__(self, name=None):
+        '''
+        Initializes SharedCounters object.
+
+        Parameters
+        ----------
+        name: str
+            Name of existing block to attach, new zeroed block is created if None.
+        '''
+        size = (header_size + len(counter_fields)) * 8
+        if name is None:
+            self._memory = shared_memory.SharedMemory(create=True, size=size)
+            self._memory.buf[:size] = bytes(size)
+        else:
+            self._memory = shared_memory.SharedMemory(name=name)
+        self.name = self._memory.name
+        self._values = self._memory.buf[:size].cast("q")
+
+    def __getstate__(self):
+        return {"name": self.name}
+
+    def __setstate__(self, state):
+        self.__init__(state["name"])
+
+    def __del__(self):
+        # view of block must be released before block is closed on garbage collection
+        if hasattr(self, "_values"):
+            self._values.release()
+
+    def write(self, stats):
+        '''
+        Publishes stats counters.
+
+        Must be called only by data handler that owns block.
+
+        Parameters
+        ----------
+        stats: Stats
+            Current stats of data handler.
+
+        Returns
+        -------
+        '''
+        values = self._values
+        values[0] += 1
+        for index, field in enumerate(counter_fields, header_size):
+            values[index] = getattr(stats, field)
+        values[1] = int(time.time() * 1000)
+        values[0] += 1
+
+    def snapshot(self):
+        '''
+        Returns consistent snapshot of counters.
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        snapshot: dict
+            Counters by name, and time of last update as UNIX timestamp under "updated" key, which is None if
+            counters were never written.
+        '''
+        values = self._values
+        deadline = None
+        while True:
+            sequence = values[0]
+            if sequence % 2 == 0:
+                copy = values.tolist()
+                if values[0] == sequence:
+                    break
+            if deadline is None:
+                deadline = time.monotonic() + snapshot_timeout
+            elif time.monotonic() > deadline:
+                # writer died in the middle of update, its last values are good enough
+                copy = values.tolist()
+                break
+        snapshot = dict(zip(counter_fields, copy[header_size:]))
+        snapshot["updated"] = copy[1] / 1000 if copy[1] > 0 else None
+        return snapshot
+
+    def close(self):
+        '''
+        Detaches shared memory block from current process.
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        '''
+        self._values.release()
+        self._memory.close()
+
+    def unlink(self):
+        '''
+        Frees shared memory block. Must be called once, by process that created block.
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        '''
+        self._memory.unlink()
+
+
+class LiveStats:
+    '''
+    Reads live stats counters of all data handlers.
+
+    Attributes
+    ---------
+    counters: dict
+        SharedCounters by stream name.
+
+    Methods
+    ---------
+    snapshot(self)
+        Returns current counters of all streams.
+    rates(self)
+        Returns per second rates of counters since previous call.
+    '''
+    def __init__(self, counters):
+        '''
+        Initializes LiveStats object.
+
+        Parameters
+        ----------
+        counters: dict
+            SharedCounters by stream name.
+        '''
+        self.counters = counters
+        self._previous = None
+        self._previous_time = None
+
+    def snapshot(self):
+        '''
+        Returns current counters of all streams.
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        snapshot: dict
+            Snapshot of counters by stream name.
+        '''
+        return {stream: counters.snapshot() for stream, counters in self.counters.items()}
+
+    def rates(self):
+        '''
+        Returns per second rates of counters since previous call.
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        rates: dict
+            Collected bytes, forwarded bytes and requests per second by stream name, empty on first call.
+        '''
+        now = time.monotonic()
+        snapshot = self.snapshot()
+        rates = {}
+        if self._previous is not None and now > self._previous_time:
+            elapsed = now - self._previous_time
+            for stream, counters in snapshot.items():
+                previous = self._previous[stream]
+                rates[stream] = {field: round((counters[field] - previous[field]) / elapsed, 2)
+                                 for field in ("dataBytes", "dataBytesForwarded", "dataRequests")}
+        self._previous = snapshot
+        self._previous_time = now
+        return rates
+
+
 class Stats:
     '''
     Represents single sensor stats regarding data collected and transmitted over network.
@@ -34,46 +284,193 @@ class Stats:
     Attributes
     ---------
     dataBytes: int
-        Amount of collected sensor data in bytes.
+        Amount of collected sensor data (MQTT payloads) in bytes.
+    dataMessages: int
+        Number of received MQTT messages.
     dataBytesForwarded: int
-        Amount of sensor data sent to cloud services in bytes.
+        Amount of data sent to cloud services on the wire in bytes, headers included.
+    serializedBytes: int
+        Amount of serialized request bodies in bytes, before compression.
+    headerBytes: int
+        Part of forwarded bytes taken by request lines, headers and protocol framing.
+    responseBytes: int
+        Amount of data received from cloud services in bytes.
     dataRequests: int
-        Number of requests to cloud services.
+        Number of requests to cloud services, failed requests and retries included.
+    retries: int
+        Number of requests made after previous request to the same endpoint failed.
+    failures: int
+        Number of failed requests.
+    endpoints: dict
+        Traffic counters by endpoint, see traffic.traffic_fields.
+    bufferBytes: int
+        Current memory usage of retry buffer in bytes.
+    bufferPeakBytes: int
+        Max memory usage of retry buffer in bytes.
+    bufferSummarizations: int
+        Number of retry buffer overflows that caused summarizing of buffered data.
+    bufferFolded: int
+        Number of buffered readings folded into aggregates.
+    counters: SharedCounters
+        Live counters updated with every change of stats, None if stats are not shared.
     Methods
     ---------
-    update_data(self, bytes, forwarded, requests)
-        Updating stats data.
+    update_received(self, size)
+        Updating stats with received MQTT message.
+    update_traffic(self, usage)
+        Updating stats with traffic sent to cloud services.
+    update_buffer(self, metrics)
+        Updating retry buffer stats.
+    ratios(self)
+        Returns derived compression and reduction ratios.
+    report(self)
+        Returns stats with per endpoint breakdown and derived ratios.
     '''
-    def __init__(self):
+    def __init__(self, counters=None):
         '''
         Initializes Stats object.
 
         Parameters
         ----------
+        counters: SharedCounters
+            Live counters. Stats continue from values already published in them, so replacement of crashed data
+            handler keeps totals of its predecessor.
         '''
         self.dataBytes = 0
+        self.dataMessages = 0
         self.dataBytesForwarded = 0
+        self.serializedBytes = 0
+        self.headerBytes = 0
+        self.responseBytes = 0
         self.dataRequests = 0
+        self.retries = 0
+        self.failures = 0
+        self.endpoints = {}
+        self.bufferBytes = 0
+        self.bufferPeakBytes = 0
+        self.bufferSummarizations = 0
+        self.bufferFolded = 0
+        self.counters = counters
+        # stats are updated both by MQTT network thread and handler's main loop
+        self._lock = threading.Lock()
+        if counters is not None:
+            snapshot = counters.snapshot()
+            for field in counter_fields:
+                setattr(self, field, snapshot[field])
 
-    def update_data(self, bytes, forwarded, requests):
+    def __getstate__(self):
+        # shared counters are not sent along with stats, receiver has its own reference to them
+        state = self.__dict__.copy()
+        state["counters"] = None
+        state["_lock"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def update_received(self, size):
         '''
-        Updates current stats  with new collected sensor data.
+        Updates current stats with received MQTT message.
 
         Parameters
         ----------
-        bytes: int
-            Collected sensor data in bytes.
-        forwarded: int
-            Sent sensor data in bytes.
-        requests: int
-            Number of made cloud service requests.
+        size: int
+            Message payload size in bytes.
 
         Returns
         ----------
         '''
-        self.dataBytes += bytes
-        self.dataBytesForwarded += forwarded
-        self.dataRequests += requests
+        with self._lock:
+            self.dataBytes += size
+            self.dataMessages += 1
+            if self.counters is not None:
+                self.counters.write(self)
+
+    def update_traffic(self, usage):
+        '''
+        Updates current stats with traffic sent to cloud services.
+
+        Parameters
+        ----------
+        usage: dict
+            Traffic counters by endpoint returned by traffic.take().
+
+        Returns
+        ----------
+        '''
+        if len(usage) == 0:
+            return
+        with self._lock:
+            for endpoint, counters in usage.items():
+                totals = self.endpoints.setdefault(endpoint, dict.fromkeys(traffic.traffic_fields, 0))
+                for field in traffic.traffic_fields:
+                    totals[field] += counters[field]
+                self.dataBytesForwarded += counters["wireBodyBytes"] + counters["headerBytes"]
+                self.serializedBytes += counters["bodyBytes"]
+                self.headerBytes += counters["headerBytes"]
+                self.responseBytes += counters["responseBytes"]
+                self.dataRequests += counters["requests"]
+                self.retries += counters["retries"]
+                self.failures += counters["failures"]
+            if self.counters is not None:
+                self.counters.write(self)
+
+    def update_buffer(self, metrics):
+        '''
+        Updates retry buffer stats.
+
+        Parameters
+        ----------
+        metrics: dict
+            Metrics returned by retry_buffer.RetryBuffer.metrics().
+
+        Returns
+        ----------
+        '''
+        with self._lock:
+            self.bufferBytes = metrics["bytes"]
+            self.bufferPeakBytes = metrics["peak_bytes"]
+            self.bufferSummarizations = metrics["summarizations"]
+            self.bufferFolded = metrics["folded"]
+            if self.counters is not None:
+                self.counters.write(self)
+
+    def ratios(self):
+        '''
+        Returns derived compression and reduction ratios.
+
+        Parameters
+        ----------
+
+        Returns
+        ----------
+        ratios: dict
+            Compression ratio (serialized body bytes per body byte on the wire), reduction ratio (collected bytes per
+            forwarded byte) and share of headers in forwarded bytes, None where there is no traffic yet.
+        '''
+        wire_body = self.dataBytesForwarded - self.headerBytes
+        return {"compression": round(self.serializedBytes / wire_body, 3) if wire_body > 0 else None,
+                "reduction": round(self.dataBytes / self.dataBytesForwarded, 3) if self.dataBytesForwarded > 0
+                else None,
+                "headerShare": round(self.headerBytes / self.dataBytesForwarded, 3) if self.dataBytesForwarded > 0
+                else None}
+
+    def report(self):
+        '''
+        Returns stats with per endpoint breakdown and derived ratios.
+
+        Parameters
+        ----------
+
+        Returns
+        ----------
+        report: dict
+        '''
+        report = {field: getattr(self, field) for field in counter_fields}
+        report["endpoints"] = self.endpoints
+        report["ratios"] = self.ratios()
+        return report
 
 
 class OverallStats:
@@ -109,6 +506,8 @@ class OverallStats:
         Amount of transmitted fuel data [byte].
     fuelDataRequests: int
         Number of requests to fuel stats service.
+    traffic: dict
+        Report of every data stream with per endpoint traffic and derived ratios, logged when stats are combined.
 
     Methods
     ---------
@@ -135,6 +534,7 @@ class OverallStats:
         self.fuelDataBytes = 0
         self.fuelDataBytesForwarded = 0
         self.fuelDataRequests = 0
+        self.traffic = {}
 
     def combine_stats(self, temp_stats, load_stats, fuel_stats):
         '''
@@ -161,11 +561,16 @@ class OverallStats:
         self.fuelDataBytes = fuel_stats.dataBytes
         self.fuelDataBytesForwarded = fuel_stats.dataBytesForwarded
         self.fuelDataRequests = fuel_stats.dataRequests
+        self.traffic = {"temperature": temp_stats.report(), "load": load_stats.report(), "fuel": fuel_stats.report()}
+        infoLogger.info("Traffic stats: " + json.dumps(self.traffic))
 
     def send_stats(self):
         '''
         Sending collected stats to cloud stats service.
 
+        Failed attempts are retried after exponentially growing, randomized delay, or after delay requested by stats
+        service through Retry-After header.
+
         Parameters
         ---------
 
@@ -184,8 +589,10 @@ class OverallStats:
                    "fuelDataBytesForwarded": self.fuelDataBytesForwarded,
                    "fuelDataRequests": self.fuelDataRequests}
 
+        backoff = resilience.new_backoff()
         # trying to send stats data 5 times
         for i in range(0, 5):
+            retry_after = None
             try:
                 post_req = requests.post(self.url, json=payload, headers={"Authorization": "Bearer " + self.jwt})
                 if post_req.status_code == 200:
@@ -193,7 +600,249 @@ class OverallStats:
                 else:
                     errorLogger.error("problem with Stats Cloud service!")
                     customLogger.critical("Stats service unavailable!")
+                    if resilience.is_failure(post_req.status_code):
+                        retry_after = resilience.parse_retry_after(post_req.headers.get("Retry-After"))
             except:
                 errorLogger.error("Stats Cloud service unavailable!")
                 customLogger.critical("Stats service unavailable!")
+            if i < 4:
+                time.sleep(max(backoff.next_delay(), min(retry_after or 0.0, backoff.cap)))
+
+
+class StatsUploader:
+    '''
+    Periodically uploads per stream stats deltas to stats cloud service.
+
+    Uploader reads live counters of every data stream and accumulates their growth since previous read as pending
+    deltas, which are saved to local state file, so crash or power loss loses at most one persist interval of stats.
+    Every upload interval, pending deltas are frozen into batch with sequence number and uploaded. Batch is removed
+    only after stats service acknowledges it - until then it is re-sent unchanged with the same sequence number, so
+    service can drop duplicate of batch whose acknowledgement was lost. Batch contains only streams and counters that
+    changed, so upload size follows activity, not number of configured streams. Streams are keyed by stream id, so new
+    sensor types need no schema change.
+
+    Attributes
+    ---------
+    url: str
+        Stats cloud service URL.
+    counters: dict
+        SharedCounters by stream id.
+    token: callable
+        Function that returns current JWT.
+    time_pattern: str
+        Server date-time format.
+    upload_interval: float
+        Time between two uploads [s].
+    persist_interval: float
+        Time between two saves of pending deltas [s].
+    state_path: str
+        Path of file with pending deltas and batch that is not acknowledged.
+
+    Methods
+    ---------
+    start(self)
+        Starts uploading thread.
+    stop(self)
+        Collects final stats, tries last upload and stops uploading thread.
+    collect(self)
+        Adds growth of live counters to pending deltas and saves them.
+    upload(self)
+        Uploads batch of pending deltas.
+    '''
+    def __init__(self, url, counters, token, time_pattern, upload_interval, persist_interval=default_persist_interval,
+                 state_path=default_state_path):
+        '''
+        Initializes StatsUploader object and loads stats left by previous run.
+
+        Parameters
+        ----------
+        url: str
+            Stats cloud service URL.
+        counters: dict
+            SharedCounters by stream id.
+        token: callable
+            Function that returns current JWT.
+        time_pattern: str
+            Server date-time format.
+        upload_interval: float
+            Time between two uploads [s].
+        persist_interval: float
+            Time between two saves of pending deltas [s].
+        state_path: str
+            Path of file with pending deltas and batch that is not acknowledged.
+        '''
+        self.url = url
+        self.counters = counters
+        self.token = token
+        self.time_pattern = time_pattern
+        self.upload_interval = upload_interval
+        self.persist_interval = persist_interval
+        self.state_path = state_path
+        # counters of current run start from zero, deltas of previous runs are restored from state file
+        self._seen = {}
+        self._state = {"sequence": 0, "pending": {}, "since": None, "batch": None}
+        self._stopped = threading.Event()
+        self._thread = None
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.state_path) as state_file:
+                self._state.update(json.load(state_file))
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError):
+            errorLogger.error("Cant read stats state - " + self.state_path + " ! Starting with empty stats.")
+            return
+        customLogger.debug("Restored stats that were not uploaded!")
+
+    def _save(self):
+        try:
+            # state is written to temporary file first, so crash during write never leaves broken state
+            temporary_path = self.state_path + ".tmp"
+            with open(temporary_path, "w") as state_file:
+                json.dump(self._state, state_file)
+                state_file.flush()
+                os.fsync(state_file.fileno())
+            os.replace(temporary_path, self.state_path)
+        except OSError:
+            errorLogger.error("Cant write stats state - " + self.state_path + " !")
+
+    def start(self):
+        '''
+        Starts uploading thread.
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        '''
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
 
+    def stop(self):
+        '''
+        Collects final stats, tries last upload and stops uploading thread.
+
+        Stats that can not be uploaded stay in state file and are uploaded by next run.
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        '''
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.collect()
+        self.upload()
+
+    def collect(self):
+        '''
+        Adds growth of live counters since previous call to pending deltas and saves them.
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        '''
+        changed = False
+        for stream, counters in self.counters.items():
+            snapshot = counters.snapshot()
+            seen = self._seen.get(stream, {})
+            for field in delta_fields:
+                delta = snapshot[field] - seen.get(field, 0)
+                if delta < 0:
+                    # counters were reset, e.g. by new SharedCounters block
+                    delta = snapshot[field]
+                if delta != 0:
+                    pending = self._state["pending"].setdefault(stream, {})
+                    pending[field] = pending.get(field, 0) + delta
+                    changed = True
+            self._seen[stream] = snapshot
+        if changed:
+            if self._state["since"] is None:
+                self._state["since"] = time.strftime(self.time_pattern, time.localtime())
+            self._save()
+
+    def upload(self):
+        '''
+        Uploads batch of pending deltas.
+
+        Batch that was not acknowledged is re-sent first. Nothing is sent if there are no pending deltas.
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        uploaded: bool
+            Whether batch was acknowledged, False also if there was nothing to upload.
+        '''
+        if self._state["batch"] is None:
+            if len(self._state["pending"]) == 0:
+                return False
+            self._state["sequence"] += 1
+            self._state["batch"] = {"sequence": self._state["sequence"], "startTime": self._state["since"],
+                                    "endTime": time.strftime(self.time_pattern, time.localtime()),
+                                    "streams": self._state["pending"]}
+            self._state["pending"] = {}
+            self._state["since"] = None
+            self._save()
+        try:
+            response = requests.post(self.url, json=self._state["batch"],
+                                     headers={"Authorization": "Bearer " + self.token()}, timeout=upload_timeout)
+        except requests.RequestException:
+            errorLogger.error("Stats Cloud service unavailable! Stats are kept for next upload.")
+            customLogger.critical("Stats service unavailable!")
+            return False
+        if response.status_code // 100 != 2:
+            errorLogger.error("problem with Stats Cloud service! - Http status code: " + str(response.status_code))
+            customLogger.critical("Stats service unavailable!")
+            return False
+        infoLogger.info("Uploaded stats batch " + str(self._state["batch"]["sequence"]) + " of " +
+                        str(len(self._state["batch"]["streams"])) + " streams")
+        self._state["batch"] = None
+        self._save()
+        return True
+
+    def _run(self):
+        next_upload = time.monotonic() + self.upload_interval
+        while not self._stopped.wait(min(self.persist_interval, max(0.0, next_upload - time.monotonic()))):
+            self.collect()
+            if time.monotonic() >= next_upload:
+                self.upload()
+                next_upload = time.monotonic() + self.upload_interval
+
+
+def create_stats_uploader(conf, url, counters, token, time_pattern):
+    '''
+    Creates stats uploader.
+
+    Parameters
+    ----------
+    conf: dict
+        Stats config. If None or without upload interval, stats are sent only once, on app shutdown.
+    url: str
+        Stats cloud service URL.
+    counters: dict
+        SharedCounters by stream id.
+    token: callable
+        Function that returns current JWT.
+    time_pattern: str
+        Server date-time format.
+
+    Returns
+    -------
+    uploader: StatsUploader
+        Stats uploader, or None if periodic upload is not configured.
+    '''
+    if conf is None or conf.get(upload_interval) is None:
+        return None
+    return StatsUploader(url, counters, token, time_pattern, conf[upload_interval],
+                         conf.get(persist_interval, default_persist_interval), conf.get(state_path, default_state_path))
@@ -0,0 +1,439 @@
+'''
+supervisor
+============
+Module that supervises data handler processes.
+
+Every data handler runs as separate worker process. Supervisor watches whether each worker is alive and whether it
+keeps updating its heartbeat, and restarts only the worker that crashed or hung, with per-worker exponential backoff,
+while other workers keep running. Worker that crashes with Python exception hands its in-memory buffers and stats to
+supervisor, and replacement worker continues with them. Buffers of worker that hung or was killed are lost, data
+kept in durable outbox is not affected.
+
+Worker beats from its main loop and from every step of work that may take long, i.e. from every request of outbox
+replay and while it waits for egress scheduler, so heartbeat timeout has to be longer than one request. Worker that
+does not exit in time after stop is requested is killed and is not restarted.
+
+Classes
+---------
+WorkerState
+    State shared between worker process and supervisor.
+Worker
+    Supervised data handler process.
+
+Functions
+---------
+heartbeat()
+    Updates heartbeat of worker run by current process.
+check_config(conf, request_timeout, reply_timeout)
+    Checks whether heartbeat timeout is longer than time worker may wait for single request.
+run_workers(conf, workers)
+    Runs workers until all of them are stopped.
+
+Constants
+---------
+heartbeat_timeout: str
+    Config key of max time in seconds without heartbeat before worker is considered hung.
+restart_delay: str
+    Config key of base time in seconds before failed worker is restarted.
+max_restart_delay: str
+    Config key of max time in seconds before failed worker is restarted.
+stable_time: str
+    Config key of time in seconds after which restarted worker is considered healthy and its backoff is reset.
+check_interval: str
+    Config key of time in seconds between two checks of workers.
+shutdown_timeout: str
+    Config key of max time in seconds worker may take to exit after stop is requested.
+'''
+import time
+import ctypes
+import queue
+from multiprocessing import Process, Queue, Value
+import resilience
+import watchdog
+import logging.config
+
+logging.config.fileConfig('logging.conf')
+infoLogger = logging.getLogger('customInfoLogger')
+errorLogger = logging.getLogger('customErrorLogger')
+customLogger = logging.getLogger('customConsoleLogger')
+
+heartbeat_timeout = "heartbeat_timeout"
+restart_delay = "restart_delay"
+max_restart_delay = "max_restart_delay"
+stable_time = "stable_time"
+check_interval = "check_interval"
+shutdown_timeout = "shutdown_timeout"
+
+default_heartbeat_timeout = 30.0
+default_restart_delay = 1.0
+default_max_restart_delay = 60.0
+default_stable_time = 60.0
+default_check_interval = 1.0
+default_shutdown_timeout = 30.0
+# max time given to worker process to exit after it is terminated [s]
+terminate_timeout = 5.0
+
+# state of worker run by current process, None in main process and in handlers that are not supervised
+_state = None
+
+
+class WorkerState:
+    '''
+    State shared between worker process and supervisor.
+
+    Worker updates heartbeat from its main loop and registers function that snapshots its buffers. If worker crashes
+    with exception, snapshot is sent to supervisor and replacement worker takes it over.
+
+    Attributes
+    ---------
+    handoff: object
+        Buffers handed over by previous worker, None if there are none.
+
+    Methods
+    ---------
+    beat(self)
+        Updates worker's heartbeat.
+    last_beat(self)
+        Returns time of last heartbeat.
+    register(self, snapshot)
+        Registers function that snapshots worker's buffers.
+    take_handoff(self)
+        Returns buffers handed over by previous worker.
+    hand_off(self)
+        Sends snapshot of worker's buffers to supervisor.
+    collect(self)
+        Returns snapshot sent by worker, if any.
+    '''
+    def __init__(self):
+        '''
+        Initializes WorkerState object.
+
+        Parameters
+        ----------
+        '''
+        self.handoff = None
+        self._heartbeat = Value(ctypes.c_double, time.time(), lock=False)
+        self._snapshots = Queue()
+        self._snapshot = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_snapshot"] = None
+        return state
+
+    def beat(self):
+        '''
+        Updates worker's heartbeat.
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        '''
+        self._heartbeat.value = time.time()
+
+    def last_beat(self):
+        '''
+        Returns time of last heartbeat.
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        time: float
+            UNIX timestamp.
+        '''
+        return self._heartbeat.value
+
+    def register(self, snapshot):
+        '''
+        Registers function that snapshots worker's buffers.
+
+        Parameters
+        ----------
+        snapshot: callable
+            Function that returns picklable snapshot of worker's buffers.
+
+        Returns
+        -------
+        '''
+        self._snapshot = snapshot
+
+    def take_handoff(self):
+        '''
+        Returns buffers handed over by previous worker.
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        handoff: object
+            Snapshot of previous worker's buffers, None if there is none.
+        '''
+        handoff = self.handoff
+        self.handoff = None
+        return handoff
+
+    def hand_off(self):
+        '''
+        Sends snapshot of worker's buffers to supervisor.
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        '''
+        if self._snapshot is None:
+            return
+        try:
+            self._snapshots.put(self._snapshot())
+        except Exception:
+            errorLogger.exception("Worker buffers can not be handed off!")
+
+    def collect(self):
+        '''
+        Returns snapshot sent by worker, if any.
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        snapshot: object
+            Snapshot of worker's buffers, None if worker did not send one.
+        '''
+        snapshot = None
+        while True:
+            try:
+                snapshot = self._snapshots.get_nowait()
+            except queue.Empty:
+                return snapshot
+
+
+class Worker:
+    '''
+    Supervised data handler process.
+
+    Attributes
+    ---------
+    name: str
+        Worker name.
+    target: callable
+        Data handler function. Worker state is passed to it as worker_state keyword argument.
+    args: tuple
+        Data handler arguments.
+    flag: multiprocessing.Event
+        Token used for stopping data handler.
+    state: WorkerState
+        State shared with worker process.
+    process: multiprocessing.Process
+        Current worker process.
+    restarts: int
+        Number of worker restarts.
+
+    Methods
+    ---------
+    start(self, supervised)
+        Starts worker process.
+    '''
+    def __init__(self, name, target, args, flag):
+        '''
+        Initializes Worker object.
+
+        Parameters
+        ----------
+        name: str
+            Worker name.
+        target: callable
+            Data handler function.
+        args: tuple
+            Data handler arguments.
+        flag: multiprocessing.Event
+            Token used for stopping data handler.
+        '''
+        self.name = name
+        self.target = target
+        self.args = args
+        self.flag = flag
+        self.state = WorkerState()
+        self.process = None
+        self.restarts = 0
+        self._started = None
+        self._restart_at = None
+        self._backoff = None
+        self._stop_deadline = None
+
+    def start(self, supervised=True):
+        '''
+        Starts worker process.
+
+        Parameters
+        ----------
+        supervised: bool
+            Whether worker state is passed to data handler.
+
+        Returns
+        -------
+        '''
+        if supervised:
+            self.state.beat()
+            self.process = Process(target=_run, args=(self.target, self.args, self.state), name=self.name)
+        else:
+            self.process = Process(target=self.target, args=self.args, name=self.name)
+        self._started = time.monotonic()
+        self.process.start()
+        self.state.handoff = None
+
+
+def _run(target, args, state):
+    global _state
+    _state = state
+    try:
+        target(*args, worker_state=state)
+    except BaseException:
+        errorLogger.exception("Worker crashed! Handing off its buffers.")
+        state.hand_off()
+        raise
+
+
+def heartbeat():
+    '''
+    Updates heartbeat of worker run by current process, e.g. between requests of long outbox replay. Does nothing if
+    current process is not supervised worker.
+
+    Parameters
+    ----------
+
+    Returns
+    -------
+    '''
+    if _state is not None:
+        _state.beat()
+
+
+def check_config(conf, request_timeout, reply_timeout):
+    '''
+    Checks whether heartbeat timeout is longer than time worker may wait for single request, so worker that waits
+    for slow cloud service is not mistaken for hung one.
+
+    Parameters
+    ----------
+    conf: dict
+        Supervisor config. If None, workers are not supervised and config is valid.
+    request_timeout: float
+        Timeout of request to cloud services [s], None if requests have no timeout.
+    reply_timeout: float
+        Time worker waits for reply of egress scheduler [s], None if egress scheduler is not used.
+
+    Returns
+    -------
+    valid: bool
+        Whether config is valid.
+    '''
+    if conf is None:
+        return True
+    timeout = conf.get(heartbeat_timeout, default_heartbeat_timeout)
+    for name, limit in (("request timeout", request_timeout), ("egress reply timeout", reply_timeout)):
+        if limit is not None and timeout <= limit:
+            errorLogger.error("Heartbeat timeout {}s must be longer than {} {}s!".format(timeout, name, limit))
+            return False
+    return True
+
+
+def _kill(process):
+    process.terminate()
+    process.join(terminate_timeout)
+    if process.is_alive():
+        process.kill()
+        process.join()
+
+
+def run_workers(conf, workers):
+    '''
+    Runs workers until all of them are stopped.
+
+    Parameters
+    ----------
+    conf: dict
+        Supervisor config. If None, workers are not supervised and function returns once all workers exit.
+    workers: list
+        Workers to run.
+
+    Returns
+    -------
+    '''
+    if conf is None:
+        for worker in workers:
+            worker.start(False)
+        for worker in workers:
+            worker.process.join()
+        return
+    timeout = conf.get(heartbeat_timeout, default_heartbeat_timeout)
+    stop_timeout = conf.get(shutdown_timeout, default_shutdown_timeout)
+    stable = conf.get(stable_time, default_stable_time)
+    interval = conf.get(check_interval, default_check_interval)
+    for worker in workers:
+        worker._backoff = resilience.Backoff(conf.get(restart_delay, default_restart_delay),
+                                             conf.get(max_restart_delay, default_max_restart_delay))
+        worker.start()
+    running = list(workers)
+    while len(running) > 0:
+        # supervisor that is stalled can not restart hung workers, so its own loop is watched too
+        watchdog.progress("supervisor", interval)
+        time.sleep(interval)
+        for worker in running[:]:
+            # buffers handed off by crashed worker are passed to its replacement
+            snapshot = worker.state.collect()
+            if snapshot is not None:
+                worker.state.handoff = snapshot
+            process = worker.process
+            # deadline of shutdown starts when stop is noticed and holds for restarted worker as well
+            if worker.flag.is_set() and worker._stop_deadline is None:
+                worker._stop_deadline = time.monotonic() + stop_timeout
+            if worker._restart_at is not None:
+                # worker that failed after stop was requested is restarted right away, so it delivers its stats
+                if worker.flag.is_set() or time.monotonic() >= worker._restart_at:
+                    worker._restart_at = None
+                    worker.restarts += 1
+                    infoLogger.info("Restarting " + worker.name + " worker, restart " + str(worker.restarts))
+                    customLogger.debug("Restarting " + worker.name + " worker!")
+                    worker.start()
+                continue
+            if process.is_alive():
+                if worker._stop_deadline is not None:
+                    if time.monotonic() < worker._stop_deadline:
+                        continue
+                    # worker hung in shutdown would be restarted only to hang again, so it is dropped
+                    errorLogger.error(worker.name + " worker did not stop in {:.1f}s! Killing it.".format(stop_timeout))
+                    customLogger.critical(worker.name + " worker is not stopping!")
+                    _kill(process)
+                    running.remove(worker)
+                    continue
+                if time.time() - worker.state.last_beat() > timeout:
+                    errorLogger.error(worker.name + " worker has not sent heartbeat for {:.1f}s! Terminating it."
+                                      .format(time.time() - worker.state.last_beat()))
+                    customLogger.critical(worker.name + " worker is not responding!")
+                    _kill(process)
+                elif worker.restarts > 0 and time.monotonic() - worker._started > stable:
+                    worker._backoff.reset()
+                    continue
+                else:
+                    continue
+            else:
+                process.join()
+                snapshot = worker.state.collect()
+                if snapshot is not None:
+                    worker.state.handoff = snapshot
+            if process.exitcode == 0 and worker.flag.is_set():
+                running.remove(worker)
+                continue
+            delay = worker._backoff.next_delay()
+            errorLogger.error(worker.name + " worker stopped with exit code " + str(process.exitcode) +
+                              "! Restarting it in {:.1f}s".format(delay))
+            customLogger.critical(worker.name + " worker failed! Restarting it in {:.1f}s".format(delay))
+            worker._restart_at = time.monotonic() + delay
+    watchdog.idle("supervisor")
@@ -0,0 +1,254 @@
+'''
+tls
+============
+Module that contains TLS client contexts shared by MQTT and HTTPS connections.
+
+Full TLS handshake costs extra round trips and public key operations on every connect and reconnect. Contexts created
+by this module cache TLS session of every server they connected to, and next connection to the same server offers
+cached session, so server can resume it with abbreviated handshake. Contexts are cached per config, so session cache
+is shared by all reconnects of MQTT clients and HTTPS connections of one process that use the same config.
+
+Classes
+---------
+ResumingContext
+    TLS client context with per-server session cache.
+
+Functions
+---------
+client_context(conf, alpn)
+    Returns TLS client context of current process for TLS config.
+configure_mqtt(client, conf)
+    Enables TLS on MQTT client.
+settle(sock, timeout)
+    Processes TLS 1.3 session tickets sent after handshake on idle connection.
+
+Constants
+---------
+ca_certs: str
+    Config key of CA certificates file used for verifying server.
+certfile: str
+    Config key of client certificate file.
+keyfile: str
+    Config key of client private key file.
+insecure: str
+    Config key of switch that disables server certificate verification. For testing only.
+session_resumption: str
+    Config key of TLS session resumption switch.
+'''
+import json
+import ssl
+import select
+import threading
+import logging.config
+
+logging.config.fileConfig('logging.conf')
+infoLogger = logging.getLogger('customInfoLogger')
+errorLogger = logging.getLogger('customErrorLogger')
+customLogger = logging.getLogger('customConsoleLogger')
+
+ca_certs = "ca_certs"
+certfile = "certfile"
+keyfile = "keyfile"
+insecure = "insecure"
+session_resumption = "session_resumption"
+
+# TLS contexts of current process by config
+_contexts = {}
+_contexts_lock = threading.Lock()
+
+
+class _ResumingSocket(ssl.SSLSocket):
+
+    def do_handshake(self, block=False):
+        super().do_handshake(block)
+        try:
+            self._session_key = (self.server_hostname, self.getpeername()[1])
+        except OSError:
+            self._session_key = None
+        self.context._handshake_done(self)
+
+    def close(self):
+        # TLS 1.3 tickets arrive after handshake, so session is stored again before it is lost
+        self.context._store(self)
+        super().close()
+
+
+class ResumingContext(ssl.SSLContext):
+    '''
+    TLS client context with per-server session cache.
+
+    Attributes
+    ---------
+    resumption: bool
+        Whether cached sessions are offered to servers.
+    handshakes: int
+        Number of completed handshakes.
+    resumed: int
+        Number of handshakes that resumed cached session.
+    '''
+    sslsocket_class = _ResumingSocket
+
+    def __new__(cls, protocol=ssl.PROTOCOL_TLS_CLIENT, resumption=True):
+        return super().__new__(cls, protocol)
+
+    def __init__(self, protocol=ssl.PROTOCOL_TLS_CLIENT, resumption=True):
+        '''
+        Initializes ResumingContext object.
+
+        Parameters
+        ----------
+        protocol: int
+            SSL protocol.
+        resumption: bool
+            Whether cached sessions are offered to servers.
+        '''
+        super().__init__()
+        self.resumption = resumption
+        self.handshakes = 0
+        self.resumed = 0
+        self._sessions = {}
+        self._sessions_lock = threading.Lock()
+
+    def wrap_socket(self, sock, server_side=False, do_handshake_on_connect=True, suppress_ragged_eofs=True,
+                    server_hostname=None, session=None):
+        '''
+        Wraps connected socket, offering cached session of server if there is one.
+
+        Parameters
+        ----------
+        sock: socket.socket
+            Connected socket.
+        server_side: bool
+            Must be False.
+        do_handshake_on_connect: bool
+            Whether handshake is done right away.
+        suppress_ragged_eofs: bool
+            Whether unexpected EOF is reported as end of stream.
+        server_hostname: str
+            Server host name.
+        session: ssl.SSLSession
+            Session to resume, cached session is used if None.
+
+        Returns
+        -------
+        sock: ssl.SSLSocket
+        '''
+        if session is None and self.resumption and not server_side:
+            try:
+                with self._sessions_lock:
+                    session = self._sessions.get((server_hostname, sock.getpeername()[1]))
+            except OSError:
+                session = None
+        return super().wrap_socket(sock, server_side, do_handshake_on_connect, suppress_ragged_eofs,
+                                   server_hostname, session)
+
+    def _handshake_done(self, sock):
+        with self._sessions_lock:
+            self.handshakes += 1
+            if sock.session_reused:
+                self.resumed += 1
+        self._store(sock)
+
+    def _store(self, sock):
+        key = getattr(sock, "_session_key", None)
+        if not self.resumption or key is None:
+            return
+        try:
+            session = sock.session
+        except (ValueError, OSError):
+            return
+        # TLS 1.3 session without ticket can not be resumed, so it does not replace cached one
+        if session is not None and (session.has_ticket or sock.version() != "TLSv1.3"):
+            with self._sessions_lock:
+                self._sessions[key] = session
+
+
+def client_context(conf, alpn=None):
+    '''
+    Returns TLS client context of current process for TLS config.
+
+    Context is created once per config and ALPN protocols, so all connections that use it share session cache.
+
+    Parameters
+    ----------
+    conf: dict
+        TLS config. Empty config verifies server against system CA certificates.
+    alpn: tuple
+        ALPN protocols offered to server, None for no ALPN.
+
+    Returns
+    -------
+    context: ResumingContext
+    '''
+    key = json.dumps(conf, sort_keys=True) + str(alpn)
+    with _contexts_lock:
+        context = _contexts.get(key)
+        if context is None:
+            context = ResumingContext(ssl.PROTOCOL_TLS_CLIENT, conf.get(session_resumption, True))
+            if conf.get(ca_certs) is not None:
+                context.load_verify_locations(conf[ca_certs])
+            else:
+                context.load_default_certs()
+            if conf.get(certfile) is not None:
+                context.load_cert_chain(conf[certfile], conf.get(keyfile))
+            if conf.get(insecure, False):
+                context.check_hostname = False
+                context.verify_mode = ssl.CERT_NONE
+            if alpn is not None:
+                context.set_alpn_protocols(list(alpn))
+            _contexts[key] = context
+        return context
+
+
+def configure_mqtt(client, conf):
+    '''
+    Enables TLS on MQTT client.
+
+    Must be called before client connects. Every reconnect of client resumes cached TLS session.
+
+    Parameters
+    ----------
+    client: paho.mqtt.client.Client
+        MQTT client.
+    conf: dict
+        TLS config. If None, client connects without TLS.
+
+    Returns
+    -------
+    '''
+    if conf is None:
+        return
+    client.tls_set_context(client_context(conf))
+    if conf.get(insecure, False):
+        client.tls_insecure_set(True)
+
+
+def settle(sock, timeout=0.1):
+    '''
+    Processes TLS 1.3 session tickets sent after handshake on idle connection.
+
+    TLS 1.3 server sends session tickets after handshake. Until they are read, idle connection looks readable, so
+    connection pools consider it dropped, and its session can not be resumed. Server must not send application data
+    before client's request.
+
+    Parameters
+    ----------
+    sock: socket.socket
+        Connected socket, plain sockets are ignored.
+    timeout: float
+        Max time to wait for session tickets [s].
+
+    Returns
+    -------
+    '''
+    if not isinstance(sock, ssl.SSLSocket) or sock.version() != "TLSv1.3":
+        return
+    previous_timeout = sock.gettimeout()
+    try:
+        if len(select.select([sock], [], [], timeout)[0]) > 0:
+            sock.setblocking(False)
+            sock.recv(1)
+    except ssl.SSLWantReadError:
+        pass
+    finally:
+        sock.settimeout(previous_timeout)
@@ -0,0 +1,344 @@
+'''
+token_manager
+============
+Module that keeps gateway's JWT valid for the whole app run.
+
+Expiration time is read from exp claim of JWT locally, and JWT is refreshed by logging in again shortly before it
+expires. New JWT is published to shared memory read by all data handler processes, so handlers use it from their next
+request on and never have to be restarted because of JWT expiration. If cloud platform rejects JWT anyway, e.g. because
+it was revoked, handler requests immediate refresh.
+
+Refreshed JWT is stored in on-disk cache, so after restart or power cycle gateway reuses still valid JWT instead of
+waiting for login. Without valid JWT, handlers start collecting data right away and keep it buffered until first JWT
+is published.
+
+Classes
+---------
+TokenManager
+    Refreshes JWT ahead of expiration and shares it with data handlers.
+
+Functions
+---------
+create_token_manager(conf, jwt, username, password, login_url, default_login_timeout)
+    Creates token manager based on JWT config.
+load_cached_jwt(path)
+    Loads JWT from on-disk cache if it is still valid.
+
+Constants
+---------
+refresh_margin: str
+    Config key of time in seconds before expiration when JWT is refreshed.
+retry_interval: str
+    Config key of max time in seconds between failed refresh attempts.
+cache_path: str
+    Config key of on-disk JWT cache path.
+login_timeout: str
+    Config key of login request timeout in seconds.
+'''
+import os
+import time
+import ctypes
+import threading
+from multiprocessing import Array, Value, Event
+import auth
+import resilience
+import logging.config
+
+logging.config.fileConfig('logging.conf')
+infoLogger = logging.getLogger('customInfoLogger')
+errorLogger = logging.getLogger('customErrorLogger')
+customLogger = logging.getLogger('customConsoleLogger')
+
+refresh_margin = "refresh_margin"
+retry_interval = "retry_interval"
+cache_path = "cache_path"
+login_timeout = "login_timeout"
+
+default_refresh_margin = 60.0
+default_retry_interval = 5.0
+# refreshing thread must not hang on login request that is never answered [s]
+default_login_timeout = 30.0
+# max JWT length in bytes
+max_token_size = 8192
+
+
+class TokenManager:
+    '''
+    Refreshes JWT ahead of expiration and shares it with data handlers.
+
+    Manager is passed to data handler processes as process argument. Refreshing thread runs in process that started
+    manager, while every process reads current JWT from shared memory.
+
+    Attributes
+    ---------
+    username: str
+        Device username.
+    password: str
+        Device password.
+    login_url: str
+        Cloud auth service URL.
+    refresh_margin: float
+        Time before expiration when JWT is refreshed [s].
+    retry_interval: float
+        Max time between failed refresh attempts [s].
+    cache_path: str
+        On-disk JWT cache path, None if JWT is not cached.
+    login_timeout: float
+        Login request timeout [s].
+
+    Methods
+    ---------
+    get(self)
+        Returns current JWT.
+    wait(self, timeout)
+        Waits until JWT is available.
+    request_refresh(self, jwt)
+        Requests immediate refresh of JWT rejected by cloud platform.
+    start(self)
+        Starts refreshing thread.
+    stop(self)
+        Stops refreshing thread.
+    '''
+    def __init__(self, jwt, username, password, login_url, refresh_margin=default_refresh_margin,
+                 retry_interval=default_retry_interval, cache_path=None, login_timeout=default_login_timeout):
+        '''
+        Initializes TokenManager object.
+
+        Parameters
+        ----------
+        jwt: str
+            Current JWT, None if JWT is obtained by refreshing thread.
+        username: str
+            Device username.
+        password: str
+            Device password.
+        login_url: str
+            Cloud auth service URL.
+        refresh_margin: float
+            Time before expiration when JWT is refreshed [s].
+        retry_interval: float
+            Max time between failed refresh attempts [s].
+        cache_path: str
+            On-disk JWT cache path, None if JWT is not cached.
+        login_timeout: float
+            Login request timeout [s].
+        '''
+        self.username = username
+        self.password = password
+        self.login_url = login_url
+        self.refresh_margin = refresh_margin
+        self.retry_interval = retry_interval
+        self.cache_path = cache_path
+        self.login_timeout = login_timeout
+        self._token = Array(ctypes.c_char, max_token_size)
+        # version is guarded by token lock, so readers decode token only after it changes
+        self._version = Value(ctypes.c_long, 0, lock=False)
+        self._cached_version = -1
+        self._cached_token = None
+        self._refresh_requested = Event()
+        self._ready = Event()
+        self._stopped = Event()
+        self._thread = None
+        if jwt is not None:
+            self._publish(jwt)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_thread"] = None
+        return state
+
+    def _publish(self, jwt):
+        encoded = jwt.encode("ascii")
+        if len(encoded) >= max_token_size:
+            errorLogger.error("JWT is longer than " + str(max_token_size) + " bytes! Keeping previous JWT.")
+            return False
+        with self._token.get_lock():
+            self._token.value = encoded
+            self._version.value += 1
+        self._ready.set()
+        return True
+
+    def get(self):
+        '''
+        Returns current JWT.
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        jwt: str
+            Current JWT, empty string if JWT is not available yet.
+        '''
+        with self._token.get_lock():
+            if self._version.value != self._cached_version:
+                self._cached_token = self._token.value.decode("ascii")
+                self._cached_version = self._version.value
+            return self._cached_token
+
+    def wait(self, timeout=None):
+        '''
+        Waits until JWT is available.
+
+        Parameters
+        ----------
+        timeout: float
+            Max waiting time [s], None for no limit.
+
+        Returns
+        -------
+        ready: bool
+            Whether JWT is available.
+        '''
+        return self._ready.wait(timeout)
+
+    def request_refresh(self, jwt=None):
+        '''
+        Requests immediate refresh of JWT rejected by cloud platform.
+
+        Parameters
+        ----------
+        jwt: str
+            Rejected JWT. Request is ignored if JWT was already replaced.
+
+        Returns
+        -------
+        '''
+        if jwt is None or jwt == self.get():
+            self._refresh_requested.set()
+
+    def start(self):
+        '''
+        Starts refreshing thread.
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        '''
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._refresh, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        '''
+        Stops refreshing thread.
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        '''
+        self._stopped.set()
+        self._refresh_requested.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _store(self, jwt):
+        try:
+            directory = os.path.dirname(self.cache_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            # JWT is written to temporary file first, so crash during write never leaves broken cache
+            temporary_path = self.cache_path + ".tmp"
+            with open(os.open(temporary_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as cache_file:
+                cache_file.write(jwt)
+            os.replace(temporary_path, self.cache_path)
+        except OSError:
+            errorLogger.error("Cant write JWT cache - " + self.cache_path + " !")
+
+    def _refresh(self):
+        failed = False
+        backoff = resilience.Backoff(min(1.0, self.retry_interval), self.retry_interval)
+        while not self._stopped.is_set():
+            current = self.get()
+            exp = auth.expires_at(current)
+            if failed:
+                delay = backoff.next_delay()
+            elif current == "":
+                delay = 0.0
+            elif exp is None:
+                # without exp claim JWT is refreshed only when cloud platform rejects it
+                delay = None
+            else:
+                delay = max(0.0, exp - self.refresh_margin - time.time())
+            self._refresh_requested.wait(delay)
+            if self._stopped.is_set():
+                break
+            self._refresh_requested.clear()
+            jwt = auth.login(self.username, self.password, self.login_url, self.login_timeout)
+            failed = jwt is None or not self._publish(jwt)
+            if failed:
+                errorLogger.error("JWT refresh failed! Retrying in up to {:.1f}s".format(self.retry_interval))
+                customLogger.error("JWT refresh failed! Retrying in up to {:.1f}s".format(self.retry_interval))
+            else:
+                backoff.reset()
+                if self.cache_path is not None:
+                    self._store(jwt)
+                exp = auth.expires_at(jwt)
+                infoLogger.info("JWT refreshed!" + ("" if exp is None else " Valid until " +
+                                                    time.strftime("%d.%m.%Y %H:%M:%S", time.localtime(exp))))
+                customLogger.debug("JWT refreshed!")
+
+
+def create_token_manager(conf, jwt, username, password, login_url, default_login_timeout=default_login_timeout):
+    '''
+    Creates token manager.
+
+    Parameters
+    ----------
+    conf: dict
+        JWT config. If None, JWT is not refreshed and handlers are restarted when it expires.
+    jwt: str
+        Current JWT, None if JWT is restored from cache or obtained by refreshing thread.
+    username: str
+        Device username.
+    password: str
+        Device password.
+    login_url: str
+        Cloud auth service URL.
+    default_login_timeout: float
+        Login request timeout [s] used if JWT config does not set it, e.g. HTTP client timeout.
+
+    Returns
+    -------
+    manager: TokenManager
+        Token manager, or None if JWT config is None.
+    '''
+    if conf is None:
+        return None
+    if jwt is None and conf.get(cache_path) is not None:
+        jwt = load_cached_jwt(conf[cache_path])
+    return TokenManager(jwt, username, password, login_url, conf.get(refresh_margin, default_refresh_margin),
+                        conf.get(retry_interval, default_retry_interval), conf.get(cache_path),
+                        conf.get(login_timeout, default_login_timeout))
+
+
+def load_cached_jwt(path):
+    '''
+    Loads JWT from on-disk cache if it is still valid.
+
+    Parameters
+    ----------
+    path: str
+        On-disk JWT cache path.
+
+    Returns
+    -------
+    jwt: str
+        Cached JWT, or None if cache is missing or JWT has expired.
+    '''
+    try:
+        with open(path) as cache_file:
+            jwt = cache_file.read().strip()
+    except OSError:
+        return None
+    if auth.is_jwt_valid(jwt) is not True:
+        infoLogger.info("Cached JWT has expired!")
+        return None
+    infoLogger.info("Restored JWT from cache!")
+    customLogger.debug("Restored JWT from cache!")
+    return jwt
@@ -0,0 +1,589 @@
+'''
+tracing
+============
+Module that traces latency of sensor data through stages of gateway pipeline.
+
+Stages are:
+
+- receive - from MQTT packet read by network thread to reading stored in handler's buffer,
+- buffer_wait - time reading waits in handler's buffer until flush,
+- parse - parsing of collected readings,
+- aggregate - summarizing parsed values into request payload,
+- serialize - JSON encoding of request body,
+- send - request to cloud service, queueing in egress scheduler included when scheduler is enabled,
+- flush and alert - whole flush of temperature/load data and whole handling of fuel alert.
+
+Reading stages are sampled - only every n-th reading is timed, so MQTT message path pays only for counter increment.
+Flush stages are timed on every flush, and every n-th flush is also kept as trace of spans. Latencies are recorded into
+log-linear histograms (16 sub-buckets per power of two, at most 6.25% relative error), which are merged by adding
+bucket counts, so histograms of several processes or runs combine without losing accuracy.
+
+Every handler process exports its histograms and kept spans into JSON file. Spans are also exported in OpenTelemetry
+(OTLP JSON) format, so they can be loaded into tracing tools.
+
+Classes
+---------
+LatencyHistogram
+    Mergeable log-linear latency histogram.
+
+Functions
+---------
+configure(conf, name)
+    Sets tracing config of current process.
+received(timestamp)
+    Records reading stored in handler's buffer.
+flushed()
+    Records buffer wait of sampled readings taken by flush.
+trace(stage)
+    Returns context that times root stage and keeps its child spans if trace is sampled.
+span(stage)
+    Returns context that times stage.
+report()
+    Returns histograms and kept spans of current process.
+to_otlp(spans, service)
+    Converts spans to OpenTelemetry JSON format.
+export()
+    Writes report of current process to export directory.
+merge_reports(paths)
+    Merges histograms of exported reports.
+summarize(conf)
+    Merges reports of all processes, logs latency percentiles and writes summary.
+
+Constants
+---------
+sample_rate: str
+    Config key of fraction of readings that are timed.
+trace_rate: str
+    Config key of fraction of flushes kept as traces of spans.
+export_path: str
+    Config key of directory with exported reports.
+export_interval: str
+    Config key of time in seconds between two exports.
+max_spans: str
+    Config key of max number of kept spans.
+stages: tuple
+    Names of traced stages.
+'''
+import os
+import json
+import time
+import threading
+from collections import deque
+import logging.config
+
+logging.config.fileConfig('logging.conf')
+infoLogger = logging.getLogger('customInfoLogger')
+errorLogger = logging.getLogger('customErrorLogger')
+customLogger = logging.getLogger('customConsoleLogger')
+
+sample_rate = "sample_rate"
+trace_rate = "trace_rate"
+export_path = "export_path"
+export_interval = "export_interval"
+max_spans = "max_spans"
+
+default_sample_rate = 0.01
+default_trace_rate = 0.1
+default_export_path = "traces"
+default_export_interval = 60.0
+default_max_spans = 1000
+stages = ("receive", "buffer_wait", "parse", "aggregate", "serialize", "send", "flush", "alert")
+
+# sub-buckets per power of two
+_sub_bits = 4
+_sub = 1 << _sub_bits
+
+
+def _bucket(micros):
+    if micros < 2 * _sub:
+        return micros
+    exponent = micros.bit_length() - _sub_bits - 1
+    return (exponent + 1) * _sub + (micros >> exponent) - _sub
+
+
+def _bucket_value(index):
+    if index < 2 * _sub:
+        return float(index)
+    exponent = index // _sub - 1
+    lower = (index % _sub + _sub) << exponent
+    return lower + ((1 << exponent) - 1) / 2
+
+
+class LatencyHistogram:
+    '''
+    Mergeable log-linear latency histogram.
+
+    Latencies are recorded in microseconds. Buckets are exact up to 32us and have 16 sub-buckets per power of two
+    above it. Only non-empty buckets are stored.
+
+    Attributes
+    ---------
+    count: int
+        Number of recorded latencies.
+    total: int
+        Sum of recorded latencies [us].
+    max: int
+        Max recorded latency [us].
+    buckets: dict
+        Number of latencies by bucket index.
+
+    Methods
+    ---------
+    record(self, seconds)
+        Records latency.
+    merge(self, other)
+        Adds latencies of other histogram.
+    percentile(self, percent)
+        Returns approximate percentile of recorded latencies.
+    summary(self)
+        Returns count, mean, percentiles and max in milliseconds.
+    to_dict(self)
+        Returns JSON serializable histogram.
+    from_dict(data)
+        Creates histogram from JSON serializable histogram.
+    '''
+    def __init__(self):
+        '''
+        Initializes empty LatencyHistogram object.
+        '''
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.buckets = {}
+
+    def record(self, seconds):
+        '''
+        Records latency.
+
+        Parameters
+        ----------
+        seconds: float
+            Latency [s], negative latency is recorded as zero.
+
+        Returns
+        -------
+        '''
+        self._record(max(0, int(seconds * 1e6)))
+
+    def _record(self, micros):
+        index = _bucket(micros)
+        buckets = self.buckets
+        buckets[index] = buckets.get(index, 0) + 1
+        self.count += 1
+        self.total += micros
+        if micros > self.max:
+            self.max = micros
+
+    def merge(self, other):
+        '''
+        Adds latencies of other histogram.
+
+        Parameters
+        ----------
+        other: LatencyHistogram
+
+        Returns
+        -------
+        '''
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, percent):
+        '''
+        Returns approximate percentile of recorded latencies.
+
+        Parameters
+        ----------
+        percent: float
+            Percentile, 0 to 100.
+
+        Returns
+        -------
+        latency: float
+            Latency [us], None if histogram is empty.
+        '''
+        if self.count == 0:
+            return None
+        rank = max(1, round(self.count * percent / 100))
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                return min(_bucket_value(index), self.max)
+        return float(self.max)
+
+    def summary(self):
+        '''
+        Returns count, mean, percentiles and max in milliseconds.
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        summary: dict
+        '''
+        if self.count == 0:
+            return {"count": 0}
+        return {"count": self.count, "mean_ms": round(self.total / self.count / 1000, 3),
+                "p50_ms": round(self.percentile(50) / 1000, 3), "p90_ms": round(self.percentile(90) / 1000, 3),
+                "p99_ms": round(self.percentile(99) / 1000, 3), "max_ms": round(self.max / 1000, 3)}
+
+    def to_dict(self):
+        '''
+        Returns JSON serializable histogram.
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        data: dict
+        '''
+        return {"count": self.count, "total_us": self.total, "max_us": self.max,
+                "buckets": {str(index): count for index, count in sorted(self.buckets.items())}}
+
+    @staticmethod
+    def from_dict(data):
+        '''
+        Creates histogram from JSON serializable histogram.
+
+        Parameters
+        ----------
+        data: dict
+            Histogram returned by to_dict().
+
+        Returns
+        -------
+        histogram: LatencyHistogram
+        '''
+        histogram = LatencyHistogram()
+        histogram.count = data["count"]
+        histogram.total = data["total_us"]
+        histogram.max = data["max_us"]
+        histogram.buckets = {int(index): count for index, count in data["buckets"].items()}
+        return histogram
+
+
+class _NoSpan:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        return False
+
+
+_no_span = _NoSpan()
+
+
+class _Span:
+    __slots__ = ("stage", "root", "trace_id", "parent_id", "span_id", "start")
+
+    def __init__(self, stage, root):
+        self.stage = stage
+        self.root = root
+
+    def __enter__(self):
+        context = _context.__dict__
+        self.trace_id = context.get("trace_id")
+        self.parent_id = context.get("span_id")
+        if self.root:
+            _state["flushes"] += 1
+            if _state["flushes"] % _state["trace_every"] == 0:
+                self.trace_id = os.urandom(16).hex()
+                self.parent_id = None
+            if self.trace_id is not None:
+                self.span_id = os.urandom(8).hex()
+                context["trace_id"] = self.trace_id
+                context["span_id"] = self.span_id
+        elif self.trace_id is not None:
+            self.span_id = os.urandom(8).hex()
+            context["span_id"] = self.span_id
+        self.start = time.time_ns()
+        return self
+
+    def __exit__(self, *exception):
+        end = time.time_ns()
+        with _lock:
+            _histograms[self.stage]._record(max(0, (end - self.start) // 1000))
+            if self.trace_id is not None:
+                _spans.append({"name": self.stage, "trace_id": self.trace_id, "span_id": self.span_id,
+                               "parent_span_id": self.parent_id, "start_ns": self.start, "end_ns": end,
+                               "process": _state["name"], "error": exception[0] is not None})
+        if self.trace_id is not None:
+            context = _context.__dict__
+            if self.root:
+                context.pop("trace_id", None)
+                context.pop("span_id", None)
+            else:
+                context["span_id"] = self.parent_id
+        return False
+
+
+# tracing state of current process
+_enabled = False
+_state = {"name": None, "sample_every": 0, "trace_every": 0, "flushes": 0, "path": None,
+          "interval": default_export_interval, "exported": 0.0}
+_histograms = {}
+# readings left until next sampled reading
+_countdown = float("inf")
+_spans = deque(maxlen=default_max_spans)
+# arrival times of sampled readings that wait in buffer
+_waiting = deque()
+_context = threading.local()
+_lock = threading.Lock()
+
+
+def _every(rate):
+    return float("inf") if rate <= 0 else max(1, round(1 / rate))
+
+
+def configure(conf, name=None):
+    '''
+    Sets tracing config of current process and resets recorded latencies.
+
+    Parameters
+    ----------
+    conf: dict
+        Tracing config. If None, tracing is disabled.
+    name: str
+        Process name used in exported report, e.g. data stream name.
+
+    Returns
+    -------
+    '''
+    global _enabled, _spans, _countdown
+    _enabled = conf is not None
+    conf = {} if conf is None else conf
+    _state.update({"name": name, "sample_every": _every(conf.get(sample_rate, default_sample_rate)),
+                   "trace_every": _every(conf.get(trace_rate, default_trace_rate)), "flushes": 0,
+                   "path": conf.get(export_path, default_export_path),
+                   "interval": conf.get(export_interval, default_export_interval), "exported": time.monotonic()})
+    _histograms.clear()
+    _histograms.update({stage: LatencyHistogram() for stage in stages})
+    _spans = deque(maxlen=conf.get(max_spans, default_max_spans))
+    _waiting.clear()
+    _countdown = _state["sample_every"] if _enabled else float("inf")
+
+
+def received(timestamp):
+    '''
+    Records reading stored in handler's buffer. Must be called only by MQTT network thread.
+
+    Parameters
+    ----------
+    timestamp: float
+        Time MQTT packet was read, time.monotonic() value set by MQTT client as message.timestamp.
+
+    Returns
+    -------
+    '''
+    global _countdown
+    # counting down is the only work done for readings that are not sampled, countdown never ends if disabled
+    _countdown -= 1
+    if _countdown > 0:
+        return
+    _countdown = _state["sample_every"]
+    now = time.monotonic()
+    with _lock:
+        _histograms["receive"].record(now - timestamp)
+    _waiting.append(now)
+
+
+def flushed():
+    '''
+    Records buffer wait of sampled readings taken by flush.
+
+    Must be called when flush takes all readings collected so far.
+
+    Parameters
+    ----------
+
+    Returns
+    -------
+    '''
+    if not _enabled:
+        return
+    now = time.monotonic()
+    with _lock:
+        while len(_waiting) > 0 and _waiting[0] <= now:
+            _histograms["buffer_wait"].record(now - _waiting.popleft())
+
+
+def trace(stage):
+    '''
+    Returns context that times root stage, e.g. flush. If trace is sampled, spans of root stage and all stages timed
+    within it by the same thread are kept.
+
+    Parameters
+    ----------
+    stage: str
+        Stage name.
+
+    Returns
+    -------
+    context: object
+    '''
+    return _Span(stage, True) if _enabled else _no_span
+
+
+def span(stage):
+    '''
+    Returns context that times stage.
+
+    Parameters
+    ----------
+    stage: str
+        Stage name.
+
+    Returns
+    -------
+    context: object
+    '''
+    return _Span(stage, False) if _enabled else _no_span
+
+
+def report():
+    '''
+    Returns histograms and kept spans of current process.
+
+    Parameters
+    ----------
+
+    Returns
+    -------
+    report: dict
+        Process name, histogram of every stage and kept spans.
+    '''
+    with _lock:
+        return {"process": _state["name"],
+                "histograms": {stage: histogram.to_dict() for stage, histogram in _histograms.items()},
+                "spans": list(_spans)}
+
+
+def to_otlp(spans, service="iot-gateway"):
+    '''
+    Converts spans to OpenTelemetry JSON format.
+
+    Parameters
+    ----------
+    spans: list
+        Spans from report.
+    service: str
+        Service name resource attribute.
+
+    Returns
+    -------
+    data: dict
+        Spans in OTLP JSON format.
+    '''
+    return {"resourceSpans": [{
+        "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": service}}]},
+        "scopeSpans": [{"scope": {"name": "tracing"}, "spans": [
+            {"traceId": span["trace_id"], "spanId": span["span_id"], "parentSpanId": span["parent_span_id"] or "",
+             "name": span["name"], "kind": 1, "startTimeUnixNano": str(span["start_ns"]),
+             "endTimeUnixNano": str(span["end_ns"]),
+             "attributes": [{"key": "gateway.process", "value": {"stringValue": str(span["process"])}}],
+             "status": {"code": 2 if span["error"] else 0}} for span in spans]}]}]}
+
+
+def _write(path, data):
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "w") as export_file:
+        json.dump(data, export_file)
+    os.replace(temporary_path, path)
+
+
+def export(force=True):
+    '''
+    Writes report of current process to export directory, as <name>.json, and its spans as <name>.otlp.json.
+
+    Parameters
+    ----------
+    force: bool
+        Whether report is written even if export interval has not elapsed since previous export.
+
+    Returns
+    -------
+    '''
+    if not _enabled or (not force and time.monotonic() - _state["exported"] < _state["interval"]):
+        return
+    _state["exported"] = time.monotonic()
+    current = report()
+    try:
+        os.makedirs(_state["path"], exist_ok=True)
+        base = os.path.join(_state["path"], str(_state["name"]))
+        _write(base + ".json", current)
+        _write(base + ".otlp.json", to_otlp(current["spans"]))
+    except OSError as error:
+        errorLogger.error("Cant export latency traces! - " + str(error))
+
+
+def merge_reports(paths):
+    '''
+    Merges histograms of exported reports.
+
+    Parameters
+    ----------
+    paths: list
+        Paths of reports written by export().
+
+    Returns
+    -------
+    histograms: dict
+        LatencyHistogram of every stage by process name, and merged over all processes under "all" key.
+    '''
+    merged = {"all": {stage: LatencyHistogram() for stage in stages}}
+    for path in paths:
+        try:
+            with open(path) as report_file:
+                data = json.load(report_file)
+        except (OSError, ValueError):
+            errorLogger.error("Cant read latency report - " + path + " !")
+            continue
+        process = merged.setdefault(str(data["process"]), {stage: LatencyHistogram() for stage in stages})
+        for stage, histogram in data["histograms"].items():
+            histogram = LatencyHistogram.from_dict(histogram)
+            process.setdefault(stage, LatencyHistogram()).merge(histogram)
+            merged["all"].setdefault(stage, LatencyHistogram()).merge(histogram)
+    return merged
+
+
+def summarize(conf):
+    '''
+    Merges reports exported by all processes, logs latency percentiles of every stage and writes them to
+    summary.json in export directory.
+
+    Parameters
+    ----------
+    conf: dict
+        Tracing config. If None, nothing is done.
+
+    Returns
+    -------
+    summary: dict
+        Latency summary of every stage by process name, None if tracing is disabled.
+    '''
+    if conf is None:
+        return None
+    path = conf.get(export_path, default_export_path)
+    try:
+        paths = [os.path.join(path, name) for name in sorted(os.listdir(path))
+                 if name.endswith(".json") and not name.endswith(".otlp.json") and name != "summary.json"]
+    except OSError:
+        paths = []
+    summary = {process: {stage: histogram.summary() for stage, histogram in histograms.items()}
+               for process, histograms in merge_reports(paths).items()}
+    for stage, stage_summary in summary["all"].items():
+        if stage_summary["count"] > 0:
+            infoLogger.info("Latency of " + stage + " stage: p50 {p50_ms} ms, p90 {p90_ms} ms, p99 {p99_ms} ms, "
+                                                    "max {max_ms} ms, {count} samples".format(**stage_summary))
+    try:
+        _write(os.path.join(path, "summary.json"), summary)
+    except OSError as error:
+        errorLogger.error("Cant write latency summary! - " + str(error))
+    return summary
@@ -0,0 +1,248 @@
+'''
+traffic
+============
+Module that accounts wire-level traffic between gateway and cloud services.
+
+Every transport records each request it makes - HTTP/1.1 and HTTP/2 egress, MQTT upstream bridge and fan-out
+targets - together with request body size before and after compression, size of request line, headers and protocol
+framing, and size of response. Records are kept per endpoint by process-local meter, and data handler periodically
+takes them over into its stats, so stats show real amount of data sent over the uplink instead of estimate.
+
+Requests sent by egress scheduler on behalf of data handler are captured by scheduler thread and returned to handler
+with request result, so traffic is accounted to stream that caused it.
+
+Sizes do not include TCP/IP and TLS record overhead.
+
+Functions
+---------
+record(endpoint, body_bytes, wire_body_bytes, header_bytes, response_bytes, failed)
+    Records single request to endpoint.
+capture()
+    Collects requests recorded by current thread instead of adding them to process meter.
+merge(usage)
+    Adds traffic recorded by another process to process meter.
+share(usage, parts)
+    Splits traffic of request made on behalf of several streams.
+take()
+    Returns traffic recorded since previous call.
+http1_sizes(response)
+    Returns wire size of HTTP/1.1 request headers and response.
+mqtt_publish_sizes(topic, payload_bytes, qos)
+    Returns wire size of MQTT PUBLISH packet headers and broker acknowledgement.
+
+Constants
+---------
+traffic_fields: tuple
+    Names of per endpoint traffic counters.
+'''
+import threading
+import urllib.parse
+from contextlib import contextmanager
+
+traffic_fields = ("requests", "retries", "failures", "bodyBytes", "wireBodyBytes", "headerBytes", "responseBytes")
+
+# size of MQTTv5 acknowledgement packets without reason string and properties
+_mqtt_ack_size = 4
+_default_ports = {"http": 80, "https": 443}
+
+_lock = threading.Lock()
+_usage = {}
+# endpoints whose last request failed, so next request to them is counted as retry
+_failing = set()
+_captured = threading.local()
+
+
+def _add(usage, endpoint, counters):
+    totals = usage.get(endpoint)
+    if totals is None:
+        totals = usage[endpoint] = dict.fromkeys(traffic_fields, 0)
+    for field in traffic_fields:
+        totals[field] += counters.get(field, 0)
+
+
+def record(endpoint, body_bytes=0, wire_body_bytes=0, header_bytes=0, response_bytes=0, failed=False):
+    '''
+    Records single request to endpoint.
+
+    Parameters
+    ----------
+    endpoint: str
+        Cloud service URL, or MQTT topic of upstream bridge.
+    body_bytes: int
+        Serialized request body size in bytes, before compression.
+    wire_body_bytes: int
+        Request body size in bytes as sent, after compression.
+    header_bytes: int
+        Size of request line, headers and protocol framing in bytes.
+    response_bytes: int
+        Size of response headers and body, or broker acknowledgement, in bytes.
+    failed: bool
+        Whether request failed.
+
+    Returns
+    -------
+    '''
+    with _lock:
+        retry = endpoint in _failing
+        if failed:
+            _failing.add(endpoint)
+        else:
+            _failing.discard(endpoint)
+    counters = {"requests": 1, "retries": int(retry), "failures": int(failed), "bodyBytes": body_bytes,
+                "wireBodyBytes": wire_body_bytes, "headerBytes": header_bytes, "responseBytes": response_bytes}
+    captured = getattr(_captured, "usage", None)
+    if captured is not None:
+        _add(captured, endpoint, counters)
+        return
+    with _lock:
+        _add(_usage, endpoint, counters)
+
+
+@contextmanager
+def capture():
+    '''
+    Collects requests recorded by current thread instead of adding them to process meter.
+
+    Parameters
+    ----------
+
+    Returns
+    -------
+    usage: dict
+        Traffic counters by endpoint, filled while context is active.
+    '''
+    previous = getattr(_captured, "usage", None)
+    _captured.usage = {}
+    try:
+        yield _captured.usage
+    finally:
+        _captured.usage = previous
+
+
+def merge(usage):
+    '''
+    Adds traffic recorded by another process to process meter.
+
+    Parameters
+    ----------
+    usage: dict
+        Traffic counters by endpoint.
+
+    Returns
+    -------
+    '''
+    with _lock:
+        for endpoint, counters in usage.items():
+            _add(_usage, endpoint, counters)
+
+
+def share(usage, parts):
+    '''
+    Splits traffic of request made on behalf of several streams.
+
+    Counters are divided evenly, remainders are accounted to first part, so sum of parts equals whole traffic.
+
+    Parameters
+    ----------
+    usage: dict
+        Traffic counters by endpoint.
+    parts: int
+        Number of parts.
+
+    Returns
+    -------
+    shares: list
+        Traffic counters by endpoint of every part.
+    '''
+    shares = [{} for _ in range(parts)]
+    for endpoint, counters in usage.items():
+        for index, part in enumerate(shares):
+            part[endpoint] = {field: value // parts + (value % parts if index == 0 else 0)
+                              for field, value in counters.items()}
+    return shares
+
+
+def take():
+    '''
+    Returns traffic recorded since previous call.
+
+    Parameters
+    ----------
+
+    Returns
+    -------
+    usage: dict
+        Traffic counters by endpoint, empty if nothing was recorded.
+    '''
+    global _usage
+    with _lock:
+        usage = _usage
+        _usage = {}
+    return usage
+
+
+def http1_sizes(response):
+    '''
+    Returns wire size of HTTP/1.1 request headers and response.
+
+    Request headers include request line and Host header added by connection. Response size includes status line,
+    headers and body as sent by server, before content decoding.
+
+    Parameters
+    ----------
+    response: requests.Response
+        Received response.
+
+    Returns
+    -------
+    header_bytes: int
+        Size of request line and headers in bytes.
+    response_bytes: int
+        Size of response in bytes.
+    '''
+    request = response.request
+    url = urllib.parse.urlsplit(request.url)
+    host = url.hostname if ":" not in url.hostname else "[" + url.hostname + "]"
+    if url.port is not None and url.port != _default_ports.get(url.scheme):
+        host += ":" + str(url.port)
+    header_bytes = len("{} {} HTTP/1.1\r\nHost: {}\r\n\r\n".format(request.method, request.path_url, host))
+    header_bytes += sum(len(name) + len(value) + 4 for name, value in request.headers.items())
+    response_bytes = len("HTTP/1.1 {} {}\r\n\r\n".format(response.status_code, response.reason or ""))
+    raw_headers = response.raw.headers if response.raw is not None else response.headers
+    response_bytes += sum(len(name) + len(value) + 4 for name, value in raw_headers.items())
+    length = response.headers.get("Content-Length")
+    response_bytes += int(length) if length is not None and length.isdigit() else len(response.content)
+    return header_bytes, response_bytes
+
+
+def mqtt_publish_sizes(topic, payload_bytes, qos):
+    '''
+    Returns wire size of MQTTv5 PUBLISH packet headers and broker acknowledgement.
+
+    Parameters
+    ----------
+    topic: str
+        Topic name.
+    payload_bytes: int
+        Message payload size in bytes.
+    qos: int
+        Quality of service.
+
+    Returns
+    -------
+    header_bytes: int
+        Size of fixed header, topic, packet identifier and properties in bytes.
+    response_bytes: int
+        Size of PUBACK, or PUBREC, PUBREL and PUBCOMP exchange, in bytes.
+    '''
+    # topic length prefix, topic, packet identifier of QoS 1/2 messages and empty properties
+    variable = 2 + len(topic.encode("utf-8")) + (2 if qos > 0 else 0) + 1
+    remaining = variable + payload_bytes
+    length_bytes = 1
+    while remaining >= 128 ** length_bytes:
+        length_bytes += 1
+    header_bytes = 1 + length_bytes + variable
+    # PUBREL is sent by gateway as part of QoS 2 exchange
+    if qos == 2:
+        header_bytes += _mqtt_ack_size
+    return header_bytes, {0: 0, 1: _mqtt_ack_size, 2: 2 * _mqtt_ack_size}[qos]
@@ -0,0 +1,225 @@
+'''
+watchdog
+============
+Module that detects stalled loops of gateway processes and measures their scheduling lag.
+
+Every watched loop reports progress once per iteration, together with time it may legitimately wait before next
+progress, e.g. flush tick of data handler's loop or measuring period of sensor. MQTT network thread is watched only
+while it runs message callback, because it otherwise waits in select() for traffic. Watchdog thread of the process
+checks loops periodically, and loop that is overdue by more than stall threshold is stalled - blocked in request
+without timeout, in reconnect loop or in other call that never returns. Stack of stalled thread is logged once per
+stall, so blocking call can be found in production logs, and recovery of loop is logged with stall duration.
+
+Watchdog thread also measures its own wake-up lag, i.e. how late it runs after sleeping for check interval. Lag is
+shared by all threads of the process, so it shows CPU starvation and threads that hold GIL for long. Lag above lag
+threshold is logged with stacks of all threads taken when watchdog runs again, so thread that caused lag is usually
+still in code that caused it.
+
+Stalls, overdue time of handler loop and MQTT network thread, and scheduling lag of data handlers are exported by
+metrics endpoint. Other processes only log them.
+
+Functions
+---------
+configure(conf, name)
+    Sets watchdog config of current process and starts watchdog thread.
+progress(loop, wait)
+    Reports progress of loop run by current thread.
+idle(loop)
+    Stops watching loop until its next progress.
+busy(loop)
+    Returns context that watches loop while it runs.
+
+Constants
+---------
+stall_threshold: str
+    Config key of time loop can be overdue before it is stalled [s].
+lag_threshold: str
+    Config key of scheduling lag that is logged with stacks [s].
+check_interval: str
+    Config key of time between two checks of loops [s].
+handler_loop: str
+    Name of data handler's flush loop.
+network_loop: str
+    Name of MQTT network thread's message callback.
+'''
+import sys
+import time
+import threading
+import traceback
+import metrics
+import logging.config
+
+logging.config.fileConfig('logging.conf')
+infoLogger = logging.getLogger('customInfoLogger')
+errorLogger = logging.getLogger('customErrorLogger')
+customLogger = logging.getLogger('customConsoleLogger')
+
+stall_threshold = "stall_threshold"
+lag_threshold = "lag_threshold"
+check_interval = "check_interval"
+
+default_stall_threshold = 10.0
+default_lag_threshold = 0.5
+default_check_interval = 0.5
+handler_loop = "handler"
+network_loop = "mqtt"
+
+# stacks of all threads are logged at most once per interval, lag usually lasts for several checks
+_lag_dump_interval = 60.0
+
+# watchdog state of current process, loop name -> (thread ident, time of next expected progress)
+_loops = {}
+_name = None
+_thread = None
+
+
+class _Watchdog(threading.Thread):
+
+    def __init__(self, conf):
+        super().__init__(name="watchdog", daemon=True)
+        self.threshold = conf.get(stall_threshold, default_stall_threshold)
+        self.lag_threshold = conf.get(lag_threshold, default_lag_threshold)
+        self.interval = conf.get(check_interval, default_check_interval)
+        self.stopped = threading.Event()
+        # loop name -> deadline that was missed, so every stall is logged once
+        self.stalled = {}
+        self.lag_dumped = None
+
+    def run(self):
+        wake = time.monotonic() + self.interval
+        while not self.stopped.wait(max(0.0, wake - time.monotonic())):
+            now = time.monotonic()
+            lag = now - wake
+            wake = now + self.interval
+            metrics.scheduling_lag(lag)
+            if lag > self.lag_threshold and (self.lag_dumped is None or now - self.lag_dumped >= _lag_dump_interval):
+                self.lag_dumped = now
+                errorLogger.error("Watchdog of {} process woke up {:.3f}s late! Stacks of all threads:\n{}"
+                                  .format(_name, lag, _all_stacks()))
+            self._check(now)
+
+    def _check(self, now):
+        loops = _loops.copy()
+        for loop, deadline in list(self.stalled.items()):
+            if loops.get(loop, (None, None))[1] != deadline:
+                del self.stalled[loop]
+                infoLogger.info("{} loop of {} process recovered after stall of {:.1f}s"
+                                .format(loop, _name, now - deadline))
+        for loop in metrics.watched_loops:
+            if loop not in loops:
+                metrics.loop_progress(loop, 0.0, False)
+        for loop, (ident, deadline) in loops.items():
+            overdue = max(0.0, now - deadline)
+            stall = overdue > self.threshold and loop not in self.stalled
+            metrics.loop_progress(loop, overdue, stall)
+            if stall:
+                self.stalled[loop] = deadline
+                errorLogger.error("{} loop of {} process has not made progress for {:.1f}s! Stack of its thread:\n{}"
+                                  .format(loop, _name, overdue, _stack(ident)))
+                customLogger.critical("{} loop of {} process is stalled!".format(loop, _name))
+
+
+def _stack(ident):
+    frame = sys._current_frames().get(ident)
+    if frame is None:
+        return "  thread has exited\n"
+    return "".join(traceback.format_stack(frame))
+
+
+def _all_stacks():
+    names = {thread.ident: thread.name for thread in threading.enumerate()}
+    current = threading.get_ident()
+    return "".join("Thread {}:\n{}".format(names.get(ident, ident), "".join(traceback.format_stack(frame)))
+                   for ident, frame in sys._current_frames().items() if ident != current)
+
+
+class _Busy:
+    __slots__ = ("loop",)
+
+    def __init__(self, loop):
+        self.loop = loop
+
+    def __enter__(self):
+        progress(self.loop)
+        return self
+
+    def __exit__(self, *exception):
+        idle(self.loop)
+        return False
+
+
+def configure(conf, name):
+    '''
+    Sets watchdog config of current process and starts watchdog thread. Loops watched by parent process before fork
+    are not watched.
+
+    Parameters
+    ----------
+    conf: dict
+        Watchdog config. If None, loops are not watched.
+    name: str
+        Process name used in log entries.
+
+    Returns
+    -------
+    '''
+    global _name, _thread
+    if _thread is not None and _thread.is_alive():
+        _thread.stopped.set()
+    _loops.clear()
+    _name = name
+    _thread = None
+    if conf is None:
+        return
+    _thread = _Watchdog(conf)
+    _thread.start()
+
+
+def progress(loop, wait=0.0):
+    '''
+    Reports progress of loop run by current thread.
+
+    Parameters
+    ----------
+    loop: str
+        Loop name.
+    wait: float
+        Time loop may wait before its next progress [s].
+
+    Returns
+    -------
+    '''
+    if _thread is not None:
+        _loops[loop] = (threading.get_ident(), time.monotonic() + wait)
+
+
+def idle(loop):
+    '''
+    Stops watching loop until its next progress, e.g. while it waits for event that may never come.
+
+    Parameters
+    ----------
+    loop: str
+        Loop name.
+
+    Returns
+    -------
+    '''
+    _loops.pop(loop, None)
+
+
+def busy(loop):
+    '''
+    Returns context that watches loop while it runs, e.g. while MQTT network thread runs message callback.
+
+    Parameters
+    ----------
+    loop: str
+        Loop name.
+
+    Returns
+    -------
+    context: object
+        Context manager.
+    '''
+    return _Busy(loop)
@@ -0,0 +1,11 @@
+import os
+import sys
+import shutil
+import tempfile
+
+src = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+sys.path.insert(0, src)
+# gateway modules configure logging from logging.conf in working directory when imported, so tests run in
+# temporary directory and do not write to log files of the repository
+os.chdir(tempfile.mkdtemp(prefix="gateway-tests-"))
+shutil.copy(os.path.join(src, "logging.conf"), os.getcwd())
@@ -0,0 +1,48 @@
+import json
+import data_service
+import outbox
+
+
+def replay(monkeypatch, tmp_path, codes, count):
+    sent = []
+
+    def forward_data(payload, url, jwt, name, backlog=False):
+        # stored JSON text is sent without serializing payload again
+        assert isinstance(payload, bytes)
+        sent.append(json.loads(payload)["value"])
+        return codes.get(sent[-1], data_service.http_ok)
+
+    monkeypatch.setattr(data_service, "forward_data", forward_data)
+    box = outbox.Outbox(str(tmp_path / "temperature.db"), "temperature")
+    for value in range(count):
+        box.append({"value": value})
+    code, delivered = data_service.forward_outbox(box, "http://cloud/data/temp", "jwt", "temperature")
+    pending = [payload["value"] for _, payload in box.pending()]
+    box.close()
+    return code, delivered, sent, pending
+
+
+def test_replay_delivers_payloads_in_order(monkeypatch, tmp_path):
+    assert replay(monkeypatch, tmp_path, {}, 3) == (data_service.http_ok, 3, [0, 1, 2], [])
+
+
+def test_replay_stops_at_failure_and_keeps_rest(monkeypatch, tmp_path):
+    code, delivered, sent, pending = replay(monkeypatch, tmp_path, {1: data_service.http_service_unavailable}, 3)
+    assert (code, delivered, sent, pending) == (data_service.http_service_unavailable, 1, [0, 1], [1, 2])
+
+
+def test_replay_keeps_payload_until_jwt_is_refreshed(monkeypatch, tmp_path):
+    code, delivered, sent, pending = replay(monkeypatch, tmp_path, {0: 401}, 2)
+    assert (code, delivered, pending) == (401, 0, [0, 1])
+
+
+def test_rejected_payload_does_not_block_outbox(monkeypatch, tmp_path):
+    code, delivered, sent, pending = replay(monkeypatch, tmp_path, {0: 400, 2: 413}, 4)
+    assert sent == [0, 1, 2, 3]
+    assert delivered == 2
+    assert pending == []
+    assert code == data_service.http_ok
+
+
+def test_empty_outbox_is_no_content(monkeypatch, tmp_path):
+    assert replay(monkeypatch, tmp_path, {}, 0) == (data_service.http_no_content, 0, [], [])
@@ -0,0 +1,102 @@
+import time
+import queue
+import threading
+import data_service
+import egress
+
+streams = ("temperature", "load", "fuel")
+
+
+def request(stream, request_id, priority, size=10):
+    return (stream, request_id, priority, time.time(), "http://cloud/" + stream, "jwt", stream,
+            {"id": request_id, "data": "x" * size})
+
+
+def schedule(monkeypatch, queued, stream_weights=None, stopped=False, fail=()):
+    # requests are queued before scheduler starts, so it picks all of them before sending first one
+    sent = []
+
+    def forward_data(payload, url, jwt, name, backlog=False):
+        sent.append((name, payload["id"]))
+        if sent[-1] in fail:
+            raise RuntimeError("connection reset")
+        return data_service.http_ok
+
+    monkeypatch.setattr(data_service, "forward_data", forward_data)
+    requests = queue.Queue()
+    replies = {stream: queue.Queue() for stream in streams}
+    for entry in queued:
+        requests.put(entry)
+    flag = threading.Event()
+    if stopped:
+        flag.set()
+    scheduler = threading.Thread(target=egress.run_scheduler,
+                                 args=(requests, replies, stream_weights or {}, flag, 60, None))
+    scheduler.start()
+    deadline = time.monotonic() + 10
+    while sum(replies[stream].qsize() for stream in streams) < len(queued) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    flag.set()
+    scheduler.join(10)
+    assert not scheduler.is_alive()
+    return sent, {stream: [replies[stream].get_nowait() for _ in range(replies[stream].qsize())]
+                  for stream in streams}
+
+
+def test_requests_are_sent_by_priority_class(monkeypatch):
+    sent, replies = schedule(monkeypatch, [request("temperature", 0, egress.bulk),
+                                           request("load", 0, egress.normal),
+                                           request("temperature", 1, egress.normal),
+                                           request("fuel", 0, egress.critical)])
+    assert sent == [("fuel", 0), ("load", 0), ("temperature", 1), ("temperature", 0)]
+    assert replies["temperature"] == [(1, data_service.http_ok, {}), (0, data_service.http_ok, {})]
+    assert replies["fuel"] == [(0, data_service.http_ok, {})]
+
+
+def test_streams_of_same_class_are_interleaved_by_weight(monkeypatch):
+    queued = [request("temperature", request_id, egress.normal) for request_id in range(4)] + \
+             [request("load", request_id, egress.normal) for request_id in range(2)]
+    sent, _ = schedule(monkeypatch, queued, {"temperature": 2, "load": 1})
+    # temperature has twice the weight, so it sends two requests for every request of load
+    assert sent == [("temperature", 0), ("temperature", 1), ("load", 0),
+                    ("temperature", 2), ("temperature", 3), ("load", 1)]
+
+
+def test_unknown_priority_is_sent_as_normal(monkeypatch):
+    sent, _ = schedule(monkeypatch, [request("temperature", 0, egress.bulk),
+                                     request("load", 0, 7)])
+    assert sent == [("load", 0), ("temperature", 0)]
+
+
+def test_requests_left_on_shutdown_are_answered(monkeypatch):
+    sent, replies = schedule(monkeypatch, [request("temperature", 0, egress.normal),
+                                           request("fuel", 0, egress.critical)], stopped=True)
+    assert sent == []
+    assert replies["temperature"] == [(0, data_service.http_service_unavailable, {})]
+    assert replies["fuel"] == [(0, data_service.http_service_unavailable, {})]
+
+
+def test_failed_dispatch_is_answered_and_scheduler_keeps_running(monkeypatch):
+    sent, replies = schedule(monkeypatch, [request("fuel", 0, egress.critical),
+                                           request("load", 0, egress.normal)], fail=[("fuel", 0)])
+    assert sent == [("fuel", 0), ("load", 0)]
+    assert replies["fuel"] == [(0, data_service.http_service_unavailable, {})]
+    assert replies["load"] == [(0, data_service.http_ok, {})]
+
+
+def test_serialized_payload_is_sent_as_it_is(monkeypatch):
+    bodies = []
+    monkeypatch.setattr(data_service, "forward_data",
+                        lambda payload, url, jwt, name, backlog=False: bodies.append(payload) or data_service.http_ok)
+    requests = queue.Queue()
+    replies = {stream: queue.Queue() for stream in streams}
+    body = b'{"id": 0}'
+    requests.put(("temperature", 0, egress.normal, time.time(), "http://cloud/temperature", "jwt", "temperature",
+                  body))
+    flag = threading.Event()
+    scheduler = threading.Thread(target=egress.run_scheduler, args=(requests, replies, {}, flag, 60, None))
+    scheduler.start()
+    assert replies["temperature"].get(timeout=10) == (0, data_service.http_ok, {})
+    flag.set()
+    scheduler.join(10)
+    assert bodies == [body]
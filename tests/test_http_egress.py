@@ -0,0 +1,117 @@
+import json
+import math
+import time
+import socket
+import threading
+import pytest
+import http_egress
+import standins
+import traffic
+
+pytest.importorskip("h2")
+import h2.config
+import h2.connection
+
+
+class StalledWindowServer:
+    # HTTP/2 server that reads request data, but never opens flow control window again
+
+    def __init__(self):
+        self._socket = socket.create_server(("127.0.0.1", 0))
+        self.port = self._socket.getsockname()[1]
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def _serve(self):
+        connection, _ = self._socket.accept()
+        protocol = h2.connection.H2Connection(config=h2.config.H2Configuration(client_side=False))
+        protocol.initiate_connection()
+        connection.sendall(protocol.data_to_send())
+        while True:
+            data = connection.recv(65536)
+            if not data:
+                break
+            protocol.receive_data(data)
+            connection.sendall(protocol.data_to_send())
+        connection.close()
+
+    def close(self):
+        self._socket.close()
+
+
+@pytest.fixture
+def http2():
+    http_egress.configure({http_egress.protocol: http_egress.http2, http_egress.timeout: 1.0})
+    yield
+    http_egress.configure(None)
+
+
+def test_http2_request_is_answered(http2):
+    cloud = standins.H2StandIn()
+    try:
+        assert http_egress.post(cloud.url + "/data/temp", {"value": 1}, {}).status_code == 200
+        assert cloud.requests == 1
+    finally:
+        cloud.close()
+
+
+def test_http2_request_times_out_without_response(http2):
+    cloud = standins.H2StandIn(latency=10.0)
+    try:
+        start = time.monotonic()
+        with pytest.raises(ConnectionError):
+            http_egress.post(cloud.url + "/data/temp", {"value": 1}, {})
+        assert time.monotonic() - start < 5.0
+    finally:
+        cloud.close()
+
+
+def test_http2_request_fails_when_window_never_opens(http2):
+    server = StalledWindowServer()
+    try:
+        start = time.monotonic()
+        with pytest.raises(ConnectionError, match="window"):
+            http_egress.post("http://127.0.0.1:" + str(server.port) + "/data/temp", {"data": "x" * 200000}, {})
+        assert time.monotonic() - start < 5.0
+    finally:
+        server.close()
+
+
+def test_http2_connection_has_finite_default_timeout():
+    http_egress.configure({http_egress.protocol: http_egress.http2})
+    try:
+        connection, path = http_egress._http2_connection("http://127.0.0.1:1/data/temp?x=1")
+        assert connection.timeout == http_egress.default_http2_timeout
+        assert path == "/data/temp?x=1"
+    finally:
+        http_egress.configure(None)
+
+
+@pytest.mark.parametrize("protocol", [http_egress.http1, http_egress.http2])
+def test_nan_is_rejected_by_both_protocols(protocol):
+    http_egress.configure({http_egress.protocol: protocol, http_egress.timeout: 1.0})
+    try:
+        with pytest.raises(ValueError):
+            http_egress.post("http://127.0.0.1:1/data/temp", {"value": math.nan}, {})
+    finally:
+        http_egress.configure(None)
+
+
+@pytest.mark.parametrize("protocol", [http_egress.http1, http_egress.http2])
+def test_compressed_body_is_accounted_after_compression(protocol):
+    stand_in = standins.CloudStandIn() if protocol == http_egress.http1 else standins.H2StandIn()
+    http_egress.configure({http_egress.protocol: protocol, http_egress.timeout: 5.0, http_egress.compress: True})
+    url = stand_in.url + "/data/temp"
+    payload = [{"value": 21.5, "unit": "C", "time": "19.10.2026 10:00:00"}] * 50
+    try:
+        traffic.take()
+        response = http_egress.post(url, payload, {})
+        assert response.status_code == 200
+        counters = traffic.take()[url]
+        assert counters["bodyBytes"] == len(json.dumps(payload).encode("utf-8"))
+        assert 0 < counters["wireBodyBytes"] < counters["bodyBytes"]
+        if protocol == http_egress.http1:
+            assert json.loads(stand_in.bodies["/data/temp"][0]) == payload
+            assert stand_in.body_bytes == counters["wireBodyBytes"]
+    finally:
+        http_egress.configure(None)
+        stand_in.close()
@@ -0,0 +1,38 @@
+import time
+import pytest
+import mqtt_bridge
+import standins
+
+url = "http://cloud/data/temp"
+
+
+@pytest.fixture
+def broker():
+    broker = standins.MqttBrokerStandIn()
+    yield broker
+    broker.close()
+
+
+@pytest.mark.parametrize("qos", [0, 1, 2])
+def test_published_message_is_delivered(broker, qos):
+    conf = mqtt_bridge.upstream_config({mqtt_bridge.address: broker.address, mqtt_bridge.port: broker.port,
+                                        mqtt_bridge.qos: qos, mqtt_bridge.publish_timeout: 5.0,
+                                        mqtt_bridge.streams: {"temperature": "devices/{device}/temperature"}},
+                                       {"temperature": url}, "device1")
+    assert conf[mqtt_bridge.routes] == {url: "devices/device1/temperature"}
+    bridge = mqtt_bridge.create_bridge(conf, "test-bridge-" + str(qos))
+    try:
+        for value in range(20):
+            assert bridge.publish(url, {"value": value}) == mqtt_bridge.http_ok
+        # broker counts message after it reads it from connection
+        deadline = time.monotonic() + 5
+        while broker.published < 20 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert broker.published == 20
+    finally:
+        bridge.close()
+
+
+def test_streams_without_topic_are_not_bridged():
+    assert mqtt_bridge.upstream_config(None, {"temperature": url}, "device1") is None
+    assert mqtt_bridge.upstream_config({mqtt_bridge.streams: {}}, {"temperature": url}, "device1") is None
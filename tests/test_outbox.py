@@ -0,0 +1,89 @@
+import os
+import time
+import multiprocessing
+import outbox
+
+
+def _crash(path):
+    box = outbox.Outbox(path, "temperature", sync_batch=1000, sync_interval=1000)
+    for value in range(3):
+        box.append({"value": value}, sync=True)
+    box.ack(1)
+    box.sync()
+    # appended, but not synced before crash
+    box.append({"value": 3})
+    os._exit(0)
+
+
+def test_reopen_after_crash_recovers_synced_payloads(tmp_path):
+    path = str(tmp_path / "temperature.db")
+    process = multiprocessing.get_context("fork").Process(target=_crash, args=(path,))
+    process.start()
+    process.join()
+    box = outbox.Outbox(path, "temperature")
+    assert box.pending() == [(2, {"value": 1}), (3, {"value": 2})]
+    assert box.size() == 2
+    # offsets keep growing after reopen, so acked offsets are never reused
+    assert box.append({"value": 4}) > 3
+    box.close()
+
+
+def test_acked_payloads_are_not_replayed_after_reopen(tmp_path):
+    path = str(tmp_path / "load.db")
+    box = outbox.Outbox(path, "load")
+    offsets = [box.append({"value": value}) for value in range(5)]
+    box.ack(offsets[2])
+    box.close()
+    box = outbox.Outbox(path, "load")
+    assert [payload["value"] for _, payload in box.pending()] == [3, 4]
+    assert box.pending(1) == [(offsets[3], {"value": 3})]
+    box.close()
+
+
+def test_payload_is_kept_until_all_consumers_ack(tmp_path):
+    path = str(tmp_path / "fuel.db")
+    box = outbox.Outbox(path, "fuel", consumers=("mirror",))
+    offset = box.append({"value": 1})
+    box.ack(offset)
+    assert box.size() == 0
+    assert box.size("mirror") == 1
+    box.ack(offset, "mirror")
+    box.close()
+    box = outbox.Outbox(path, "fuel", consumers=("mirror",))
+    assert box.pending(consumer="mirror") == []
+    box.close()
+
+
+def test_idle_write_is_synced_by_timer(tmp_path):
+    path = str(tmp_path / "temperature.db")
+    box = outbox.Outbox(path, "temperature", sync_batch=1000, sync_interval=0.2)
+    box.append({"value": 1})
+    deadline = time.monotonic() + 5
+    while box._unsynced > 0 and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert box._unsynced == 0
+    box.close()
+
+
+def test_corrupted_database_is_moved_aside(tmp_path):
+    path = str(tmp_path / "temperature.db")
+    with open(path, "wb") as database:
+        database.write(b"not a database" * 100)
+    box = outbox.Outbox(path, "temperature")
+    assert box.size() == 0
+    assert any(name.startswith("temperature.db.corrupt-") for name in os.listdir(str(tmp_path)))
+    box.close()
+
+
+def test_write_ahead_log_of_corrupted_database_is_moved_aside(tmp_path):
+    path = str(tmp_path / "temperature.db")
+    for suffix, content in (("", b"not a database" * 100), ("-wal", b"stale log"), ("-shm", b"stale index")):
+        with open(path + suffix, "wb") as database:
+            database.write(content)
+    box = outbox.Outbox(path, "temperature")
+    box.append({"value": 1}, sync=True)
+    assert box.size() == 1
+    box.close()
+    names = os.listdir(str(tmp_path))
+    assert any(name.startswith("temperature.db.corrupt-") and name.endswith("-wal") for name in names)
+    assert any(name.startswith("temperature.db.corrupt-") and name.endswith("-shm") for name in names)
@@ -0,0 +1,96 @@
+import time
+import email.utils
+import resilience
+
+
+def test_backoff_delay_is_jittered_below_growing_bound(monkeypatch):
+    monkeypatch.setattr(resilience.random, "uniform", lambda low, high: high)
+    backoff = resilience.Backoff(base=1.0, cap=10.0, factor=2.0)
+    assert [backoff.next_delay() for _ in range(6)] == [1.0, 2.0, 4.0, 8.0, 10.0, 10.0]
+    backoff.reset()
+    assert backoff.next_delay() == 1.0
+
+
+def test_backoff_delay_stays_within_bounds():
+    backoff = resilience.Backoff(base=0.5, cap=3.0)
+    for _ in range(100):
+        assert 0.0 <= backoff.next_delay() <= 3.0
+    assert backoff.attempt == 100
+
+
+def test_breaker_opens_at_threshold_and_skips_requests():
+    breaker = resilience.CircuitBreaker("http://cloud/data", threshold=3, backoff=resilience.Backoff(base=60, cap=60))
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.state == resilience.state_closed
+    assert breaker.allow_request()
+    breaker.record_failure()
+    assert breaker.state == resilience.state_open
+    assert not breaker.allow_request()
+    assert breaker.retry_in() > 0
+
+
+def test_half_open_breaker_allows_single_probe(monkeypatch):
+    monkeypatch.setattr(resilience.random, "uniform", lambda low, high: 0.0)
+    breaker = resilience.CircuitBreaker("http://cloud/data", threshold=1)
+    breaker.record_failure()
+    assert breaker.state == resilience.state_open
+    assert breaker.allow_request()
+    assert breaker.state == resilience.state_half_open
+    # probe is in flight
+    assert not breaker.allow_request()
+    breaker.record_success()
+    assert breaker.state == resilience.state_closed
+    assert breaker.failures == 0
+    assert breaker.backoff.attempt == 0
+
+
+def test_failed_probe_opens_breaker_again(monkeypatch):
+    monkeypatch.setattr(resilience.random, "uniform", lambda low, high: 0.0)
+    breaker = resilience.CircuitBreaker("http://cloud/data", threshold=5)
+    breaker.record_failure(retry_after=0.0)
+    assert breaker.allow_request()
+    breaker.record_failure()
+    assert breaker.state == resilience.state_open
+
+
+def test_retry_after_opens_breaker_for_requested_delay():
+    breaker = resilience.CircuitBreaker("http://cloud/data", threshold=3, backoff=resilience.Backoff(base=0.0))
+    breaker.record_failure(retry_after=30.0)
+    assert breaker.state == resilience.state_open
+    assert 29.0 < breaker.retry_in() <= 30.0
+
+
+def test_breakers_are_shared_per_url_and_use_config():
+    resilience.configure({resilience.failure_threshold: 1})
+    try:
+        assert resilience.breaker("http://cloud/a") is resilience.breaker("http://cloud/a")
+        assert resilience.breaker("http://cloud/a") is not resilience.breaker("http://cloud/b")
+        assert resilience.breaker("http://cloud/a").threshold == 1
+    finally:
+        resilience.configure(None)
+
+
+def test_failure_codes():
+    assert resilience.is_failure(503)
+    assert resilience.is_failure(429)
+    assert not resilience.is_failure(401)
+    assert not resilience.is_failure(200)
+
+
+def test_parse_retry_after():
+    assert resilience.parse_retry_after(None) is None
+    assert resilience.parse_retry_after("120") == 120.0
+    assert resilience.parse_retry_after("-5") == 0.0
+    assert resilience.parse_retry_after("soon") is None
+    date = email.utils.formatdate(time.time() + 60, usegmt=True)
+    assert 55.0 < resilience.parse_retry_after(date) <= 60.0
+
+
+def test_rejected_codes():
+    assert resilience.is_rejected(400)
+    assert resilience.is_rejected(413)
+    assert resilience.is_rejected(422)
+    # solved by new JWT, waiting or connection that works again
+    for code in (401, 403, 404, 408, 429, 200, 503):
+        assert not resilience.is_rejected(code)
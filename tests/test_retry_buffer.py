@@ -0,0 +1,89 @@
+import sys
+import retry_buffer
+
+time_format = "%d.%m.%Y %H:%M:%S"
+
+
+def reading(value, second, minute=0):
+    return "[ value={:.2f} , time=01.01.2024 10:{:02d}:{:02d} , unit=C ]".format(value, minute, second)
+
+
+def test_drain_returns_readings_in_order_and_empties_buffer():
+    buffer = retry_buffer.RetryBuffer(time_format=time_format)
+    buffer.extend([reading(1, 0), reading(2, 1)])
+    buffer.extend([reading(3, 2)])
+    assert len(buffer) == 3
+    readings, aggregates = buffer.drain()
+    assert readings == [reading(1, 0), reading(2, 1), reading(3, 2)]
+    assert aggregates == []
+    assert len(buffer) == 0
+    assert buffer.bytes == 0
+
+
+def test_restored_data_goes_in_front_of_newer_data():
+    buffer = retry_buffer.RetryBuffer(time_format=time_format)
+    buffer.extend([reading(1, 0), reading(2, 1)])
+    readings, aggregates = buffer.drain()
+    buffer.extend([reading(3, 2)])
+    buffer.restore(readings, aggregates)
+    assert buffer.drain()[0] == [reading(1, 0), reading(2, 1), reading(3, 2)]
+
+
+def test_oldest_readings_are_summarized_when_limit_is_exceeded():
+    size = sys.getsizeof(reading(0, 0))
+    buffer = retry_buffer.RetryBuffer(max_bytes=5 * size + retry_buffer.aggregate_bytes, period=60,
+                                      time_format=time_format)
+    buffer.extend([reading(value, value) for value in range(10)])
+    assert buffer.bytes <= buffer.max_bytes
+    assert len(buffer) == 10
+    readings, aggregates = buffer.drain()
+    # newest readings are kept raw, folded ones are counted in aggregate of their period
+    assert readings == [reading(value, value) for value in range(5, 10)]
+    assert len(aggregates) == 1
+    assert aggregates[0]["count"] == 5
+    assert aggregates[0]["sum"] == sum(range(5))
+    assert (aggregates[0]["min"], aggregates[0]["max"], aggregates[0]["unit"]) == (0, 4, "C")
+    metrics = buffer.metrics()
+    assert metrics["summarizations"] == 1
+    assert metrics["folded"] == 5
+    assert metrics["peak_bytes"] > buffer.max_bytes
+
+
+def test_aggregates_are_merged_when_they_alone_exceed_limit():
+    buffer = retry_buffer.RetryBuffer(max_bytes=2 * retry_buffer.aggregate_bytes, period=60,
+                                      time_format=time_format)
+    buffer.extend([reading(minute, 0, minute) for minute in range(10)])
+    readings, aggregates = buffer.drain()
+    assert readings == []
+    assert len(aggregates) == 2
+    assert sum(aggregate["count"] for aggregate in aggregates) == 10
+    assert [aggregate["start"] for aggregate in aggregates] == sorted(aggregate["start"] for aggregate in aggregates)
+
+
+def test_restored_aggregates_are_merged_by_period():
+    # every reading is summarized right away
+    buffer = retry_buffer.RetryBuffer(max_bytes=0, period=60, time_format=time_format)
+    buffer.extend([reading(1, 0)])
+    readings, aggregates = buffer.drain()
+    assert readings == [] and len(aggregates) == 1
+    buffer.extend([reading(2, 30)])
+    buffer.restore(readings, aggregates)
+    readings, aggregates = buffer.drain()
+    assert readings == []
+    assert len(aggregates) == 1
+    assert aggregates[0]["count"] == 2
+    assert aggregates[0]["sum"] == 3
+
+
+def test_invalid_reading_is_dropped_when_summarized():
+    buffer = retry_buffer.RetryBuffer(max_bytes=0, time_format=time_format)
+    buffer.extend(["garbage"])
+    assert buffer.drain() == ([], [])
+
+
+def test_create_retry_buffer_uses_defaults():
+    buffer = retry_buffer.create_retry_buffer(None, time_format)
+    assert buffer.max_bytes == retry_buffer.default_max_bytes
+    assert buffer.period == retry_buffer.default_period
+    buffer = retry_buffer.create_retry_buffer({retry_buffer.max_bytes: 1024}, time_format)
+    assert buffer.max_bytes == 1024
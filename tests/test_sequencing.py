@@ -0,0 +1,71 @@
+import sequencing
+
+
+def observe_all(numbers):
+    tracker = sequencing.SequenceTracker()
+    return tracker, [tracker.observe(number) for number in numbers]
+
+
+def test_in_order_readings_have_no_anomalies():
+    tracker, anomalies = observe_all(range(5))
+    assert anomalies == [(0, 0, 0, 0)] * 5
+    assert tracker.highest == 4
+
+
+def test_first_reading_may_start_anywhere():
+    tracker, anomalies = observe_all([42, 43])
+    assert anomalies == [(0, 0, 0, 0)] * 2
+
+
+def test_skipped_readings_are_gaps():
+    tracker, anomalies = observe_all([0, 1, 5])
+    assert anomalies[-1] == (3, 0, 0, 0)
+    assert tracker.highest == 5
+
+
+def test_skipped_reading_arriving_later_is_reorder():
+    tracker, anomalies = observe_all([0, 3, 1, 2])
+    assert anomalies[1:] == [(2, 0, 0, 0), (0, 0, 1, 0), (0, 0, 1, 0)]
+    # reading that arrived late once is duplicate when it arrives again
+    assert tracker.observe(1) == (0, 1, 0, 0)
+
+
+def test_repeated_reading_is_duplicate():
+    tracker, anomalies = observe_all([0, 1, 2, 2, 1])
+    assert anomalies[3:] == [(0, 1, 0, 0), (0, 1, 0, 0)]
+
+
+def test_zero_restarts_sequence():
+    tracker, anomalies = observe_all([0, 1, 2, 0, 1])
+    assert anomalies[3:] == [(0, 0, 0, 1), (0, 0, 0, 0)]
+    assert tracker.highest == 1
+
+
+def test_number_far_behind_highest_restarts_sequence():
+    tracker, anomalies = observe_all([5000, 10])
+    assert anomalies[1] == (0, 0, 0, 1)
+    assert tracker.highest == 10
+
+
+def test_late_readings_are_tracked_only_within_window():
+    first = 100
+    highest = first + sequencing.window + 10
+    tracker, anomalies = observe_all([first, highest])
+    assert anomalies[1] == (sequencing.window + 9, 0, 0, 0)
+    assert tracker.observe(highest - sequencing.window) == (0, 0, 1, 0)
+    # reading older than window restarts sequence
+    assert tracker.observe(highest - sequencing.window - 1) == (0, 0, 0, 1)
+
+
+def test_missing_set_stays_bounded():
+    tracker = sequencing.SequenceTracker()
+    for number in range(0, 100 * sequencing.window, 2):
+        tracker.observe(number)
+    assert len(tracker._missing) <= 2 * sequencing.window
+
+
+def test_parse_sequence():
+    assert sequencing.parse_sequence("[ value=1.00 , time=01.01.2024 10:00:00 , unit=C , seq=7 , sent=1700000000.5 ]") \
+        == (7, 1700000000.5)
+    assert sequencing.parse_sequence("[ value=1.00 , time=01.01.2024 10:00:00 , unit=C ]") is None
+    assert sequencing.parse_sequence("[ value=1.00 , time=01.01.2024 10:00:00 , unit=C , seq=x , sent=1 ]") is None
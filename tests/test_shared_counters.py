@@ -0,0 +1,77 @@
+import pickle
+import multiprocessing
+import types
+import pytest
+import stats_service
+
+
+def stats_with(value):
+    return types.SimpleNamespace(**{field: value for field in stats_service.counter_fields})
+
+
+@pytest.fixture
+def counters():
+    counters = stats_service.SharedCounters()
+    yield counters
+    counters.close()
+    counters.unlink()
+
+
+def test_new_block_is_zeroed(counters):
+    snapshot = counters.snapshot()
+    assert snapshot["updated"] is None
+    assert all(snapshot[field] == 0 for field in stats_service.counter_fields)
+
+
+def test_snapshot_returns_written_counters(counters):
+    counters.write(stats_with(5))
+    snapshot = counters.snapshot()
+    assert snapshot["updated"] is not None
+    assert all(snapshot[field] == 5 for field in stats_service.counter_fields)
+
+
+def test_unpickled_counters_attach_same_block(counters):
+    attached = pickle.loads(pickle.dumps(counters))
+    try:
+        assert attached.name == counters.name
+        counters.write(stats_with(7))
+        assert attached.snapshot()["dataBytes"] == 7
+    finally:
+        attached.close()
+
+
+def test_snapshot_does_not_wait_forever_for_dead_writer(counters):
+    counters.write(stats_with(3))
+    # writer died in the middle of update and left sequence number odd
+    counters._values[0] += 1
+    assert counters.snapshot()["dataBytes"] == 3
+
+
+def _write(counters, count):
+    for value in range(1, count + 1):
+        counters.write(stats_with(value))
+
+
+def test_reader_never_sees_partial_update(counters):
+    count = 20000
+    writer = multiprocessing.get_context("fork").Process(target=_write, args=(counters, count))
+    writer.start()
+    last = 0
+    while writer.is_alive():
+        snapshot = counters.snapshot()
+        values = {snapshot[field] for field in stats_service.counter_fields}
+        # every counter is written with the same value, so mixed values mean torn read
+        assert len(values) == 1
+        assert values.pop() >= last
+        last = snapshot["dataBytes"]
+    writer.join()
+    assert counters.snapshot()["dataBytes"] == count
+
+
+def test_stats_continue_from_published_counters(counters):
+    counters.write(stats_with(11))
+    stats = stats_service.Stats(counters)
+    assert stats.dataBytes == 11
+    stats.update_received(4)
+    assert counters.snapshot()["dataBytes"] == 15
+    assert counters.snapshot()["dataMessages"] == 12
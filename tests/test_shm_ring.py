@@ -0,0 +1,63 @@
+import pickle
+import multiprocessing
+import pytest
+import shm_ring
+
+
+@pytest.fixture
+def ring():
+    ring = shm_ring.ShmRing(slots=8)
+    yield ring
+    ring.close()
+    ring.unlink()
+
+
+def test_readings_are_taken_in_order(ring):
+    assert ring.push(1.0, 10.0, "C")
+    assert ring.push_many([(2.0, 11.0, "C"), (3.0, 12.0, "kg")]) == 2
+    assert ring.pop_many(timeout=0) == [(1.0, 10.0, "C"), (2.0, 11.0, "C"), (3.0, 12.0, "kg")]
+    assert ring.pop_many(timeout=0) == []
+
+
+def test_full_ring_drops_readings(ring):
+    assert ring.push_many([(float(value), 0.0, "C") for value in range(10)]) == 8
+    assert not ring.push(10.0, 0.0, "C")
+    assert ring.dropped() == 3
+    assert [reading[0] for reading in ring.pop_many(3, timeout=0)] == [0.0, 1.0, 2.0]
+    # slots are reused once consumer moves tail
+    assert ring.push_many([(11.0, 0.0, "C")] * 3) == 3
+    assert len(ring.pop_many(timeout=0)) == 8
+
+
+def test_record_is_not_taken_before_it_is_committed(ring):
+    ring.push(1.0, 10.0, "C")
+    ring.push(2.0, 11.0, "C")
+    # head is visible, but commit word of second record is not
+    ring._commits[shm_ring._record_words] = 0
+    assert ring.pop_many(timeout=0) == [(1.0, 10.0, "C")]
+    ring._commits[shm_ring._record_words] = 2
+    assert ring.pop_many(timeout=0) == [(2.0, 11.0, "C")]
+
+
+def test_unit_cut_inside_multibyte_character_is_decoded(ring):
+    ring.push(1.0, 10.0, "°" * 9)
+    assert ring.pop_many(timeout=0) == [(1.0, 10.0, "°" * 8)]
+
+
+def _produce(ring, count):
+    for value in range(count):
+        while not ring.push(float(value), float(value), "C"):
+            pass
+    ring.close()
+
+
+def test_readings_pass_between_processes(ring):
+    count = 5000
+    producer = multiprocessing.get_context("fork").Process(target=_produce,
+                                                           args=(pickle.loads(pickle.dumps(ring)), count))
+    producer.start()
+    readings = []
+    while len(readings) < count:
+        readings += ring.pop_many(timeout=5)
+    producer.join()
+    assert readings == [(float(value), float(value), "C") for value in range(count)]
@@ -0,0 +1,117 @@
+import types
+import pytest
+import requests
+import stats_service
+
+time_pattern = "%d.%m.%Y %H:%M:%S"
+
+
+class FakeCounters:
+
+    def __init__(self, **values):
+        self.values = dict.fromkeys(stats_service.counter_fields, 0)
+        self.values.update(values)
+
+    def snapshot(self):
+        return dict(self.values, updated=None)
+
+
+@pytest.fixture
+def cloud(monkeypatch):
+    # responses are taken in order, exception instances are raised
+    cloud = types.SimpleNamespace(batches=[], responses=[])
+
+    def post(url, json=None, headers=None, timeout=None):
+        cloud.batches.append(json)
+        response = cloud.responses.pop(0) if cloud.responses else 200
+        if isinstance(response, Exception):
+            raise response
+        return types.SimpleNamespace(status_code=response)
+
+    monkeypatch.setattr(stats_service.requests, "post", post)
+    return cloud
+
+
+def uploader(tmp_path, counters):
+    return stats_service.StatsUploader("http://cloud/stats/streams", counters, lambda: "jwt", time_pattern, 60,
+                                       state_path=str(tmp_path / "stats.state"))
+
+
+def test_batch_holds_only_changed_streams_and_counters(tmp_path, cloud):
+    counters = {"temperature": FakeCounters(), "load": FakeCounters()}
+    stats = uploader(tmp_path, counters)
+    assert not stats.upload()
+    counters["temperature"].values.update(dataBytes=100, dataMessages=2, bufferBytes=50)
+    stats.collect()
+    assert stats.upload()
+    assert cloud.batches[0]["sequence"] == 1
+    assert cloud.batches[0]["streams"] == {"temperature": {"dataBytes": 100, "dataMessages": 2}}
+    # only growth since previous collect is uploaded
+    counters["temperature"].values["dataBytes"] = 130
+    stats.collect()
+    assert stats.upload()
+    assert cloud.batches[1]["sequence"] == 2
+    assert cloud.batches[1]["streams"] == {"temperature": {"dataBytes": 30}}
+
+
+def test_batch_is_resent_unchanged_until_acknowledged(tmp_path, cloud):
+    counters = {"fuel": FakeCounters(dataRequests=1)}
+    stats = uploader(tmp_path, counters)
+    stats.collect()
+    cloud.responses = [requests.ConnectionError(), 503]
+    assert not stats.upload()
+    # deltas collected while batch waits are kept for next batch
+    counters["fuel"].values["dataRequests"] = 3
+    stats.collect()
+    assert not stats.upload()
+    assert stats.upload()
+    assert cloud.batches[0] == cloud.batches[1] == cloud.batches[2]
+    assert cloud.batches[0]["sequence"] == 1
+    assert stats.upload()
+    assert cloud.batches[3]["sequence"] == 2
+    assert cloud.batches[3]["streams"] == {"fuel": {"dataRequests": 2}}
+
+
+def test_unacknowledged_batch_and_pending_deltas_survive_restart(tmp_path, cloud):
+    counters = {"load": FakeCounters(dataBytes=10)}
+    stats = uploader(tmp_path, counters)
+    stats.collect()
+    cloud.responses = [500]
+    assert not stats.upload()
+    counters["load"].values["dataBytes"] = 15
+    stats.collect()
+    # counters of new run start from zero
+    restarted = uploader(tmp_path, {"load": FakeCounters(dataBytes=1)})
+    restarted.collect()
+    assert restarted.upload()
+    assert cloud.batches[1] == cloud.batches[0]
+    assert restarted.upload()
+    assert cloud.batches[2]["sequence"] == 2
+    assert cloud.batches[2]["streams"] == {"load": {"dataBytes": 6}}
+
+
+def test_reset_counters_are_counted_from_zero(tmp_path, cloud):
+    counters = {"temperature": FakeCounters(dataBytes=100)}
+    stats = uploader(tmp_path, counters)
+    stats.collect()
+    counters["temperature"].values["dataBytes"] = 20
+    stats.collect()
+    assert stats.upload()
+    assert cloud.batches[0]["streams"] == {"temperature": {"dataBytes": 120}}
+
+
+def test_stats_uploader_is_created_only_with_upload_interval(tmp_path):
+    assert stats_service.create_stats_uploader(None, "url", {}, lambda: "jwt", time_pattern) is None
+    assert stats_service.create_stats_uploader({"live_interval": 60}, "url", {}, lambda: "jwt", time_pattern) is None
+    stats = stats_service.create_stats_uploader({stats_service.upload_interval: 300,
+                                                 stats_service.state_path: str(tmp_path / "stats.state")},
+                                                "url", {}, lambda: "jwt", time_pattern)
+    assert stats.upload_interval == 300
+
+
+def test_sending_overall_stats_keeps_circuit_breakers(cloud):
+    stats_service.resilience.configure(None)
+    breaker = stats_service.resilience.breaker("http://cloud/data/temp")
+    stats_service.OverallStats("http://cloud/stats", "jwt", time_pattern).send_stats()
+    assert len(cloud.batches) == 1
+    assert stats_service.resilience.breaker("http://cloud/data/temp") is breaker
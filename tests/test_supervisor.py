@@ -0,0 +1,60 @@
+import time
+import threading
+import multiprocessing
+import supervisor
+
+
+def _hang_on_shutdown(flag, worker_state=None):
+    while not flag.is_set():
+        supervisor.heartbeat()
+        time.sleep(0.05)
+    time.sleep(1000)
+
+
+def _stop(flag, worker_state=None):
+    flag.wait()
+
+
+def _crash_once(flag, marker, worker_state=None):
+    if not marker.is_set():
+        marker.set()
+        raise RuntimeError("crash")
+    flag.wait()
+
+
+def test_worker_hanging_in_shutdown_is_killed_after_deadline():
+    flag = multiprocessing.Event()
+    worker = supervisor.Worker("hang", _hang_on_shutdown, (flag,), flag)
+    threading.Timer(0.5, flag.set).start()
+    start = time.monotonic()
+    supervisor.run_workers({supervisor.shutdown_timeout: 1.0, supervisor.check_interval: 0.1}, [worker])
+    assert time.monotonic() - start < 10
+    assert worker.process.exitcode != 0
+    assert worker.restarts == 0
+
+
+def test_stopped_worker_is_not_restarted():
+    flag = multiprocessing.Event()
+    worker = supervisor.Worker("stop", _stop, (flag,), flag)
+    threading.Timer(0.3, flag.set).start()
+    supervisor.run_workers({supervisor.check_interval: 0.1}, [worker])
+    assert worker.process.exitcode == 0
+    assert worker.restarts == 0
+
+
+def test_crashed_worker_is_restarted():
+    flag = multiprocessing.Event()
+    marker = multiprocessing.Event()
+    worker = supervisor.Worker("crash", _crash_once, (flag, marker), flag)
+    threading.Timer(1.0, flag.set).start()
+    supervisor.run_workers({supervisor.check_interval: 0.1, supervisor.restart_delay: 0.1}, [worker])
+    assert worker.restarts == 1
+    assert worker.process.exitcode == 0
+
+
+def test_heartbeat_timeout_must_exceed_request_timeouts():
+    assert supervisor.check_config(None, 300, 300)
+    assert supervisor.check_config({supervisor.heartbeat_timeout: 150}, 30, 120)
+    assert supervisor.check_config({supervisor.heartbeat_timeout: 150}, None, None)
+    assert not supervisor.check_config({supervisor.heartbeat_timeout: 30}, 30, None)
+    assert not supervisor.check_config({}, 10, supervisor.default_heartbeat_timeout)